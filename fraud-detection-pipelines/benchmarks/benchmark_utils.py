@@ -0,0 +1,133 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Helpers shared by the pipeline benchmarks."""
+
+import os
+import threading
+import time
+from typing import Dict, List, Tuple
+
+import tfx.v1 as tfx
+from ml_metadata.metadata_store import metadata_store
+
+NODE_CONTEXT_TYPE = 'node'
+
+
+def get_component_timings(metadata_path: str, pipeline_name: str) -> Dict[str, Dict[str, float]]:
+    """Returns the start and end time (seconds since epoch) of the last execution of each component."""
+    store = metadata_store.MetadataStore(
+        tfx.orchestration.metadata.sqlite_metadata_connection_config(metadata_path))
+
+    timings = {}
+    for context in store.get_contexts_by_type(NODE_CONTEXT_TYPE):
+        # Node contexts are named <pipeline name>.<component id>
+        if not context.name.startswith(pipeline_name + '.'):
+            continue
+        executions = store.get_executions_by_context(context.id)
+        if not executions:
+            continue
+        last = max(executions, key=lambda e: e.create_time_since_epoch)
+        component_id = context.name[len(pipeline_name) + 1:]
+        timings[component_id] = {'start': last.create_time_since_epoch / 1000,
+                                 'end': last.last_update_time_since_epoch / 1000,
+                                 'wall_secs': (last.last_update_time_since_epoch -
+                                               last.create_time_since_epoch) / 1000}
+    return timings
+
+
+def _process_tree_rss_bytes(root_pid: int) -> int:
+    """Returns the resident memory of the process and all its descendants (Linux only)."""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                # The command name may contain spaces, the ppid is the 2nd field after it
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    total, pending = 0, [root_pid]
+    while pending:
+        pid = pending.pop()
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * page_size
+        except (OSError, IndexError, ValueError):
+            pass
+        pending.extend(children.get(pid, []))
+    return total
+
+
+class ResourceSampler:
+    """Samples the memory and CPU time of this process (and its children) in a background thread."""
+
+    def __init__(self, interval_secs: float = 0.5):
+        self._interval_secs = interval_secs
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        # (time since epoch, RSS bytes, CPU seconds)
+        self.samples: List[Tuple[float, int, float]] = []
+
+    def _sample(self):
+        times = os.times()
+        cpu_secs = times.user + times.system + times.children_user + times.children_system
+        self.samples.append((time.time(), _process_tree_rss_bytes(os.getpid()), cpu_secs))
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._sample()
+            self._stop.wait(self._interval_secs)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    def summarize(self, start: float, end: float) -> Dict[str, float]:
+        """Returns the peak RSS and the CPU time between start and end (seconds since epoch)."""
+        window = [s for s in self.samples if start <= s[0] <= end]
+        before = [s for s in self.samples if s[0] < start]
+        after = [s for s in self.samples if s[0] > end]
+        # Include the closest samples around the window, short components may have no sample inside
+        if before:
+            window.insert(0, before[-1])
+        if after:
+            window.append(after[0])
+        if not window:
+            return {'peak_rss_mb': 0.0, 'cpu_secs': 0.0}
+        return {'peak_rss_mb': max(s[1] for s in window) / 2 ** 20,
+                'cpu_secs': window[-1][2] - window[0][2]}
+
+
+def run_local_pipeline(pipeline: tfx.dsl.Pipeline) -> float:
+    """Runs the pipeline with the LocalDagRunner and returns its wall time in seconds."""
+    start = time.perf_counter()
+    tfx.orchestration.LocalDagRunner().run(pipeline)
+    return time.perf_counter() - start
+
+
+def format_table(rows: List[Dict], columns: List[str]) -> str:
+    widths = [max(len(c), *(len(f"{r.get(c, '')}") for r in rows)) for c in columns]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths))]
+    for r in rows:
+        lines.append("  ".join(f"{r.get(c, '')}".ljust(w) for c, w in zip(columns, widths)))
+    return "\n".join(lines)
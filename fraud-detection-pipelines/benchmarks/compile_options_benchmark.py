@@ -0,0 +1,112 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Compares the XLA, steps per execution and mixed precision options of build_model.
+
+Trains build_model on synthetic data with every option, and reports the training
+examples/sec, its speedup over the default options, and the latency of the model
+call of the serving signatures (XLA-compiled with jit_compile).
+
+    python -m benchmarks.compile_options_benchmark --num-examples=200000 --steps-per-execution=16
+"""
+
+import argparse
+import time
+from typing import Any, Dict
+
+import numpy as np
+import tensorflow as tf
+
+from benchmarks import benchmark_utils
+from benchmarks import packed_input_benchmark
+from my_vertex_pipelines import trainer_fn
+
+
+def _serving_latency_ms(model: tf.keras.Model, features: np.ndarray, packed: bool, batch_size: int,
+                        iterations: int, jit_compile: bool) -> float:
+    batch = features[:batch_size]
+    if packed:
+        x = {trainer_fn.PACKED_FEATURES_KEY: tf.constant(batch)}
+    else:
+        x = {k: tf.constant(batch[:, i:i + 1]) for i, k in enumerate(packed_input_benchmark.FEATURE_KEYS)}
+    # Same call of the model as in the serving signatures
+    model_call = trainer_fn._get_model_call(model, jit_compile)
+    predict = tf.function(lambda inputs: model_call(inputs))
+    predict(x)  # trace and compile
+    start = time.perf_counter()
+    for _ in range(iterations):
+        predict(x)
+    return (time.perf_counter() - start) * 1000 / iterations
+
+
+def run_benchmark(num_examples: int, batch_size: int, epochs: int, iterations: int, steps_per_execution: int,
+                  packed: bool):
+    rng = np.random.default_rng(0)
+    features = rng.random((num_examples, len(packed_input_benchmark.FEATURE_KEYS)), dtype=np.float32)
+    labels = (rng.random(num_examples) < 0.002).astype(np.int64)
+    ds = packed_input_benchmark._make_dataset(features, labels, batch_size, packed)
+
+    options: Dict[str, Dict[str, Any]] = {
+        'default': {},
+        'jit_compile': {'jit_compile': True},
+        f'steps_per_execution_{steps_per_execution}': {'steps_per_execution': steps_per_execution},
+        'mixed_bfloat16': {'mixed_precision': 'mixed_bfloat16'},
+        'all': {'jit_compile': True, 'steps_per_execution': steps_per_execution, 'mixed_precision': 'mixed_bfloat16'},
+    }
+    results = []
+    for name, compile_options in options.items():
+        model = trainer_fn.build_model(hparams=trainer_fn._get_hyperparameters(),
+                                       feature_keys=packed_input_benchmark.FEATURE_KEYS,
+                                       packed=packed,
+                                       **compile_options)
+        model.fit(ds, epochs=1, verbose=0)  # warm up: tracing, XLA compilation and dataset cache
+        start = time.perf_counter()
+        model.fit(ds, epochs=epochs, verbose=0)
+        elapsed = time.perf_counter() - start
+
+        jit_compile = compile_options.get('jit_compile', False)
+        results.append({
+            'options': name,
+            'train_examples_per_sec': round(num_examples * epochs / elapsed),
+            'serving_latency_ms_batch_1': round(
+                _serving_latency_ms(model, features, packed, 1, iterations, jit_compile), 3),
+            'serving_latency_ms_batch_256': round(
+                _serving_latency_ms(model, features, packed, 256, iterations, jit_compile), 3),
+        })
+
+    baseline = results[0]['train_examples_per_sec']
+    for result in results:
+        result['speedup'] = round(result['train_examples_per_sec'] / baseline, 2)
+
+    print(benchmark_utils.format_table(results, ['options', 'train_examples_per_sec', 'speedup',
+                                                 'serving_latency_ms_batch_1', 'serving_latency_ms_batch_256']))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-examples", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--steps-per-execution", type=int, default=16)
+    parser.add_argument("--per-column", action="store_true", default=False,
+                        help="One input per column instead of the packed input")
+    args = parser.parse_args()
+
+    run_benchmark(num_examples=args.num_examples,
+                  batch_size=args.batch_size,
+                  epochs=args.epochs,
+                  iterations=args.iterations,
+                  steps_per_execution=args.steps_per_execution,
+                  packed=not args.per_column)
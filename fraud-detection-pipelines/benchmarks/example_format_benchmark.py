@@ -0,0 +1,93 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""A/B benchmark of the TFRecord and Parquet formats of the ExampleGen output.
+
+Runs the pipeline locally with the same synthetic data and each --example-format,
+and reports, for every stage, the CPU time and the bytes stored in its output
+artifacts. Fails if a stage did not run with one of the formats, so it is also a
+smoke test of the Parquet examples through the Trainer and the Evaluator.
+
+    python -m benchmarks.example_format_benchmark --num-rows=1000000 --work-dir=/tmp/example_format_benchmark
+"""
+
+import argparse
+import json
+import logging
+import os
+from typing import Dict
+
+from benchmarks import benchmark_utils
+from benchmarks import pipeline_benchmark
+from my_vertex_pipelines import vertex_configs
+
+STAGES = ['ExampleGen', 'StatisticsGen', 'Transform', 'Trainer', 'Evaluator']
+
+
+def _get_stored_bytes(pipeline_root: str) -> Dict[str, int]:
+    """Returns the size of the output artifacts of each component, in the component directories of the root."""
+    stored_bytes = {}
+    for component_id in os.listdir(pipeline_root):
+        component_dir = os.path.join(pipeline_root, component_id)
+        if os.path.isdir(component_dir):
+            stored_bytes[component_id] = sum(os.path.getsize(os.path.join(dir_name, f))
+                                             for dir_name, _, files in os.walk(component_dir) for f in files)
+    return stored_bytes
+
+
+def run_benchmark(work_dir: str, num_rows: int, data_format: str, local_profile: str):
+    reports = {}
+    rows = []
+    for example_format in vertex_configs.EXAMPLE_FORMATS:
+        report = pipeline_benchmark.run_benchmark(work_dir=work_dir,
+                                                  num_rows=num_rows,
+                                                  data_format=data_format,
+                                                  local_profile=local_profile,
+                                                  pipeline_options={'example_format': example_format})
+        missing = [stage for stage in STAGES if not any(c.endswith(stage) for c in report['components'])]
+        if missing:
+            raise RuntimeError(f"The stages {missing} did not run with --example-format={example_format}")
+        report['stored_bytes'] = _get_stored_bytes(report['pipeline_root'])
+        reports[example_format] = report
+        for component_id, component in sorted(report['components'].items()):
+            if not any(component_id.endswith(stage) for stage in STAGES):
+                continue
+            rows.append({'format': example_format,
+                         'component': component_id,
+                         'cpu_secs': f"{component['cpu_secs']:.1f}",
+                         'wall_secs': f"{component['wall_secs']:.1f}",
+                         'stored_mb': f"{report['stored_bytes'].get(component_id, 0) / 2 ** 20:.1f}"})
+
+    print(benchmark_utils.format_table(rows, ['format', 'component', 'cpu_secs', 'wall_secs', 'stored_mb']))
+    return reports
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--work-dir", required=True)
+    parser.add_argument("--num-rows", type=int, default=1000000)
+    parser.add_argument("--data-format", choices=vertex_configs.LOCAL_DATA_FORMATS, default="parquet",
+                        help="Format of the synthetic input files, the same for both runs")
+    parser.add_argument("--local-profile", choices=vertex_configs.LOCAL_PROFILES, default="single")
+    parser.add_argument("--output", required=False, help="Write the JSON reports to this file")
+    args = parser.parse_args()
+
+    benchmark_reports = run_benchmark(work_dir=args.work_dir,
+                                      num_rows=args.num_rows,
+                                      data_format=args.data_format,
+                                      local_profile=args.local_profile)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark_reports, f, indent=2)
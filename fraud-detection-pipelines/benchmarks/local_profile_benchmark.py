@@ -0,0 +1,102 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Compares the wall time per component of the local execution profiles.
+
+Runs the full pipeline with the LocalDagRunner once per profile, each with a
+fresh metadata store and pipeline root so no component is served from cache.
+
+    python -m benchmarks.local_profile_benchmark --project-id=... --region=... \
+        --temp-location=gs://... --query="SELECT * FROM data_playground.transactions" \
+        --transform-fn-path=./my_vertex_pipelines/feature_engineering_fn.py \
+        --trainer-fn-path=./my_vertex_pipelines/trainer_fn.py \
+        --output=/tmp/local_profile_benchmark.json
+"""
+
+import argparse
+import json
+import os
+import tempfile
+
+import tfx.v1 as tfx
+
+from benchmarks import benchmark_utils
+from my_vertex_pipelines import fraud_detection_pipeline
+from my_vertex_pipelines import vertex_configs
+
+PIPELINE_NAME = 'local-profile-benchmark'
+
+
+def run_benchmark(profiles, project_id: str, region: str, temp_location: str, query: str,
+                  transform_fn_file: str, trainer_fn_file: str):
+    results = {}
+    for profile in profiles:
+        execution_profile = vertex_configs.get_local_execution_profile(profile=profile)
+        work_dir = tempfile.mkdtemp(prefix=f"{PIPELINE_NAME}-{profile}-")
+        metadata_path = os.path.join(work_dir, 'metadata.db')
+
+        pipeline = fraud_detection_pipeline.create_pipeline(
+            pipeline_name=PIPELINE_NAME,
+            experiment_name=f"{PIPELINE_NAME}-experiment",
+            experiment_run_name=f"{PIPELINE_NAME}-{profile}",
+            pipeline_root=os.path.join(work_dir, 'root'),
+            query=query,
+            transform_fn_file=transform_fn_file,
+            trainer_fn_file=trainer_fn_file,
+            beam_pipeline_args=vertex_configs.get_beam_args_for_local(project=project_id,
+                                                                      temp_location_gcs=temp_location,
+                                                                      region=region,
+                                                                      execution_profile=execution_profile),
+            region=region,
+            project_id=project_id,
+            service_account=None,
+            local_connection_config=tfx.orchestration.metadata.sqlite_metadata_connection_config(metadata_path),
+            stats_batch_size=execution_profile['stats_batch_size'])
+
+        total_secs = benchmark_utils.run_local_pipeline(pipeline)
+        timings = benchmark_utils.get_component_timings(metadata_path, PIPELINE_NAME)
+        results[profile] = {'execution_profile': execution_profile,
+                            'total_secs': total_secs,
+                            'components': {k: v['wall_secs'] for k, v in timings.items()}}
+
+    rows = [{'component': c, **{p: f"{results[p]['components'].get(c, 0):.1f}" for p in profiles}}
+            for c in sorted({c for r in results.values() for c in r['components']})]
+    rows.append({'component': 'TOTAL', **{p: f"{results[p]['total_secs']:.1f}" for p in profiles}})
+    print(benchmark_utils.format_table(rows, ['component'] + list(profiles)))
+
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--profiles", nargs="+", default=vertex_configs.LOCAL_PROFILES,
+                        choices=vertex_configs.LOCAL_PROFILES)
+    parser.add_argument("--project-id", required=True)
+    parser.add_argument("--region", required=True)
+    parser.add_argument("--temp-location", required=True)
+    parser.add_argument("--query", required=True)
+    parser.add_argument("--transform-fn-path", required=True)
+    parser.add_argument("--trainer-fn-path", required=True)
+    parser.add_argument("--output", required=False, help="Write the results as JSON to this file")
+    args = parser.parse_args()
+
+    benchmark_results = run_benchmark(profiles=args.profiles,
+                                      project_id=args.project_id,
+                                      region=args.region,
+                                      temp_location=args.temp_location,
+                                      query=args.query,
+                                      transform_fn_file=args.transform_fn_path,
+                                      trainer_fn_file=args.trainer_fn_path)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark_results, f, indent=2)
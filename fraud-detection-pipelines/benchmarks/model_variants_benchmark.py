@@ -0,0 +1,72 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Compares the size, load time and latency of the float model and its lightweight variants.
+
+Takes the serving model and the model run directory of a Trainer run with
+--export-variants (see model_variants), and measures every SavedModel with the
+raw tensor signature.
+
+    python -m benchmarks.model_variants_benchmark --model-dir=<Trainer model>/Format-Serving \
+        --model-run-dir=<Trainer model_run> --batch-sizes 1 256
+"""
+
+import argparse
+import json
+import os
+import time
+
+import tensorflow as tf
+
+from my_vertex_pipelines import model_variants
+from my_vertex_pipelines import serving_utils
+
+
+def run_benchmark(model_dir: str, model_run_dir: str, batch_sizes, iterations: int):
+    model_dirs = {model_variants.FLOAT_MODEL: model_dir}
+    variants_dir = os.path.join(model_run_dir, model_variants.VARIANTS_DIR)
+    for variant in sorted(tf.io.gfile.listdir(variants_dir)):
+        model_dirs[variant.rstrip('/')] = os.path.join(variants_dir, variant.rstrip('/'))
+
+    results = {}
+    for name, path in model_dirs.items():
+        size, gzip_size = serving_utils.get_model_size(path)
+        start = time.perf_counter()
+        serving_utils.load_model(path)
+        load_secs = time.perf_counter() - start
+        results[name] = {'size_bytes': size, 'gzip_size_bytes': gzip_size, 'load_secs': load_secs}
+        for batch_size in batch_sizes:
+            results[name][f'p50_ms_batch_{batch_size}'] = serving_utils.measure_raw_latency_ms(
+                path, batch_size, iterations)
+
+    float_size = results[model_variants.FLOAT_MODEL]['gzip_size_bytes']
+    for result in results.values():
+        result['gzip_size_ratio'] = result['gzip_size_bytes'] / float_size
+
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-dir", required=True, help="Float SavedModel of the Trainer")
+    parser.add_argument("--model-run-dir", required=True,
+                        help="Model run directory of the same Trainer run, with the variants")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 256])
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    run_benchmark(model_dir=args.model_dir,
+                  model_run_dir=args.model_run_dir,
+                  batch_sizes=args.batch_sizes,
+                  iterations=args.iterations)
@@ -0,0 +1,93 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Compares the per-column and the packed model input layouts.
+
+Trains build_model on synthetic data with both layouts and reports training
+examples/sec and the latency of a single forward pass.
+
+    python -m benchmarks.packed_input_benchmark --num-examples=200000
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from my_vertex_pipelines import trainer_fn
+
+FEATURE_KEYS = [f"V{i}" for i in range(1, 29)] + ["Amount"]
+
+
+def _make_dataset(features: np.ndarray, labels: np.ndarray, batch_size: int, packed: bool) -> tf.data.Dataset:
+    if packed:
+        x = {trainer_fn.PACKED_FEATURES_KEY: features}
+    else:
+        x = {k: features[:, i:i + 1] for i, k in enumerate(FEATURE_KEYS)}
+    return tf.data.Dataset.from_tensor_slices((x, labels)).batch(batch_size).cache().prefetch(tf.data.AUTOTUNE)
+
+
+def _serving_latency_ms(model: tf.keras.Model, features: np.ndarray, packed: bool, batch_size: int,
+                        iterations: int) -> float:
+    batch = features[:batch_size]
+    if packed:
+        x = {trainer_fn.PACKED_FEATURES_KEY: tf.constant(batch)}
+    else:
+        x = {k: tf.constant(batch[:, i:i + 1]) for i, k in enumerate(FEATURE_KEYS)}
+    predict = tf.function(lambda inputs: model(inputs, training=False))
+    predict(x)  # trace
+    start = time.perf_counter()
+    for _ in range(iterations):
+        predict(x)
+    return (time.perf_counter() - start) * 1000 / iterations
+
+
+def run_benchmark(num_examples: int, batch_size: int, epochs: int, iterations: int):
+    rng = np.random.default_rng(0)
+    features = rng.random((num_examples, len(FEATURE_KEYS)), dtype=np.float32)
+    labels = (rng.random(num_examples) < 0.002).astype(np.int64)
+
+    results = {}
+    for layout, packed in [("per_column", False), ("packed", True)]:
+        model = trainer_fn.build_model(hparams=trainer_fn._get_hyperparameters(),
+                                       feature_keys=FEATURE_KEYS,
+                                       packed=packed)
+        ds = _make_dataset(features, labels, batch_size, packed)
+        model.fit(ds, epochs=1, verbose=0)  # warm up: tracing and dataset cache
+        start = time.perf_counter()
+        model.fit(ds, epochs=epochs, verbose=0)
+        elapsed = time.perf_counter() - start
+        results[layout] = {
+            'train_examples_per_sec': num_examples * epochs / elapsed,
+            'serving_latency_ms_batch_1': _serving_latency_ms(model, features, packed, 1, iterations),
+            'serving_latency_ms_batch_256': _serving_latency_ms(model, features, packed, 256, iterations),
+        }
+
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-examples", type=int, default=200000)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--epochs", type=int, default=3)
+    parser.add_argument("--iterations", type=int, default=1000)
+    args = parser.parse_args()
+
+    run_benchmark(num_examples=args.num_examples,
+                  batch_size=args.batch_size,
+                  epochs=args.epochs,
+                  iterations=args.iterations)
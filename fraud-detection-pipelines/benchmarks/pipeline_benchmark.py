@@ -0,0 +1,143 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""End-to-end benchmark of the pipeline on synthetic creditcard data.
+
+Generates (or reuses) synthetic data, runs create_pipeline with the
+LocalDagRunner and writes a JSON report with the wall time, peak RSS, CPU time
+and examples/sec of each component.
+
+    python -m benchmarks.pipeline_benchmark --num-rows=1000000 --data-format=parquet \
+        --work-dir=/tmp/pipeline_benchmark --output=/tmp/pipeline_benchmark/report.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import platform
+import time
+
+import tfx.v1 as tfx
+
+from benchmarks import benchmark_utils
+from my_vertex_pipelines import fraud_detection_pipeline
+from my_vertex_pipelines import synthetic_data
+from my_vertex_pipelines import vertex_configs
+
+PIPELINE_NAME = 'pipeline-benchmark'
+# Component ids are the class names, e.g. FileBasedExampleGen
+COMPONENTS = ['ExampleGen', 'StatisticsGen', 'Transform', 'Trainer', 'Evaluator']
+
+MODULE_DIR = os.path.dirname(os.path.abspath(fraud_detection_pipeline.__file__))
+
+
+def run_benchmark(work_dir: str,
+                  num_rows: int,
+                  data_format: str = 'csv',
+                  data_path: str = None,
+                  local_profile: str = 'single',
+                  transform_fn_file: str = os.path.join(MODULE_DIR, 'feature_engineering_fn.py'),
+                  trainer_fn_file: str = os.path.join(MODULE_DIR, 'trainer_fn.py'),
+                  pipeline_options: dict = None):
+    if not data_path:
+        data_path = os.path.join(work_dir, f'data-{num_rows}-{data_format}')
+        if not os.path.exists(data_path):
+            synthetic_data.generate(output_dir=data_path, num_rows=num_rows, data_format=data_format)
+
+    # Fresh metadata store and pipeline root, so nothing is served from the cache
+    run_dir = os.path.join(work_dir, time.strftime('run-%Y%m%d%H%M%S'))
+    metadata_path = os.path.join(run_dir, 'metadata.db')
+    execution_profile = vertex_configs.get_local_execution_profile(profile=local_profile)
+
+    pipeline = fraud_detection_pipeline.create_pipeline(
+        pipeline_name=PIPELINE_NAME,
+        experiment_name=f"{PIPELINE_NAME}-experiment",
+        experiment_run_name=os.path.basename(run_dir),
+        pipeline_root=os.path.join(run_dir, 'root'),
+        query=None,
+        transform_fn_file=transform_fn_file,
+        trainer_fn_file=trainer_fn_file,
+        beam_pipeline_args=vertex_configs.get_beam_args_for_local(project='local',
+                                                                  temp_location_gcs=os.path.join(run_dir, 'tmp'),
+                                                                  region='local',
+                                                                  execution_profile=execution_profile),
+        region=None,
+        project_id=None,
+        service_account=None,
+        local_connection_config=tfx.orchestration.metadata.sqlite_metadata_connection_config(metadata_path),
+        stats_batch_size=execution_profile['stats_batch_size'],
+        data_path=data_path,
+        data_format=data_format,
+        **(pipeline_options or {}))
+
+    with benchmark_utils.ResourceSampler() as sampler:
+        total_secs = benchmark_utils.run_local_pipeline(pipeline)
+
+    components = {}
+    for component_id, timing in benchmark_utils.get_component_timings(metadata_path, PIPELINE_NAME).items():
+        resources = sampler.summarize(timing['start'], timing['end'])
+        components[component_id] = {
+            'wall_secs': timing['wall_secs'],
+            'peak_rss_mb': resources['peak_rss_mb'],
+            'cpu_secs': resources['cpu_secs'],
+            # Rows of the input data per second, comparable across components and runs
+            'examples_per_sec': num_rows / timing['wall_secs'] if timing['wall_secs'] else None,
+        }
+
+    report = {
+        'pipeline': PIPELINE_NAME,
+        'num_rows': num_rows,
+        'data_format': data_format,
+        'data_path': data_path,
+        'pipeline_root': os.path.join(run_dir, 'root'),
+        'execution_profile': execution_profile,
+        'pipeline_options': pipeline_options or {},
+        'host': {'cpu_count': os.cpu_count(), 'platform': platform.platform(), 'tfx_version': tfx.__version__},
+        'total_wall_secs': total_secs,
+        'components': components,
+    }
+
+    rows = [{'component': k,
+             'wall_secs': f"{v['wall_secs']:.1f}",
+             'peak_rss_mb': f"{v['peak_rss_mb']:.0f}",
+             'cpu_secs': f"{v['cpu_secs']:.1f}",
+             'examples_per_sec': f"{v['examples_per_sec'] or 0:.0f}"}
+            for k, v in sorted(components.items())
+            if any(k.endswith(c) for c in COMPONENTS)]
+    print(benchmark_utils.format_table(rows, ['component', 'wall_secs', 'peak_rss_mb', 'cpu_secs',
+                                              'examples_per_sec']))
+    return report
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--work-dir", required=True)
+    parser.add_argument("--num-rows", type=int, default=1000000)
+    parser.add_argument("--data-format", choices=vertex_configs.LOCAL_DATA_FORMATS, default="csv")
+    parser.add_argument("--data-path", required=False,
+                        help="Existing data to use instead of generating it (--num-rows must match)")
+    parser.add_argument("--local-profile", choices=vertex_configs.LOCAL_PROFILES, default="single")
+    parser.add_argument("--output", required=False, help="Write the JSON report to this file")
+    args = parser.parse_args()
+
+    benchmark_report = run_benchmark(work_dir=args.work_dir,
+                                     num_rows=args.num_rows,
+                                     data_format=args.data_format,
+                                     data_path=args.data_path,
+                                     local_profile=args.local_profile)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark_report, f, indent=2)
@@ -0,0 +1,110 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Load test of the local prediction server for different batching settings.
+
+Starts the server in-process for every combination of max batch size and max
+wait time, and sends single-transaction requests from concurrent clients.
+Reports the client-side p50/p99 latency, the throughput and the mean batch size.
+
+    python -m benchmarks.prediction_server_benchmark --max-batch-sizes 1 16 64 --max-wait-ms 0 2 5 \
+      --concurrency=64 --requests-per-client=200
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from typing import Dict, List
+
+import numpy as np
+
+from benchmarks import benchmark_utils
+from my_vertex_pipelines import prediction_server
+from my_vertex_pipelines import synthetic_data
+from my_vertex_pipelines import vertex_configs
+
+
+async def _client(host: str, port: int, requests: List[Dict[str, float]], latencies: List[float]):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        for request in requests:
+            start = time.perf_counter()
+            writer.write(json.dumps(request).encode() + b'\n')
+            await writer.drain()
+            response = json.loads(await reader.readline())
+            if 'error' in response:
+                raise RuntimeError(response['error'])
+            latencies.append(time.perf_counter() - start)
+    finally:
+        writer.close()
+
+
+async def _run_load(model_dir: str, port: int, max_batch_size: int, max_wait_ms: float, concurrency: int,
+                    requests_per_client: int, num_inference_threads: int) -> Dict[str, float]:
+    predictor = prediction_server.MicroBatchingPredictor(base_dir=model_dir,
+                                                         max_batch_size=max_batch_size,
+                                                         max_wait_ms=max_wait_ms,
+                                                         num_inference_threads=num_inference_threads)
+    await predictor.start()
+    server = await asyncio.start_server(
+        lambda r, w: prediction_server._handle_connection(predictor, r, w), '127.0.0.1', port)
+
+    columns = synthetic_data.generate_chunk(concurrency * requests_per_client, first_row=0, seed=0)
+    keys = synthetic_data.FEATURE_KEYS + ['Amount']
+    rows = [{k: float(columns[k][n]) for k in keys} for n in range(concurrency * requests_per_client)]
+
+    latencies: List[float] = []
+    start = time.perf_counter()
+    async with server:
+        await asyncio.gather(*[
+            _client('127.0.0.1', port, rows[c * requests_per_client:(c + 1) * requests_per_client], latencies)
+            for c in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    server_stats = predictor.stats.summary()
+    await predictor.stop()
+
+    latencies = np.array(latencies)
+    return {'max_batch_size': max_batch_size,
+            'max_wait_ms': max_wait_ms,
+            'requests_per_sec': round(len(latencies) / elapsed, 1),
+            'p50_ms': round(float(np.percentile(latencies, 50) * 1000), 2),
+            'p99_ms': round(float(np.percentile(latencies, 99) * 1000), 2),
+            'mean_batch_size': round(server_stats['mean_batch_size'], 1)}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-dir", default=vertex_configs.SERVING_MODEL_DIR)
+    parser.add_argument("--port", type=int, default=8501)
+    parser.add_argument("--max-batch-sizes", type=int, nargs='+', default=[1, 16, 64, 256])
+    parser.add_argument("--max-wait-ms", type=float, nargs='+', default=[0.0, 2.0, 5.0])
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--requests-per-client", type=int, default=200)
+    parser.add_argument("--num-inference-threads", type=int, default=1)
+    args = parser.parse_args()
+
+    results = []
+    for max_batch_size, max_wait_ms in itertools.product(args.max_batch_sizes, args.max_wait_ms):
+        result = asyncio.run(_run_load(model_dir=args.model_dir,
+                                       port=args.port,
+                                       max_batch_size=max_batch_size,
+                                       max_wait_ms=max_wait_ms,
+                                       concurrency=args.concurrency,
+                                       requests_per_client=args.requests_per_client,
+                                       num_inference_threads=args.num_inference_threads))
+        results.append(result)
+
+    print(benchmark_utils.format_table(
+        results, ['max_batch_size', 'max_wait_ms', 'requests_per_sec', 'p50_ms', 'p99_ms', 'mean_batch_size']))
@@ -0,0 +1,85 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Compares the latency and throughput of the tf.Example and raw tensor serving signatures.
+
+Loads the latest model pushed to SERVING_MODEL_DIR and calls both signatures
+with synthetic transactions. The time of the tf.Example signature includes
+serializing the examples, which is what a client has to do.
+
+    python -m benchmarks.serving_signatures_benchmark --batch-sizes 1 32 256
+"""
+
+import argparse
+import json
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from my_vertex_pipelines import serving_utils
+from my_vertex_pipelines import synthetic_data
+from my_vertex_pipelines import vertex_configs
+
+
+def _measure(fn, iterations: int) -> np.ndarray:
+    fn()  # warm up
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        latencies.append(time.perf_counter() - start)
+    return np.array(latencies)
+
+
+def run_benchmark(model_dir: str, batch_sizes, iterations: int):
+    model = serving_utils.load_model(model_dir)
+    raw_feature_keys = serving_utils.get_raw_feature_keys(model)
+    examples_fn = model.signatures[serving_utils.EXAMPLES_SIGNATURE]
+    raw_fn = model.signatures[serving_utils.RAW_TENSOR_SIGNATURE]
+
+    results = {'model_dir': model_dir}
+    for batch_size in batch_sizes:
+        columns = synthetic_data.generate_chunk(batch_size, first_row=0, seed=0)
+        rows = {k: columns[k] for k in raw_feature_keys}
+        dense = np.stack([rows[k] for k in raw_feature_keys], axis=1).astype(np.float32)
+
+        def call_examples():
+            return examples_fn(examples=tf.constant(serving_utils.rows_to_tf_examples(rows)))
+
+        def call_raw():
+            return raw_fn(features=tf.constant(dense))
+
+        for name, fn in [('tf_example', call_examples), ('raw_tensor', call_raw)]:
+            latencies = _measure(fn, iterations)
+            results[f"{name}_batch_{batch_size}"] = {
+                'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                'p99_ms': float(np.percentile(latencies, 99) * 1000),
+                'examples_per_sec': float(batch_size / latencies.mean()),
+            }
+
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-dir", required=False,
+                        help="SavedModel to benchmark (default: latest version in SERVING_MODEL_DIR)")
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 32, 256])
+    parser.add_argument("--iterations", type=int, default=500)
+    args = parser.parse_args()
+
+    run_benchmark(model_dir=args.model_dir or serving_utils.get_latest_model_dir(vertex_configs.SERVING_MODEL_DIR),
+                  batch_sizes=args.batch_sizes,
+                  iterations=args.iterations)
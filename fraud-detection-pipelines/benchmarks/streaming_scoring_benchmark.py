@@ -0,0 +1,77 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Throughput of the streaming scoring, with the in-memory source, for several micro-batch sizes.
+
+Runs my_vertex_pipelines.streaming_scoring with synthetic transactions and the
+latest model pushed to SERVING_MODEL_DIR (trained with --velocity-features to
+use the velocity features). Reports the transactions per second and the mean
+and max time from the source to the score. The memory source is bounded, so
+the time to the score includes waiting for the whole input to be read: the
+latency of a Pub/Sub stream is closer to the max wait of the micro-batches.
+
+    python -m benchmarks.streaming_scoring_benchmark --num-transactions=100000 --batch-sizes 16 64 256
+"""
+
+import argparse
+import time
+
+from apache_beam.metrics.metric import MetricsFilter
+
+from benchmarks import benchmark_utils
+from my_vertex_pipelines import serving_utils
+from my_vertex_pipelines import streaming_scoring
+from my_vertex_pipelines import vertex_configs
+
+
+def run_benchmark(model_dir: str, num_transactions: int, batch_size: int, max_wait_ms: int, num_cards: int,
+                  beam_pipeline_args):
+    start = time.perf_counter()
+    result = streaming_scoring.run(source=f'memory:{num_transactions}',
+                                   sink='log',
+                                   model_dir=model_dir,
+                                   batch_size=batch_size,
+                                   max_wait_ms=max_wait_ms,
+                                   alert_threshold=2.0,  # Never logs, the scores are probabilities
+                                   num_cards=num_cards,
+                                   beam_pipeline_args=beam_pipeline_args)
+    elapsed = time.perf_counter() - start
+
+    latency = result.metrics().query(MetricsFilter().with_name('latency_ms'))['distributions'][0].committed
+    return {'batch_size': batch_size,
+            'transactions_per_sec': round(num_transactions / elapsed, 1),
+            'mean_latency_ms': round(latency.mean, 1),
+            'max_latency_ms': latency.max}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-dir", required=False,
+                        help="SavedModel to score with (default: latest version in SERVING_MODEL_DIR)")
+    parser.add_argument("--num-transactions", type=int, default=100000)
+    parser.add_argument("--num-cards", type=int, default=1000)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[16, 64, 256])
+    parser.add_argument("--max-wait-ms", type=int, default=vertex_configs.STREAM_MAX_WAIT_MS)
+    args, beam_args = parser.parse_known_args()
+
+    model_dir = args.model_dir or serving_utils.get_latest_model_dir(vertex_configs.SERVING_MODEL_DIR)
+    results = [run_benchmark(model_dir=model_dir,
+                             num_transactions=args.num_transactions,
+                             batch_size=batch_size,
+                             max_wait_ms=args.max_wait_ms,
+                             num_cards=args.num_cards,
+                             beam_pipeline_args=beam_args)
+               for batch_size in args.batch_sizes]
+
+    print(benchmark_utils.format_table(
+        results, ['batch_size', 'transactions_per_sec', 'mean_latency_ms', 'max_latency_ms']))
@@ -0,0 +1,109 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Compares the keras and gbt trainer engines.
+
+Trains trainer_fn.build_model and trainer_gbt_fn.build_model with the same synthetic
+transactions, scaled to [0, 1] like the Transform step does, and reports the training
+time, the latency of the model call and the metrics of each one on held-out data.
+
+    python -m benchmarks.trainer_engine_benchmark --num-examples=500000 --fraud-rate=0.01
+"""
+
+import argparse
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from benchmarks import benchmark_utils
+from benchmarks import packed_input_benchmark
+from my_vertex_pipelines import synthetic_data
+from my_vertex_pipelines import trainer_fn
+from my_vertex_pipelines import trainer_gbt_fn
+
+
+def _get_data(num_examples: int, fraud_rate: float, seed: int):
+    columns = synthetic_data.generate_chunk(num_examples, first_row=0, seed=seed, fraud_rate=fraud_rate)
+    features = np.stack([columns[k] for k in packed_input_benchmark.FEATURE_KEYS], axis=1)
+    return features, columns['Class']
+
+
+def _get_metrics(model: tf.keras.Model, ds: tf.data.Dataset, labels: np.ndarray) -> dict:
+    scores = model.predict(ds, verbose=0).reshape(-1)
+    metrics = {'binary_accuracy': tf.keras.metrics.BinaryAccuracy(),
+               'auc': tf.keras.metrics.AUC(),
+               'auc_pr': tf.keras.metrics.AUC(curve='PR')}
+    for metric in metrics.values():
+        metric.update_state(labels, scores)
+    return {name: round(float(metric.result()), 4) for name, metric in metrics.items()}
+
+
+def run_benchmark(num_examples: int, fraud_rate: float, batch_size: int, epochs: int, iterations: int,
+                  num_trees: int, max_depth: int):
+    train_features, train_labels = _get_data(num_examples, fraud_rate, seed=0)
+    eval_features, eval_labels = _get_data(num_examples // 2, fraud_rate, seed=1)
+    # Min-max scaling with the training data, as in feature_engineering_fn
+    low, high = train_features.min(axis=0), train_features.max(axis=0)
+    train_features = (train_features - low) / np.maximum(high - low, 1e-6)
+    eval_features = (eval_features - low) / np.maximum(high - low, 1e-6)
+
+    train_ds = packed_input_benchmark._make_dataset(train_features, train_labels, batch_size, packed=False)
+    eval_ds = packed_input_benchmark._make_dataset(eval_features, eval_labels, batch_size, packed=False)
+
+    results = []
+    keras_model = trainer_fn.build_model(hparams=trainer_fn._get_hyperparameters(),
+                                         feature_keys=packed_input_benchmark.FEATURE_KEYS)
+    start = time.perf_counter()
+    keras_model.fit(train_ds, epochs=epochs, verbose=0)
+    results.append({'engine': 'keras', 'train_secs': time.perf_counter() - start, 'model': keras_model})
+
+    gbt_model = trainer_gbt_fn.build_model(num_trees=num_trees, max_depth=max_depth)
+    train_secs, _ = trainer_gbt_fn.train(gbt_model, train_ds, eval_ds)
+    results.append({'engine': 'gbt', 'train_secs': train_secs, 'model': gbt_model})
+
+    for result in results:
+        model = result.pop('model')
+        result['train_secs'] = round(result['train_secs'], 2)
+        result['train_examples_per_sec'] = round(num_examples * (epochs if result['engine'] == 'keras' else 1)
+                                                 / result['train_secs'])
+        for serving_batch_size in (1, 256):
+            result[f'serving_latency_ms_batch_{serving_batch_size}'] = round(
+                packed_input_benchmark._serving_latency_ms(model, eval_features, False, serving_batch_size,
+                                                           iterations), 3)
+        result.update(_get_metrics(model, eval_ds, eval_labels))
+
+    print(benchmark_utils.format_table(results, ['engine', 'train_secs', 'train_examples_per_sec',
+                                                 'serving_latency_ms_batch_1', 'serving_latency_ms_batch_256',
+                                                 'binary_accuracy', 'auc', 'auc_pr']))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-examples", type=int, default=200000)
+    parser.add_argument("--fraud-rate", type=float, default=synthetic_data.FRAUD_RATE)
+    parser.add_argument("--batch-size", type=int, default=4096)
+    parser.add_argument("--epochs", type=int, default=1, help="Passes over the training data of the keras engine")
+    parser.add_argument("--iterations", type=int, default=500)
+    parser.add_argument("--num-trees", type=int, default=trainer_gbt_fn.NUM_TREES)
+    parser.add_argument("--max-depth", type=int, default=trainer_gbt_fn.MAX_DEPTH)
+    args = parser.parse_args()
+
+    run_benchmark(num_examples=args.num_examples,
+                  fraud_rate=args.fraud_rate,
+                  batch_size=args.batch_size,
+                  epochs=args.epochs,
+                  iterations=args.iterations,
+                  num_trees=args.num_trees,
+                  max_depth=args.max_depth)
@@ -0,0 +1,88 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Compares the per-column and the fused Transform analyzers.
+
+Runs preprocessing_fn with both modes over the same synthetic data with
+tft_beam, checks that the transformed values are the same and reports the
+wall time of each mode.
+
+    python -m benchmarks.transform_analyzers_benchmark --num-examples=100000
+"""
+
+import argparse
+import functools
+import json
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+import tensorflow_transform.beam as tft_beam
+from tensorflow_transform.tf_metadata import dataset_metadata, schema_utils
+
+from my_vertex_pipelines import feature_engineering_fn
+
+NUMERIC_KEYS = ["Time"] + [f"V{i}" for i in range(1, 29)] + ["Amount"]
+
+
+def _make_raw_data(num_examples: int):
+    rng = np.random.default_rng(0)
+    values = rng.normal(size=(num_examples, len(NUMERIC_KEYS))).astype(np.float32)
+    labels = (rng.random(num_examples) < 0.002).astype(np.int64)
+    raw_data = [{**{k: values[n, i] for i, k in enumerate(NUMERIC_KEYS)}, 'Class': labels[n]}
+                for n in range(num_examples)]
+
+    feature_spec = {k: tf.io.FixedLenFeature([], tf.float32) for k in NUMERIC_KEYS}
+    feature_spec['Class'] = tf.io.FixedLenFeature([], tf.int64)
+    raw_metadata = dataset_metadata.DatasetMetadata(schema_utils.schema_from_feature_spec(feature_spec))
+
+    return raw_data, raw_metadata
+
+
+def _analyze_and_transform(raw_data, raw_metadata, fused_analyzers: bool):
+    preprocessing_fn = functools.partial(feature_engineering_fn.preprocessing_fn,
+                                         custom_config={'fused_analyzers': fused_analyzers})
+    start = time.perf_counter()
+    with tft_beam.Context(temp_dir=tempfile.mkdtemp()):
+        (transformed_data, _), _ = ((raw_data, raw_metadata)
+                                    | tft_beam.AnalyzeAndTransformDataset(preprocessing_fn))
+    return transformed_data, time.perf_counter() - start
+
+
+def run_benchmark(num_examples: int):
+    raw_data, raw_metadata = _make_raw_data(num_examples)
+
+    per_column, per_column_secs = _analyze_and_transform(raw_data, raw_metadata, fused_analyzers=False)
+    fused, fused_secs = _analyze_and_transform(raw_data, raw_metadata, fused_analyzers=True)
+
+    # Parity: both modes must produce the same columns with the same values
+    for key in per_column[0].keys():
+        expected = np.array([row[key] for row in per_column])
+        actual = np.array([row[key] for row in fused])
+        np.testing.assert_allclose(actual, expected, rtol=1e-6, atol=1e-6, err_msg=key)
+
+    results = {'num_examples': num_examples,
+               'per_column_secs': per_column_secs,
+               'fused_secs': fused_secs,
+               'outputs_match': True}
+    print(json.dumps(results, indent=2))
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-examples", type=int, default=100000)
+    args = parser.parse_args()
+
+    run_benchmark(num_examples=args.num_examples)
@@ -0,0 +1,125 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Component of the batch scoring mode, which scores bulk transactions with the latest blessed model.
+
+BatchScore reads the examples of the scoring split, groups them in batches and
+calls the raw tensor signature of the model once per batch, in every Beam
+worker. It writes every input row with its score as Parquet files. The columns
+are the raw features of the model (its feature_keys signature), and the other
+columns of the raw feature spec of the latest Transform graph, which may be from
+a later run than the model. Missing and NULL values are written as nulls, but
+the features of the model can't be missing.
+"""
+
+import os
+from typing import Any, Dict, Iterable, List
+
+import apache_beam as beam
+import numpy as np
+import pyarrow as pa
+import tensorflow as tf
+import tensorflow_transform as tft
+import tfx.v1 as tfx
+from tfx.types import artifact_utils
+from tfx.utils import path_utils
+
+from my_vertex_pipelines import serving_utils
+
+SCORING_SPLIT = 'score'
+SCORE_COLUMN = 'score'
+
+
+_PARQUET_TYPES = {tf.int64: pa.int64(), tf.float32: pa.float32(), tf.string: pa.binary()}
+
+
+def _get_example_files(examples: tfx.types.standard_artifacts.Examples) -> List[str]:
+    split_uri = artifact_utils.get_split_uri([examples], SCORING_SPLIT)
+    return sorted(tf.io.gfile.glob(os.path.join(split_uri, '*')))
+
+
+def _get_schema(raw_feature_spec: Dict[str, Any], model_feature_keys: List[str]) -> pa.Schema:
+    """Returns the Parquet schema of the output: the raw features and the model features, nullable, and the score."""
+    # The raw tensor signature of the model takes float32 features
+    types = {**{k: pa.float32() for k in model_feature_keys},
+             **{name: _PARQUET_TYPES[spec.dtype] for name, spec in raw_feature_spec.items()}}
+    fields = [pa.field(name, types[name]) for name in sorted(types)]
+    return pa.schema(fields + [pa.field(SCORE_COLUMN, pa.float32())])
+
+
+def _to_row(record: bytes, feature_names: List[str]) -> Dict[str, Any]:
+    """Returns the first value of every feature of the schema, None if the feature is missing, empty or NULL."""
+    features = tf.train.Example.FromString(record).features.feature
+    row = {}
+    for name in feature_names:
+        kind = features[name].WhichOneof('kind') if name in features else None
+        values = getattr(features[name], kind).value if kind else []
+        row[name] = values[0] if values else None
+    return row
+
+
+class ScoreBatch(beam.DoFn):
+    """Loads the model once per worker and scores a batch of rows with a single call of the model."""
+
+    def __init__(self, model_dir: str):
+        self._model_dir = model_dir
+        self._model = None
+        self._predict_fn = None
+        self._raw_feature_keys = None
+
+    def setup(self):
+        # Keep a reference to the model, the signature does not own the variables
+        self._model = serving_utils.load_model(self._model_dir)
+        self._raw_feature_keys = serving_utils.get_raw_feature_keys(self._model)
+        self._predict_fn = self._model.signatures[serving_utils.RAW_TENSOR_SIGNATURE]
+
+    def process(self, rows: List[Dict[str, Any]]) -> Iterable[Dict[str, Any]]:
+        # The model has no default for a missing feature, like Transform in training
+        for row in rows:
+            missing = [k for k in self._raw_feature_keys if row.get(k) is None]
+            if missing:
+                raise ValueError(f"Can't score a row with missing features {missing}: {row}")
+        features = np.array([[row[k] for k in self._raw_feature_keys] for row in rows], dtype=np.float32)
+        outputs = self._predict_fn(features=tf.constant(features))
+        scores = next(iter(outputs.values())).numpy().reshape(-1)
+        for row, score in zip(rows, scores):
+            yield {**row, SCORE_COLUMN: float(score)}
+
+
+@tfx.dsl.components.component(use_beam=True)
+def BatchScore(examples: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.Examples],
+               model: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.Model],
+               transform_graph: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.TransformGraph],
+               scores: tfx.dsl.components.OutputArtifact[tfx.types.standard_artifacts.InferenceResult],
+               batch_size: tfx.dsl.components.Parameter[int] = 1024,
+               output_num_shards: tfx.dsl.components.Parameter[int] = 0,
+               beam_pipeline: tfx.dsl.components.BeamComponentParameter[beam.Pipeline] = None):
+    example_files = _get_example_files(examples)
+    if not example_files:
+        raise ValueError(f"No examples to score in {examples.uri}")
+    model_dir = path_utils.serving_model_path(model.uri)
+    model_feature_keys = serving_utils.get_raw_feature_keys(serving_utils.load_model(model_dir))
+    raw_feature_spec = tft.TFTransformOutput(transform_graph.uri).raw_feature_spec()
+    schema = _get_schema(raw_feature_spec, model_feature_keys)
+
+    input_pattern = os.path.join(artifact_utils.get_split_uri([examples], SCORING_SPLIT), '*')
+    with beam_pipeline as p:
+        _ = (p
+             | 'ReadExamples' >> beam.io.ReadFromTFRecord(input_pattern)
+             | 'ToRows' >> beam.Map(_to_row, [name for name in schema.names if name != SCORE_COLUMN])
+             | 'Batch' >> beam.BatchElements(min_batch_size=batch_size, max_batch_size=batch_size)
+             | 'Score' >> beam.ParDo(ScoreBatch(model_dir))
+             | 'WriteScores' >> beam.io.WriteToParquet(os.path.join(scores.uri, 'scores'),
+                                                       schema,
+                                                       file_name_suffix='.parquet',
+                                                       num_shards=output_num_shards))
@@ -0,0 +1,178 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Deterministic samples of the input data, for fast development runs.
+
+All the fraud rows are kept, and the other rows are kept if the hash of the row
+falls in the first sample_fraction of the hash buckets. With max_rows, only the
+fraud rows and then the rows with the lowest hashes are kept, up to max_rows.
+The same data and arguments always give the same sample.
+
+The BigQuery query is wrapped with the sampling, using FARM_FINGERPRINT of the row.
+Local files are sampled into a copy with the same relative paths, reused while the
+files don't change. The hashes of both sources differ, so are their samples.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import tensorflow as tf
+
+LABEL_KEY = 'Class'
+HASH_BUCKETS = 1000000
+
+
+def get_sampled_query(query: str, sample_fraction: Optional[float] = None, max_rows: Optional[int] = None) -> str:
+    """Returns the query with the rows of the deterministic sample only."""
+    row_hash = "FARM_FINGERPRINT(TO_JSON_STRING(t))"
+    sampled_query = f"SELECT t.* FROM ({query}) AS t"
+    if sample_fraction is not None and sample_fraction < 1:
+        sampled_query += (f" WHERE t.{LABEL_KEY} = 1 "
+                          f"OR ABS(MOD({row_hash}, {HASH_BUCKETS})) < {int(sample_fraction * HASH_BUCKETS)}")
+    if max_rows:
+        sampled_query += f" ORDER BY t.{LABEL_KEY} DESC, {row_hash} LIMIT {max_rows}"
+    return sampled_query
+
+
+def _hash_columns(columns: List[np.ndarray]) -> np.ndarray:
+    # Combines the bits of the values of each row, vectorized; strings are hashed with crc32
+    hashes = np.zeros(len(columns[0]) if columns else 0, dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for column in columns:
+            if column.dtype.kind in 'biuf':
+                values = column.astype(np.float64).view(np.uint64)
+            else:
+                values = np.array([zlib.crc32(str(v).encode()) for v in column], dtype=np.uint64)
+            hashes = (hashes ^ values) * np.uint64(0x9E3779B97F4A7C15)
+            hashes ^= hashes >> np.uint64(31)
+    return hashes
+
+
+def _read_rows(path: str, data_format: str):
+    """Returns the rows of a file (a pyarrow table, or the TFRecord records), their labels and their hashes."""
+    if data_format == 'tfrecord':
+        compression = 'GZIP' if path.endswith('.gz') else ''
+        records = [r.numpy() for r in tf.data.TFRecordDataset(path, compression_type=compression)]
+        labels = np.array([tf.train.Example.FromString(r).features.feature[LABEL_KEY].int64_list.value[0]
+                           for r in records], dtype=np.int64)
+        hashes = np.array([int.from_bytes(hashlib.md5(r).digest()[:8], 'big') for r in records], dtype=np.uint64)
+        return records, labels, hashes
+
+    with tf.io.gfile.GFile(path, 'rb') as f:
+        table = pq.read_table(f) if data_format == 'parquet' else pa_csv.read_csv(f)
+    columns = [table.column(name).to_numpy(zero_copy_only=False) for name in table.column_names]
+    return table, table.column(LABEL_KEY).to_numpy(zero_copy_only=False), _hash_columns(columns)
+
+
+def _write_rows(rows, mask: np.ndarray, path: str, data_format: str):
+    tf.io.gfile.makedirs(os.path.dirname(path))
+    if data_format == 'tfrecord':
+        options = tf.io.TFRecordOptions(compression_type='GZIP' if path.endswith('.gz') else '')
+        with tf.io.TFRecordWriter(path, options) as writer:
+            for record in np.array(rows, dtype=object)[mask]:
+                writer.write(record)
+        return
+
+    sampled = rows.filter(mask)
+    with tf.io.gfile.GFile(path, 'wb') as f:
+        if data_format == 'parquet':
+            pq.write_table(sampled, f)
+        else:
+            pa_csv.write_csv(sampled, f)
+
+
+def _get_keep_mask(labels: np.ndarray, hashes: np.ndarray, sample_fraction: Optional[float],
+                   cutoff: Optional[Tuple[int, int]] = None) -> np.ndarray:
+    fraud = labels == 1
+    keep = fraud.copy()
+    if sample_fraction is not None and sample_fraction < 1:
+        keep |= (hashes % np.uint64(HASH_BUCKETS)) < int(sample_fraction * HASH_BUCKETS)
+    else:
+        keep[:] = True
+    if cutoff is not None:
+        # Same order as the BigQuery query: fraud rows first, then by hash
+        rank, cutoff_hash = cutoff
+        row_rank = np.where(fraud, 0, 1)
+        keep &= (row_rank < rank) | ((row_rank == rank) & (hashes <= np.uint64(cutoff_hash)))
+    return keep
+
+
+def _get_cutoff(keys: Dict[str, Tuple[np.ndarray, np.ndarray]], sample_fraction: Optional[float],
+                max_rows: int) -> Optional[Tuple[int, int]]:
+    """Returns the (rank, hash) of the last row kept with max_rows, None if the sample is already smaller."""
+    ranks, hashes = [], []
+    for labels, row_hashes in keys.values():
+        keep = _get_keep_mask(labels, row_hashes, sample_fraction)
+        ranks.append(np.where(labels[keep] == 1, 0, 1))
+        hashes.append(row_hashes[keep])
+    ranks, hashes = np.concatenate(ranks), np.concatenate(hashes)
+    if len(ranks) <= max_rows:
+        return None
+    order = np.lexsort((hashes, ranks))
+    last = order[max_rows - 1]
+    return int(ranks[last]), int(hashes[last])
+
+
+def _get_files(data_path: str) -> List[str]:
+    return sorted(os.path.join(dir_name, f) for dir_name, _, files in tf.io.gfile.walk(data_path) for f in files)
+
+
+def get_sample_dir(data_path: str, data_format: str, sample_fraction: Optional[float], max_rows: Optional[int],
+                   base_dir: str) -> str:
+    """Returns the directory of the sample, named after the arguments and the paths and sizes of the files."""
+    files = [(os.path.relpath(f, data_path), tf.io.gfile.stat(f).length, tf.io.gfile.stat(f).mtime_nsec)
+             for f in _get_files(data_path)]
+    key_source = json.dumps([files, data_format, sample_fraction, max_rows])
+    name = f"{os.path.basename(data_path.rstrip('/'))}-{hashlib.sha256(key_source.encode()).hexdigest()[:16]}"
+    return os.path.join(base_dir, name)
+
+
+def sample_local_data(data_path: str, data_format: str, sample_fraction: Optional[float],
+                      max_rows: Optional[int], base_dir: str) -> str:
+    """Writes the sample of the files in data_path, if not written yet, and returns its directory."""
+    sample_dir = get_sample_dir(data_path, data_format, sample_fraction, max_rows, base_dir)
+    # Written last, next to the sample and not in it, so ExampleGen does not read it
+    summary_file = sample_dir.rstrip('/') + '.json'
+    if tf.io.gfile.exists(summary_file):
+        logging.info(f"Reusing the sample of {data_path} in {sample_dir}")
+        return sample_dir
+    if tf.io.gfile.exists(sample_dir):
+        tf.io.gfile.rmtree(sample_dir)
+
+    files = _get_files(data_path)
+    cutoff = None
+    if max_rows:
+        keys = {f: _read_rows(f, data_format)[1:] for f in files}
+        cutoff = _get_cutoff(keys, sample_fraction, max_rows)
+
+    num_rows, num_sampled = 0, 0
+    for f in files:
+        rows, labels, hashes = _read_rows(f, data_format)
+        mask = _get_keep_mask(labels, hashes, sample_fraction, cutoff)
+        _write_rows(rows, mask, os.path.join(sample_dir, os.path.relpath(f, data_path)), data_format)
+        num_rows += len(mask)
+        num_sampled += int(mask.sum())
+
+    summary = {'data_path': data_path, 'sample_fraction': sample_fraction, 'max_rows': max_rows,
+               'num_rows': num_rows, 'num_sampled_rows': num_sampled}
+    with tf.io.gfile.GFile(summary_file, 'w') as f:
+        json.dump(summary, f, indent=2)
+    logging.info(f"Sampled {num_sampled} of {num_rows} rows of {data_path} in {sample_dir}")
+    return sample_dir
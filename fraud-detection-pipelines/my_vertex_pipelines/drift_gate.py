@@ -0,0 +1,110 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Components that skip the training branch of the pipeline when the data has not changed materially.
+
+DriftGate compares the statistics of the new data with the baseline statistics,
+those of the data of the last run that produced a blessed model, and decides if
+the model should be trained again. RecordBaseline runs after a model is blessed
+and records the statistics of its data as the new baseline. The baselines have
+an artifact type of their own, so the resolver finds the last one whichever
+evaluation (full or sampled) blessed the model.
+"""
+
+import copy
+from typing import List, Tuple
+
+import tensorflow_data_validation as tfdv
+import tfx.v1 as tfx
+from tfx.components.statistics_gen import stats_artifact_utils
+from tfx.utils import io_utils
+
+from tensorflow_metadata.proto.v0 import schema_pb2
+from tensorflow_metadata.proto.v0 import statistics_pb2
+
+# Statistics of the split compared with the baseline
+STATS_SPLIT = 'train'
+RECORD_BASELINE_ID = 'record_baseline'
+
+
+class BaselineStatistics(tfx.types.standard_artifacts.ExampleStatistics):
+    """Statistics of the data of the last blessed model, written by RecordBaseline."""
+    TYPE_NAME = 'BaselineStatistics'
+
+
+def _load_statistics(statistics: tfx.types.standard_artifacts.ExampleStatistics
+                     ) -> statistics_pb2.DatasetFeatureStatisticsList:
+    return stats_artifact_utils.load_statistics(statistics, STATS_SPLIT).proto()
+
+
+def get_drift_anomalies(statistics: statistics_pb2.DatasetFeatureStatisticsList,
+                        baseline: statistics_pb2.DatasetFeatureStatisticsList,
+                        schema: schema_pb2.Schema,
+                        drift_threshold: float,
+                        num_examples_threshold: float) -> List[str]:
+    """Returns the descriptions of the differences between the statistics and the baseline above the thresholds.
+
+    The distribution of every feature is compared with the Jensen-Shannon divergence (numeric
+    features) or the L-infinity distance (categorical features), and the number of examples
+    with its relative change.
+    """
+    schema = copy.deepcopy(schema)
+    for feature in schema.feature:
+        if feature.type == schema_pb2.BYTES:
+            feature.drift_comparator.infinity_norm.threshold = drift_threshold
+        else:
+            feature.drift_comparator.jensen_shannon_divergence.threshold = drift_threshold
+    num_examples_comparator = schema.dataset_constraints.num_examples_drift_comparator
+    num_examples_comparator.min_fraction_threshold = 1 - num_examples_threshold
+    num_examples_comparator.max_fraction_threshold = 1 + num_examples_threshold
+
+    anomalies = tfdv.validate_statistics(statistics, schema, previous_statistics=baseline)
+    descriptions = [f"{name}: {info.short_description}" for name, info in sorted(anomalies.anomaly_info.items())]
+    descriptions += [f"dataset: {reason.short_description}" for reason in anomalies.dataset_anomaly_info.reason]
+    return descriptions
+
+
+def _should_train(statistics, schema, baseline_statistics, drift_threshold, num_examples_threshold
+                  ) -> Tuple[bool, str]:
+    if baseline_statistics is None:
+        return True, "No baseline statistics, there is no blessed model yet"
+
+    schema_proto = io_utils.SchemaReader().read(io_utils.get_only_uri_in_dir(schema.uri))
+    anomalies = get_drift_anomalies(_load_statistics(statistics),
+                                    _load_statistics(baseline_statistics),
+                                    schema_proto,
+                                    drift_threshold=drift_threshold,
+                                    num_examples_threshold=num_examples_threshold)
+    if anomalies:
+        return True, "Data changed since the last blessed model: " + "; ".join(anomalies)
+    return False, "No feature drift or change in the number of examples above the thresholds"
+
+
+@tfx.dsl.components.component
+def DriftGate(statistics: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.ExampleStatistics],
+              schema: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.Schema],
+              baseline_statistics: tfx.dsl.components.InputArtifact[BaselineStatistics] = None,
+              drift_threshold: tfx.dsl.components.Parameter[float] = 0.1,
+              num_examples_threshold: tfx.dsl.components.Parameter[float] = 0.2
+              ) -> tfx.dsl.components.OutputDict(should_train=int, reason=str):
+    # Both outputs are recorded in the metadata of the run
+    should_train, reason = _should_train(statistics, schema, baseline_statistics,
+                                         drift_threshold, num_examples_threshold)
+    return {'should_train': int(should_train), 'reason': reason}
+
+
+@tfx.dsl.components.component
+def RecordBaseline(statistics: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.ExampleStatistics],
+                   baseline_statistics: tfx.dsl.components.OutputArtifact[BaselineStatistics]):
+    io_utils.copy_dir(statistics.uri, baseline_statistics.uri)
+    baseline_statistics.split_names = statistics.split_names
@@ -11,20 +11,59 @@
 #  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
-from typing import Dict
+from typing import Any, Dict, List, Optional
 
 import tensorflow_transform as tft
 import tensorflow as tf
 
+LABEL_KEY = 'Class'
+# Name of the single dense float vector emitted when packed_features is enabled
+PACKED_FEATURES_KEY = 'features'
+# Prefix of the velocity features columns, must match velocity_features.FEATURE_PREFIX
+VELOCITY_FEATURES_PREFIX = 'velocity_'
 
-def preprocessing_fn(inputs: Dict[str, tf.Tensor]) -> Dict[str, tf.Tensor]:
-    # Let's normalize all the columns that start with V
-    output_dict = {
-        'Amount': tft.scale_to_0_1(inputs['Amount']),
-        'Class': inputs['Class']
-    }
-    for col in inputs.keys():
-        if col.startswith("V"):
-            output_dict[col] = tft.scale_to_0_1(inputs[col])
+
+def get_packed_feature_keys(keys, velocity_features: bool = False) -> List[str]:
+    # The order of the columns in the packed vector is part of the model contract,
+    # so it must not depend on the order of the dict keys: V1..V28 first, then Amount,
+    # then the velocity features sorted by name.
+    # trainer_fn.get_packed_feature_keys must return exactly the same order.
+    v_keys = sorted([k for k in keys if k.startswith("V")], key=lambda k: int(k[1:]))
+    velocity_keys = sorted([k for k in keys if k.startswith(VELOCITY_FEATURES_PREFIX)]) if velocity_features else []
+    return v_keys + ['Amount'] + velocity_keys
+
+
+def _scale_to_0_1_fused(inputs: Dict[str, tf.Tensor], feature_keys: List[str]) -> tf.Tensor:
+    # Stack the columns and compute all the per-column min/max in a single elementwise
+    # analyzer, instead of one min/max analyzer per column. Output values are the same.
+    stacked = tf.stack([tf.reshape(inputs[k], [-1]) for k in feature_keys], axis=1)
+    return tft.scale_to_0_1(stacked, elementwise=True)
+
+
+def preprocessing_fn(inputs: Dict[str, tf.Tensor],
+                     custom_config: Optional[Dict[str, Any]] = None) -> Dict[str, tf.Tensor]:
+    custom_config = custom_config or {}
+    packed_features = custom_config.get('packed_features', False)
+    # The velocity features are computed before ExampleGen, see velocity_features.add_velocity_features
+    velocity_features = custom_config.get('velocity_features', False)
+    feature_keys = get_packed_feature_keys(inputs.keys(), velocity_features)
+    if velocity_features and len(feature_keys) == len(get_packed_feature_keys(inputs.keys())):
+        raise ValueError(f"velocity_features is set, but the data has no {VELOCITY_FEATURES_PREFIX}* columns")
+
+    if custom_config.get('fused_analyzers', False):
+        packed = _scale_to_0_1_fused(inputs, feature_keys)
+        if packed_features:
+            return {PACKED_FEATURES_KEY: packed, LABEL_KEY: inputs[LABEL_KEY]}
+        scaled = {k: tf.reshape(packed[:, i], tf.shape(inputs[k])) for i, k in enumerate(feature_keys)}
+    else:
+        # Let's normalize all the columns that start with V
+        scaled = {k: tft.scale_to_0_1(inputs[k]) for k in feature_keys}
+        if packed_features:
+            # One [batch, n_features] tensor instead of one [batch] tensor per column
+            packed = tf.stack([tf.reshape(scaled[k], [-1]) for k in feature_keys], axis=1)
+            return {PACKED_FEATURES_KEY: packed, LABEL_KEY: inputs[LABEL_KEY]}
+
+    output_dict = dict(scaled)
+    output_dict[LABEL_KEY] = inputs[LABEL_KEY]
 
     return output_dict
@@ -13,16 +13,21 @@
 #  limitations under the License.
 
 import argparse
+import inspect
 import logging
 import os.path
+import posixpath
+from typing import Any, Dict, List, Optional, Tuple
 
 from datetime import datetime
 
-import tfx.v1 as tfx
-
-from my_vertex_pipelines import fraud_detection_pipeline
+# Only light modules at the top, TFX and the Vertex SDK are imported by the code paths that need them
+from my_vertex_pipelines import pipeline_spec_cache
 from my_vertex_pipelines import vertex_configs
-from my_vertex_pipelines import vertex_run
+
+
+def get_experiment_name(pipeline_name: str) -> str:
+    return f"{pipeline_name}-experiment"
 
 
 def main(running_locally: bool,
@@ -37,63 +42,311 @@ def main(running_locally: bool,
          dataflow_network: str,
          transform_fn_file: str,
          trainer_fn_file: str,
-         temp_location: str):
-    pipeline_definition = os.path.join("/tmp", pipeline_name + "_pipeline.json")
-    runner = tfx.orchestration.experimental.KubeflowV2DagRunner(
-        config=tfx.orchestration.experimental.KubeflowV2DagRunnerConfig(),
-        output_filename=pipeline_definition)
+         temp_location: str,
+         packed_features: bool,
+         fused_analyzers: bool,
+         input_config: Dict[str, Any],
+         local_profile: str = 'single',
+         direct_num_workers: Optional[int] = None,
+         direct_running_mode: Optional[str] = None,
+         stats_batch_size: Optional[int] = None,
+         data_path: Optional[str] = None,
+         data_format: str = 'csv',
+         split_ratio: Tuple[int, int] = (2, 1),
+         output_num_shards: Optional[int] = None,
+         output_compression: bool = True,
+         example_format: str = 'tfrecord',
+         sample_fraction: Optional[float] = None,
+         max_rows: Optional[int] = None,
+         collect_metrics: bool = False,
+         profile_steps: Optional[str] = None,
+         distribution_strategy: str = 'none',
+         cpu_replicas: Optional[int] = None,
+         trainer_machine_type: str = vertex_configs.TRAINER_MACHINE_TYPE,
+         trainer_worker_count: int = 0,
+         trainer_worker_machine_type: Optional[str] = None,
+         tuner_parallel_trials: int = 0,
+         tuner_max_epochs: int = vertex_configs.TUNER_MAX_EPOCHS,
+         epochs: float = vertex_configs.TRAIN_EPOCHS,
+         warm_start: bool = False,
+         warm_start_epochs: float = vertex_configs.WARM_START_EPOCHS,
+         incremental: bool = False,
+         span_column: Optional[str] = None,
+         span: Optional[int] = None,
+         span_window: int = vertex_configs.SPAN_WINDOW,
+         skip_unchanged_data: bool = False,
+         drift_threshold: float = vertex_configs.DRIFT_THRESHOLD,
+         num_examples_threshold: float = vertex_configs.NUM_EXAMPLES_THRESHOLD,
+         pipeline_image: Optional[str] = None,
+         eval_sample_rate: Optional[float] = None,
+         eval_margin: float = vertex_configs.EVAL_MARGIN,
+         eval_num_workers: Optional[int] = None,
+         batch_score: bool = False,
+         score_batch_size: int = vertex_configs.SCORE_BATCH_SIZE,
+         score_num_workers: Optional[int] = None,
+         velocity_features: bool = False,
+         jit_compile: bool = False,
+         steps_per_execution: int = 1,
+         mixed_precision: str = 'none',
+         export_variants: Optional[List[str]] = None,
+         variant_tolerance: float = vertex_configs.VARIANT_TOLERANCE,
+         pruning_sparsity: float = vertex_configs.PRUNING_SPARSITY,
+         pruning_epochs: float = vertex_configs.PRUNING_EPOCHS,
+         gbt_num_trees: int = vertex_configs.GBT_NUM_TREES,
+         gbt_max_depth: int = vertex_configs.GBT_MAX_DEPTH,
+         compile_cache: bool = True,
+         compile_cache_dir: str = vertex_configs.PIPELINE_SPEC_CACHE_DIR,
+         job_id: Optional[str] = None,
+         submit: bool = True) -> Optional[str]:
+    """Runs the pipeline locally, or compiles it and submits it to Vertex.
 
-    if running_locally:
-        metadata_connection = tfx.orchestration.metadata.sqlite_metadata_connection_config(vertex_configs.METADATA_PATH)
-        beam_args = vertex_configs.get_beam_args_for_local(project=project_id,
-                                                           region=region,
-                                                           temp_location_gcs=temp_location)
-    else:
-        metadata_connection = None
-        if use_dataflow:
-            beam_args = vertex_configs.get_beam_args_for_dataflow(project=project_id,
-                                                                  region=region,
-                                                                  temp_location_gcs=temp_location,
-                                                                  service_account_dataflow=service_account_dataflow,
-                                                                  dataflow_network=dataflow_network)
+    Returns the path of the compiled Vertex pipeline definition, which is not submitted if
+    submit is False (see sweep_launcher).
+    """
+    # The id of the job is the only argument that must not change the compiled definition
+    arguments = {k: v for k, v in locals().items() if k not in ('job_id', 'submit')}
+
+    # Use a custom job id to register params and metrics in the same experiment run id
+    this_moment: str = datetime.now().strftime("%Y%m%d%H%M%S")
+    job_id = job_id or f"{pipeline_name}-{this_moment}"
+    experiment_name = get_experiment_name(pipeline_name)
+
+    if sample_fraction is not None or max_rows:
+        # Development runs with a deterministic sample, all the fraud rows and a fraction of the others
+        from my_vertex_pipelines import data_sampling
+        if data_path:
+            # In Vertex the components can't read the local disk, the sample is written next to the pipeline root
+            sample_base_dir = (vertex_configs.SAMPLED_DATA_DIR if running_locally
+                               else posixpath.join(pipeline_root, vertex_configs.SAMPLED_DATA_SUBDIR))
+            data_path = data_sampling.sample_local_data(data_path, data_format, sample_fraction, max_rows,
+                                                        base_dir=sample_base_dir)
         else:
+            query = data_sampling.get_sampled_query(query, sample_fraction, max_rows)
+        # The compiled definition depends on the sample, e.g. a new sample directory when the files change
+        arguments.update(data_path=data_path, query=query)
+
+    def build_pipeline(experiment_run_name: str):
+        # Imported here, the CLI only pays for TFX, TFMA and TF when it builds a pipeline
+        import tfx.v1 as tfx
+        from my_vertex_pipelines import fraud_detection_pipeline
+
+        # In Vertex the DirectRunner runs in the component container, so the CPU count is resolved there
+        execution_profile = vertex_configs.get_local_execution_profile(profile=local_profile,
+                                                                       num_workers=direct_num_workers,
+                                                                       running_mode=direct_running_mode,
+                                                                       stats_batch_size=stats_batch_size,
+                                                                       resolve_cpu_count=running_locally)
+
+        # With Dataflow in Vertex, StatisticsGen keeps its default batch size
+        profile_stats_batch_size = (None if use_dataflow and not running_locally
+                                    else execution_profile['stats_batch_size'])
+        if running_locally:
+            metadata_connection = tfx.orchestration.metadata.sqlite_metadata_connection_config(
+                vertex_configs.METADATA_PATH)
             beam_args = vertex_configs.get_beam_args_for_local(project=project_id,
                                                                region=region,
-                                                               temp_location_gcs=temp_location)
+                                                               temp_location_gcs=temp_location,
+                                                               execution_profile=execution_profile)
+        else:
+            metadata_connection = None
+            if use_dataflow:
+                beam_args = vertex_configs.get_beam_args_for_dataflow(project=project_id,
+                                                                      region=region,
+                                                                      temp_location_gcs=temp_location,
+                                                                      service_account_dataflow=service_account_dataflow,
+                                                                      dataflow_network=dataflow_network)
+            else:
+                beam_args = vertex_configs.get_beam_args_for_local(project=project_id,
+                                                                   region=region,
+                                                                   temp_location_gcs=temp_location,
+                                                                   execution_profile=execution_profile)
 
-    # Use a custom job id to register params and metrics in the same experiment run id
-    this_moment: str = datetime.now().strftime("%Y%m%d%H%M%S")
-    job_id = f"{pipeline_name}-{this_moment}"
-    experiment_name = f"{pipeline_name}-experiment"
-
-    pipeline: tfx.dsl.Pipeline = fraud_detection_pipeline.create_pipeline(
-        pipeline_name=pipeline_name,
-        experiment_name=experiment_name,
-        experiment_run_name=job_id,
-        pipeline_root=pipeline_root,
-        query=query,
-        beam_pipeline_args=beam_args,
-        transform_fn_file=transform_fn_file,
-        region=region,
-        trainer_fn_file=trainer_fn_file,
-        project_id=project_id,
-        service_account=service_account,
-        local_connection_config=metadata_connection)
-
-    runner.run(pipeline)  # Creates pipeline definition
+        if batch_score:
+            return fraud_detection_pipeline.create_batch_scoring_pipeline(
+                pipeline_name=pipeline_name,
+                pipeline_root=pipeline_root,
+                query=query,
+                beam_pipeline_args=beam_args,
+                local_connection_config=metadata_connection,
+                data_path=data_path,
+                data_format=data_format,
+                output_num_shards=output_num_shards,
+                output_compression=output_compression,
+                score_batch_size=score_batch_size,
+                score_num_workers=score_num_workers)
+        else:
+            return fraud_detection_pipeline.create_pipeline(
+                pipeline_name=pipeline_name,
+                experiment_name=experiment_name,
+                experiment_run_name=experiment_run_name,
+                pipeline_root=pipeline_root,
+                query=query,
+                beam_pipeline_args=beam_args,
+                transform_fn_file=transform_fn_file,
+                region=region,
+                trainer_fn_file=trainer_fn_file,
+                project_id=project_id,
+                service_account=service_account,
+                local_connection_config=metadata_connection,
+                packed_features=packed_features,
+                fused_analyzers=fused_analyzers,
+                input_config=input_config,
+                stats_batch_size=profile_stats_batch_size,
+                data_path=data_path,
+                data_format=data_format,
+                split_ratio=split_ratio,
+                output_num_shards=output_num_shards,
+                output_compression=output_compression,
+                example_format=example_format,
+                profile_steps=profile_steps,
+                distribution_strategy=distribution_strategy,
+                cpu_replicas=cpu_replicas,
+                trainer_machine_type=trainer_machine_type,
+                trainer_worker_count=trainer_worker_count,
+                trainer_worker_machine_type=trainer_worker_machine_type,
+                tuner_parallel_trials=tuner_parallel_trials,
+                tuner_max_epochs=tuner_max_epochs,
+                epochs=epochs,
+                warm_start=warm_start,
+                warm_start_epochs=warm_start_epochs,
+                incremental=incremental,
+                span_column=span_column,
+                span=span,
+                span_window=span_window,
+                skip_unchanged_data=skip_unchanged_data,
+                drift_threshold=drift_threshold,
+                num_examples_threshold=num_examples_threshold,
+                eval_sample_rate=eval_sample_rate,
+                eval_margin=eval_margin,
+                eval_num_workers=eval_num_workers,
+                velocity_features=velocity_features,
+                jit_compile=jit_compile,
+                steps_per_execution=steps_per_execution,
+                mixed_precision=mixed_precision,
+                export_variants=export_variants,
+                variant_tolerance=variant_tolerance,
+                pruning_sparsity=pruning_sparsity,
+                pruning_epochs=pruning_epochs,
+                gbt_num_trees=gbt_num_trees,
+                gbt_max_depth=gbt_max_depth)
 
     logging.getLogger().setLevel(logging.INFO)
 
     if running_locally:
-        vertex_run.run_locally(pipeline)
-    else:
-        vertex_run.run_in_vertex(project_id=project_id,
-                                 region=region,
-                                 pipeline_definition=pipeline_definition,
-                                 pipeline_name=pipeline_name,
-                                 experiment_name=experiment_name,
-                                 job_id=job_id,
-                                 service_account=service_account)
+        # The LocalDagRunner runs the pipeline object, there is no need to compile it
+        from my_vertex_pipelines import vertex_run
+        vertex_run.run_locally(build_pipeline(experiment_run_name=job_id), collect_metrics=collect_metrics)
+        return None
+
+    pipeline_definition = os.path.join("/tmp", job_id + "_pipeline.json")
+    cache_key = pipeline_spec_cache.get_cache_key(arguments, [transform_fn_file, trainer_fn_file])
+    definition = pipeline_spec_cache.load(compile_cache_dir, cache_key, job_id) if compile_cache else None
+    if definition is None:
+        import tfx.v1 as tfx
+
+        # Compiled with a placeholder job id, so the definition can be reused by the next runs
+        runner = tfx.orchestration.experimental.KubeflowV2DagRunner(
+            config=tfx.orchestration.experimental.KubeflowV2DagRunnerConfig(default_image=pipeline_image),
+            output_filename=pipeline_definition)
+        runner.run(build_pipeline(experiment_run_name=pipeline_spec_cache.JOB_ID_PLACEHOLDER))
+        with open(pipeline_definition) as f:
+            definition = f.read()
+        if compile_cache:
+            pipeline_spec_cache.save(compile_cache_dir, cache_key, definition)
+        definition = definition.replace(pipeline_spec_cache.JOB_ID_PLACEHOLDER, job_id)
+    with open(pipeline_definition, 'w') as f:
+        f.write(definition)
+    if not submit:
+        return pipeline_definition
+
+    from my_vertex_pipelines import vertex_run
+    vertex_run.run_in_vertex(project_id=project_id,
+                             region=region,
+                             pipeline_definition=pipeline_definition,
+                             pipeline_name=pipeline_name,
+                             experiment_name=experiment_name,
+                             job_id=job_id,
+                             service_account=service_account,
+                             collect_metrics=collect_metrics,
+                             pipeline_root=pipeline_root)
+    return pipeline_definition
+
+
+def resolve_arguments(arguments: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns all the arguments of main, with the defaults and the values derived from the given ones.
+
+    Checks the combinations that the pipeline doesn't support, raising a ValueError, for the CLI and the
+    sweeps (see sweep_launcher). split_ratio can also be given as "train:eval", and trainer_engine (not an
+    argument of main) chooses the trainer module next to trainer_fn_file.
+    """
+    defaults = {name: parameter.default for name, parameter in inspect.signature(main).parameters.items()
+                if parameter.default is not inspect.Parameter.empty and name not in ('job_id', 'submit')}
+    resolved = {**defaults, **arguments}
+    trainer_engine = resolved.pop('trainer_engine', 'keras')
+
+    if not resolved.get('query') and not resolved.get('data_path'):
+        raise ValueError("one of --query or --data-path is required")
+    split_ratio = resolved['split_ratio']
+    try:
+        train_ratio, eval_ratio = (int(x) for x in (split_ratio.split(":") if isinstance(split_ratio, str)
+                                                    else split_ratio))
+    except (TypeError, ValueError):
+        raise ValueError(f"--split-ratio must be two integers, as train:eval, got {split_ratio}")
+    if train_ratio <= 0 or eval_ratio <= 0:
+        raise ValueError(f"--split-ratio must be two positive integers, got {split_ratio}")
+    resolved['split_ratio'] = (train_ratio, eval_ratio)
+
+    eval_sample_rate = resolved['eval_sample_rate']
+    if eval_sample_rate is not None and not 0 < eval_sample_rate <= 1:
+        raise ValueError("--eval-sample-rate must be in (0, 1]")
+    if eval_sample_rate is not None and resolved['export_variants']:
+        # The sampled evaluation pushes the float model, without selecting a variant
+        raise ValueError("--export-variants can't be used with --eval-sample-rate")
+    if resolved['incremental'] and not resolved.get('data_path'):
+        if not resolved['span_column']:
+            raise ValueError("--incremental with --query requires --span-column")
+        if resolved['span'] is None:
+            resolved['span'] = vertex_configs.get_latest_complete_span()
+
+    running_locally = resolved['running_locally']
+    span_window = arguments.get('span_window')
+    if span_window is not None and span_window < 1:
+        raise ValueError("--span-window must be positive")
+    if span_window is not None and span_window > 1 and not running_locally:
+        raise ValueError("--span-window needs --run-locally, Vertex pipelines can't resolve a window of spans")
+    resolved['span_window'] = span_window or (vertex_configs.SPAN_WINDOW if running_locally else 1)
+
+    if resolved['trainer_worker_count'] > 0 and resolved['distribution_strategy'] != "multi_worker":
+        raise ValueError("--trainer-worker-count requires --distribution-strategy=multi_worker")
+    if running_locally and resolved['distribution_strategy'] == "multi_worker":
+        raise ValueError("--distribution-strategy=multi_worker is only supported in Vertex")
+    if resolved['example_format'] == "parquet" and resolved['packed_features']:
+        # The Evaluator then reads the raw examples, and the serving signature takes tf.Examples
+        raise ValueError("--example-format=parquet can't be combined with --packed-features")
+    sample_fraction, max_rows = resolved['sample_fraction'], resolved['max_rows']
+    if sample_fraction is not None and not 0 < sample_fraction <= 1:
+        raise ValueError("--sample-fraction must be in (0, 1]")
+    if max_rows is not None and max_rows <= 0:
+        raise ValueError("--max-rows must be positive")
+    if resolved['batch_score'] and (sample_fraction is not None or max_rows):
+        raise ValueError("--batch-score scores all the rows, it can't be combined with --sample-fraction or "
+                         "--max-rows")
+    if not 0 < resolved['pruning_sparsity'] < 1:
+        raise ValueError("--pruning-sparsity must be in (0, 1)")
+    if resolved['pruning_epochs'] <= 0:
+        raise ValueError("--pruning-epochs must be positive")
+
+    resolved['trainer_fn_file'] = vertex_configs.get_trainer_fn_file(resolved['trainer_fn_file'], trainer_engine)
+    if os.path.basename(resolved['trainer_fn_file']) == vertex_configs.GBT_TRAINER_MODULE:
+        # The trees are trained in a single process and a single pass, from scratch
+        if not running_locally:
+            raise ValueError("--trainer-engine=gbt needs --run-locally, the TFX and serving images of Vertex "
+                             "don't have the TF-DF ops of the model")
+        if resolved['tuner_parallel_trials'] > 0 or resolved['export_variants'] or resolved['warm_start']:
+            raise ValueError("--tuner-parallel-trials, --export-variants and --warm-start need the keras engine")
+        if resolved['distribution_strategy'] != "none":
+            raise ValueError("--distribution-strategy needs the keras engine")
+    return resolved
 
 
 if __name__ == '__main__':
@@ -115,23 +368,242 @@ if __name__ == '__main__':
     parser.add_argument("--pipeline-root", required=True)
     parser.add_argument("--pipeline-name", required=True)
 
-    parser.add_argument("--query", required=True)
+    parser.add_argument("--query", required=False, help="Mandatory if --data-path is not set")
+    parser.add_argument("--data-path", required=False,
+                        help="Directory with the data files, to read the data from files instead of BigQuery")
+    parser.add_argument("--data-format", required=False, choices=vertex_configs.LOCAL_DATA_FORMATS, default="csv",
+                        help="Format of the files in --data-path")
+    parser.add_argument("--split-ratio", required=False, default="2:1",
+                        help="Ratio of the train and eval splits, as train:eval")
+    parser.add_argument("--output-num-shards", required=False, type=int,
+                        help="Number of files of each split written by ExampleGen (default: chosen by the runner)")
+    parser.add_argument("--no-output-compression", required=False, action="store_true", default=False,
+                        help="Write the ExampleGen TFRecords without gzip compression")
+    parser.add_argument("--example-format", required=False, choices=vertex_configs.EXAMPLE_FORMATS,
+                        default="tfrecord", help="Format of the ExampleGen output: tf.Example TFRecords, or "
+                                                 "Parquet files read in columns by StatisticsGen and Transform")
 
     parser.add_argument("--transform-fn-path", required=True)
     parser.add_argument("--trainer-fn-path", required=True)
 
+    parser.add_argument("--packed-features", required=False, action="store_true", default=False,
+                        help="Transform output and model input as a single dense vector instead of one "
+                             "tensor per column")
+    parser.add_argument("--fused-analyzers", required=False, action="store_true", default=False,
+                        help="Compute the min/max of all the numeric columns in a single Transform analyzer")
+
+    parser.add_argument("--input-cache", required=False, choices=["none", "memory", "disk"], default="none",
+                        help="Cache the training data in RAM or on local disk after the first epoch")
+    parser.add_argument("--input-cache-dir", required=False,
+                        help="Local directory for --input-cache=disk (default: system temp dir)")
+    parser.add_argument("--shuffle-buffer-size", required=False, type=int,
+                        default=vertex_configs.SHUFFLE_BUFFER_SIZE,
+                        help="Number of examples in the shuffle buffer, 0 disables shuffling")
+    parser.add_argument("--nondeterministic-input", required=False, action="store_true", default=False,
+                        help="Allow the input pipeline to return examples out of order, for more throughput")
+    parser.add_argument("--profile-input-pipeline", required=False, action="store_true", default=False,
+                        help="Log if each training epoch is input-bound or compute-bound")
+
+    parser.add_argument("--local-profile", required=False, choices=vertex_configs.LOCAL_PROFILES, default="single",
+                        help="DirectRunner execution profile: workers and running mode derived from the CPU count")
+    parser.add_argument("--direct-num-workers", required=False, type=int,
+                        help="Overrides the number of DirectRunner workers of the profile")
+    parser.add_argument("--direct-running-mode", required=False,
+                        choices=["in_memory", "multi_threading", "multi_processing"],
+                        help="Overrides the DirectRunner running mode of the profile")
+    parser.add_argument("--stats-batch-size", required=False, type=int,
+                        help="Overrides the desired batch size of StatisticsGen of the profile")
+
+    parser.add_argument("--collect-metrics", required=False, action="store_true", default=False,
+                        help="Write a JSON file with the performance metrics of the run to "
+                             "<pipeline root>/run_metrics. In Vertex, waits until the job finishes")
+    parser.add_argument("--profile-steps", required=False,
+                        help="Range of training steps to trace with the TensorFlow profiler, as first,last")
+
+    parser.add_argument("--distribution-strategy", required=False, choices=vertex_configs.DISTRIBUTION_STRATEGIES,
+                        default="none",
+                        help="mirrored: replicas in the local GPUs or CPU devices, multi_worker: replicas in all "
+                             "the machines of the Vertex training job")
+    parser.add_argument("--cpu-replicas", required=False, type=int,
+                        help="Number of CPU devices of the mirrored strategy without GPUs (default: half the CPUs)")
+    parser.add_argument("--trainer-machine-type", required=False, default=vertex_configs.TRAINER_MACHINE_TYPE,
+                        help="Machine type of the chief of the Vertex training job")
+    parser.add_argument("--trainer-worker-count", required=False, type=int, default=0,
+                        help="Number of additional workers of the Vertex training job, for multi_worker")
+    parser.add_argument("--trainer-worker-machine-type", required=False,
+                        help="Machine type of the additional workers (default: same as the chief)")
+
+    parser.add_argument("--trainer-engine", required=False, choices=vertex_configs.TRAINER_ENGINES,
+                        default="keras", help="keras trains the network of --trainer-fn-path, gbt the gradient "
+                                              "boosted trees of the trainer_gbt_fn.py module next to it")
+    parser.add_argument("--gbt-num-trees", required=False, type=int, default=vertex_configs.GBT_NUM_TREES,
+                        help="Max number of trees of the gbt engine, it stops earlier if the eval loss stops improving")
+    parser.add_argument("--gbt-max-depth", required=False, type=int, default=vertex_configs.GBT_MAX_DEPTH,
+                        help="Max depth of the trees of the gbt engine")
+
+    parser.add_argument("--jit-compile", required=False, action="store_true", default=False,
+                        help="Compile the training steps and the model in the serving signatures with XLA")
+    parser.add_argument("--steps-per-execution", required=False, type=int, default=1,
+                        help="Training steps run in each call of the training function")
+    parser.add_argument("--mixed-precision", required=False, choices=vertex_configs.MIXED_PRECISION_POLICIES,
+                        default="none", help="Compute the hidden layers of the model in bfloat16")
+    parser.add_argument("--export-variants", required=False, nargs="+", choices=vertex_configs.MODEL_VARIANTS,
+                        help="Also export these lightweight variants of the model, and push the smallest one "
+                             "blessed by its evaluation. pruned needs tensorflow-model-optimization")
+    parser.add_argument("--variant-tolerance", required=False, type=float, default=vertex_configs.VARIANT_TOLERANCE,
+                        help="Max drop of binary accuracy of a variant against the float model to push it")
+    parser.add_argument("--pruning-sparsity", required=False, type=float, default=vertex_configs.PRUNING_SPARSITY,
+                        help="Fraction of the weights set to zero in the pruned variant")
+    parser.add_argument("--pruning-epochs", required=False, type=float, default=vertex_configs.PRUNING_EPOCHS,
+                        help="Passes over the training data (fractional) to fine-tune the pruned variant")
+
+    parser.add_argument("--tuner-parallel-trials", required=False, type=int, default=0,
+                        help="Add a Tuner running this number of Hyperband trials in parallel (processes when "
+                             "running locally, workers in Vertex). 0 disables tuning")
+    parser.add_argument("--tuner-max-epochs", required=False, type=int, default=vertex_configs.TUNER_MAX_EPOCHS,
+                        help="Hyperband epochs of the longest trials, each epoch is a fraction of the training data")
+
+    parser.add_argument("--epochs", required=False, type=float, default=vertex_configs.TRAIN_EPOCHS,
+                        help="Passes over the training data when training from scratch, may be fractional")
+    parser.add_argument("--warm-start", required=False, action="store_true", default=False,
+                        help="Start training from the weights of the latest blessed model, if compatible")
+    parser.add_argument("--warm-start-epochs", required=False, type=float, default=vertex_configs.WARM_START_EPOCHS,
+                        help="Passes over the training data when warm starting, may be fractional")
+
+    parser.add_argument("--incremental", required=False, action="store_true", default=False,
+                        help="Ingest only a new span (day) of data, and analyze and train with the last "
+                             "--span-window spans, reusing the Transform analyzer cache")
+    parser.add_argument("--span-column", required=False,
+                        help="Date or timestamp column of the --query that defines the span of each row. "
+                             "Mandatory with --incremental and --query")
+    parser.add_argument("--span", required=False, type=int,
+                        help="Span to ingest, as days since 1970-01-01 (default: yesterday with --query, "
+                             "the latest span-N directory with --data-path)")
+    parser.add_argument("--span-window", required=False, type=int,
+                        help="Number of most recent spans used by Transform and the Trainer (local runs only, "
+                             f"default {vertex_configs.SPAN_WINDOW}). Vertex runs use the new span only")
+
+    parser.add_argument("--skip-unchanged-data", required=False, action="store_true", default=False,
+                        help="Skip training, evaluation and pushing if the data did not drift since the data "
+                             "of the last blessed model")
+    parser.add_argument("--drift-threshold", required=False, type=float, default=vertex_configs.DRIFT_THRESHOLD,
+                        help="Max Jensen-Shannon divergence (numeric) or L-infinity distance (categorical) of a "
+                             "feature to consider the data unchanged")
+    parser.add_argument("--num-examples-threshold", required=False, type=float,
+                        default=vertex_configs.NUM_EXAMPLES_THRESHOLD,
+                        help="Max relative change of the number of examples to consider the data unchanged")
+    parser.add_argument("--pipeline-image", required=False,
+                        help="Image of the components in Vertex (default: the TFX image). The components defined "
+                             "in this package, like the drift gate, need an image with it installed")
+
+    parser.add_argument("--eval-sample-rate", required=False, type=float,
+                        help="Evaluate first a deterministic sample of this fraction of the non-fraud eval "
+                             "examples (and all the fraud examples), and the full eval split only if the result "
+                             "is near the blessing threshold")
+    parser.add_argument("--eval-margin", required=False, type=float, default=vertex_configs.EVAL_MARGIN,
+                        help="Distance from the threshold to the confidence interval of the sampled evaluation "
+                             "below which the full evaluation runs")
+    parser.add_argument("--eval-num-workers", required=False, type=int,
+                        help="Beam workers of the Evaluator (DirectRunner processes or Dataflow workers)")
+
+    parser.add_argument("--velocity-features", required=False, action="store_true", default=False,
+                        help="Use the velocity features columns of the data (see "
+                             "my_vertex_pipelines.velocity_features) as features of the model")
+
+    parser.add_argument("--batch-score", required=False, action="store_true", default=False,
+                        help="Instead of training, score all the rows of --query (or the files in --data-path) "
+                             "with the latest blessed model of the pipeline, writing the scores as Parquet")
+    parser.add_argument("--score-batch-size", required=False, type=int, default=vertex_configs.SCORE_BATCH_SIZE,
+                        help="Examples per call of the model in --batch-score")
+    parser.add_argument("--score-num-workers", required=False, type=int,
+                        help="Beam workers of the scoring (DirectRunner processes or Dataflow workers)")
+
+    parser.add_argument("--sample-fraction", required=False, type=float,
+                        help="Development run with all the fraud rows and this fraction of the other rows, "
+                             "chosen by a hash of the row, so every run gets the same sample")
+    parser.add_argument("--max-rows", required=False, type=int,
+                        help="Development run with at most this number of rows, the fraud rows first and then "
+                             "the rows with the lowest hashes (after --sample-fraction, if given)")
+
+    parser.add_argument("--no-compile-cache", required=False, action="store_true", default=False,
+                        help="Always build and compile the Vertex pipeline, instead of reusing the definition "
+                             "compiled for the same arguments and module files")
+
     args = parser.parse_args()
 
-    main(running_locally=args.run_locally,
-         use_dataflow=args.use_dataflow,
-         pipeline_name=args.pipeline_name,
-         pipeline_root=args.pipeline_root,
-         query=args.query,
-         project_id=args.project_id,
-         region=args.region,
-         service_account=args.service_account,
-         service_account_dataflow=args.service_account_dataflow,
-         dataflow_network=args.dataflow_network,
-         transform_fn_file=args.transform_fn_path,
-         trainer_fn_file=args.trainer_fn_path,
-         temp_location=args.temp_location)
+    try:
+        main_arguments = resolve_arguments(dict(
+            running_locally=args.run_locally,
+            use_dataflow=args.use_dataflow,
+            pipeline_name=args.pipeline_name,
+            pipeline_root=args.pipeline_root,
+            query=args.query,
+            project_id=args.project_id,
+            region=args.region,
+            service_account=args.service_account,
+            service_account_dataflow=args.service_account_dataflow,
+            dataflow_network=args.dataflow_network,
+            transform_fn_file=args.transform_fn_path,
+            trainer_fn_file=args.trainer_fn_path,
+            trainer_engine=args.trainer_engine,
+            temp_location=args.temp_location,
+            packed_features=args.packed_features,
+            fused_analyzers=args.fused_analyzers,
+            input_config=vertex_configs.get_trainer_input_config(cache=args.input_cache,
+                                                                 shuffle_buffer_size=args.shuffle_buffer_size,
+                                                                 deterministic=not args.nondeterministic_input,
+                                                                 profile=args.profile_input_pipeline,
+                                                                 cache_dir=args.input_cache_dir),
+            local_profile=args.local_profile,
+            direct_num_workers=args.direct_num_workers,
+            direct_running_mode=args.direct_running_mode,
+            stats_batch_size=args.stats_batch_size,
+            data_path=args.data_path,
+            data_format=args.data_format,
+            split_ratio=args.split_ratio,
+            output_num_shards=args.output_num_shards,
+            output_compression=not args.no_output_compression,
+            example_format=args.example_format,
+            sample_fraction=args.sample_fraction,
+            max_rows=args.max_rows,
+            collect_metrics=args.collect_metrics,
+            profile_steps=args.profile_steps,
+            distribution_strategy=args.distribution_strategy,
+            cpu_replicas=args.cpu_replicas,
+            trainer_machine_type=args.trainer_machine_type,
+            trainer_worker_count=args.trainer_worker_count,
+            trainer_worker_machine_type=args.trainer_worker_machine_type,
+            tuner_parallel_trials=args.tuner_parallel_trials,
+            tuner_max_epochs=args.tuner_max_epochs,
+            epochs=args.epochs,
+            warm_start=args.warm_start,
+            warm_start_epochs=args.warm_start_epochs,
+            incremental=args.incremental,
+            span_column=args.span_column,
+            span=args.span,
+            span_window=args.span_window,
+            skip_unchanged_data=args.skip_unchanged_data,
+            drift_threshold=args.drift_threshold,
+            num_examples_threshold=args.num_examples_threshold,
+            pipeline_image=args.pipeline_image,
+            eval_sample_rate=args.eval_sample_rate,
+            eval_margin=args.eval_margin,
+            eval_num_workers=args.eval_num_workers,
+            batch_score=args.batch_score,
+            score_batch_size=args.score_batch_size,
+            score_num_workers=args.score_num_workers,
+            velocity_features=args.velocity_features,
+            jit_compile=args.jit_compile,
+            steps_per_execution=args.steps_per_execution,
+            mixed_precision=args.mixed_precision,
+            export_variants=args.export_variants,
+            variant_tolerance=args.variant_tolerance,
+            pruning_sparsity=args.pruning_sparsity,
+            pruning_epochs=args.pruning_epochs,
+            gbt_num_trees=args.gbt_num_trees,
+            gbt_max_depth=args.gbt_max_depth,
+            compile_cache=not args.no_compile_cache))
+    except ValueError as e:
+        parser.error(str(e))
+
+    main(**main_arguments)
@@ -12,16 +12,188 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-from typing import Optional, List
+import contextlib
+import logging
+import os
+from typing import Any, Dict, Optional, List, Tuple
 
 import tfx.v1 as tfx
-from tfx.components import StatisticsGen, SchemaGen, Transform
-from tfx.extensions.google_cloud_big_query.example_gen.component import BigQueryExampleGen
+from tfx.components import FileBasedExampleGen, StatisticsGen, SchemaGen, Transform
+from tfx.components.example_gen.csv_example_gen import executor as csv_executor
+from tfx.components.example_gen.custom_executors import parquet_executor
+from tfx.components.example_gen.import_example_gen import executor as import_executor
+from tfx.dsl.components.base import executor_spec
 
+import tensorflow_data_validation as tfdv
 import tensorflow_model_analysis as tfma
 
+from my_vertex_pipelines import batch_scoring
+from my_vertex_pipelines import drift_gate
+from my_vertex_pipelines import local_example_gen
+from my_vertex_pipelines import local_tuner
+from my_vertex_pipelines import model_variants
+from my_vertex_pipelines import sampled_evaluation
 from my_vertex_pipelines import vertex_configs
 
+# Stock and custom (sharding and compression) ExampleGen executors of each local data format
+_LOCAL_EXECUTORS = {
+    'csv': (csv_executor.Executor, local_example_gen.CsvExecutor),
+    'parquet': (parquet_executor.Executor, local_example_gen.ParquetExecutor),
+    'tfrecord': (import_executor.Executor, local_example_gen.TFRecordExecutor),
+}
+
+
+class _TFRecordTransform(Transform):
+    """Transform that materializes the transformed examples as TFRecords, whatever the format of its input."""
+    EXECUTOR_SPEC = executor_spec.BeamExecutorSpec(local_example_gen.TFRecordTransformExecutor)
+
+
+def _get_span_query(query: str, span_column: str) -> str:
+    # ExampleGen replaces the placeholders with the limits of the span (a day), in seconds since the epoch
+    return (f"SELECT * EXCEPT({span_column}) FROM ({query}) "
+            f"WHERE TIMESTAMP({span_column}) >= TIMESTAMP_SECONDS(@span_begin_timestamp) "
+            f"AND TIMESTAMP({span_column}) < TIMESTAMP_SECONDS(@span_end_timestamp)")
+
+
+def _create_example_gen(query: Optional[str],
+                        data_path: Optional[str],
+                        data_format: str,
+                        split_ratio: Tuple[int, int],
+                        output_num_shards: Optional[int],
+                        output_compression: bool,
+                        incremental: bool = False,
+                        span_column: Optional[str] = None,
+                        span: Optional[int] = None,
+                        output_config: Optional[tfx.proto.Output] = None,
+                        example_format: str = 'tfrecord'):
+    if output_config is None:
+        output_config = tfx.proto.Output(
+            split_config=tfx.proto.SplitConfig(splits=[
+                tfx.proto.SplitConfig.Split(name='train', hash_buckets=split_ratio[0]),
+                tfx.proto.SplitConfig.Split(name='eval', hash_buckets=split_ratio[1])]))
+
+    range_config = None
+    if incremental and span is not None:
+        range_config = tfx.proto.RangeConfig(
+            static_range=tfx.proto.StaticRange(start_span_number=span, end_span_number=span))
+
+    if not data_path:
+        # Get data from BigQuery, only the rows of the span (day) if incremental
+        custom_executor_spec = None
+        if example_format == 'parquet':
+            custom_executor_spec = executor_spec.BeamExecutorSpec(local_example_gen.ParquetBigQueryExecutor)
+        if incremental:
+            return tfx.extensions.google_cloud_big_query.BigQueryExampleGen(
+                query=_get_span_query(query, span_column),
+                output_config=output_config,
+                range_config=range_config,
+                custom_executor_spec=custom_executor_spec)
+        return tfx.extensions.google_cloud_big_query.BigQueryExampleGen(query=query,
+                                                                        output_config=output_config,
+                                                                        custom_executor_spec=custom_executor_spec)
+
+    # Get data from files (all the files in the data_path directory, or in its span-N subdirectory
+    # if incremental, the latest span if no span is given)
+    input_config = None
+    if incremental:
+        input_config = tfx.proto.Input(splits=[tfx.proto.Input.Split(name='single_split', pattern='span-{SPAN}/*')])
+    stock_executor, sharded_executor = _LOCAL_EXECUTORS[data_format]
+    if output_num_shards or not output_compression or example_format != 'tfrecord':
+        return FileBasedExampleGen(
+            input_base=data_path,
+            input_config=input_config,
+            output_config=output_config,
+            range_config=range_config,
+            custom_config=local_example_gen.make_custom_config(num_shards=output_num_shards,
+                                                               compress=output_compression,
+                                                               file_format=example_format),
+            custom_executor_spec=executor_spec.BeamExecutorSpec(sharded_executor))
+
+    return FileBasedExampleGen(input_base=data_path,
+                               input_config=input_config,
+                               output_config=output_config,
+                               range_config=range_config,
+                               custom_executor_spec=executor_spec.BeamExecutorSpec(stock_executor))
+
+
+def _create_model_resolver() -> tfx.dsl.Resolver:
+    # Only the float models of the Trainer, the variants are never the baseline or the model to score with.
+    # Vertex pipelines ignore the producer, there the variants are never blessed (see model_variants)
+    return tfx.dsl.Resolver(
+        strategy_class=tfx.dsl.experimental.LatestBlessedModelStrategy,
+        model=tfx.dsl.Channel(type=tfx.types.standard_artifacts.Model, producer_component_id='Trainer'),
+        model_blessing=tfx.dsl.Channel(
+            type=tfx.types.standard_artifacts.ModelBlessing)).with_id(
+        'latest_blessed_model_resolver')
+
+
+def _get_eval_config(example_weight_key: Optional[str] = None,
+                     confidence_intervals: bool = False,
+                     variant_tolerance: Optional[float] = None) -> tfma.EvalConfig:
+    # Metrics to be checked. A variant is also checked against the float model (the baseline),
+    # it can't be less accurate than it by more than the tolerance
+    threshold = tfma.MetricThreshold(
+        value_threshold=tfma.GenericValueThreshold(
+            lower_bound={'value': vertex_configs.ACCURACY_THRESHOLD}))
+    if variant_tolerance is not None:
+        threshold.change_threshold.CopyFrom(tfma.GenericChangeThreshold(
+            direction=tfma.MetricDirection.HIGHER_IS_BETTER,
+            absolute={'value': -variant_tolerance}))
+    eval_config = tfma.EvalConfig(
+        model_specs=[tfma.ModelSpec(label_key='Class', example_weight_key=example_weight_key)],
+        slicing_specs=[tfma.SlicingSpec()],
+        metrics_specs=[
+            tfma.MetricsSpec(per_slice_thresholds={
+                'binary_accuracy':
+                    tfma.PerSliceMetricThresholds(thresholds=[
+                        tfma.PerSliceMetricThreshold(
+                            slicing_specs=[tfma.SlicingSpec()],
+                            threshold=threshold
+                        )]),
+            })])
+    if confidence_intervals:
+        eval_config.options.compute_confidence_intervals.value = True
+    return eval_config
+
+
+def _get_worker_beam_args(beam_pipeline_args: Optional[List[str]], num_workers: int) -> List[str]:
+    # Appended to the pipeline Beam args of a single component, so they override them
+    if any(arg == '--runner=DataflowRunner' for arg in beam_pipeline_args or []):
+        return [f'--num_workers={num_workers}']
+    return ['--direct_running_mode=multi_processing', f'--direct_num_workers={num_workers}']
+
+
+def _create_pusher(model: tfx.dsl.Channel,
+                   model_blessing: tfx.dsl.Channel,
+                   local_connection_config: Optional[str],
+                   project_id: str,
+                   region: str):
+    if local_connection_config:
+        return tfx.components.Pusher(
+            model=model,
+            model_blessing=model_blessing,
+            push_destination=tfx.proto.PushDestination(
+                filesystem=tfx.proto.PushDestination.Filesystem(
+                    base_directory=vertex_configs.SERVING_MODEL_DIR)))
+    else:
+        serving_image = 'europe-docker.pkg.dev/vertex-ai/prediction/tf2-cpu.2-9:latest'
+        vertex_serving_spec = vertex_configs.get_vertex_endpoint_config(
+            project_id,
+            endpoint_name="fraud-detection")
+        return tfx.extensions.google_cloud_ai_platform.Pusher(
+            model=model,
+            model_blessing=model_blessing,
+            custom_config={
+                tfx.extensions.google_cloud_ai_platform.ENABLE_VERTEX_KEY:
+                    True,
+                tfx.extensions.google_cloud_ai_platform.VERTEX_REGION_KEY:
+                    region,
+                tfx.extensions.google_cloud_ai_platform.VERTEX_CONTAINER_IMAGE_URI_KEY:
+                    serving_image,
+                tfx.extensions.google_cloud_ai_platform.SERVING_ARGS_KEY:
+                    vertex_serving_spec,
+            })
+
 
 def create_pipeline(pipeline_name: str,
                     experiment_name: str,
@@ -34,19 +206,75 @@ def create_pipeline(pipeline_name: str,
                     region: str,
                     project_id: str,
                     service_account: str,
-                    local_connection_config: Optional[str]) -> tfx.dsl.Pipeline:
+                    local_connection_config: Optional[str],
+                    packed_features: bool = False,
+                    fused_analyzers: bool = False,
+                    input_config: Optional[Dict[str, Any]] = None,
+                    stats_batch_size: Optional[int] = None,
+                    data_path: Optional[str] = None,
+                    data_format: str = 'csv',
+                    split_ratio: Tuple[int, int] = (2, 1),
+                    output_num_shards: Optional[int] = None,
+                    output_compression: bool = True,
+                    example_format: str = 'tfrecord',
+                    profile_steps: Optional[str] = None,
+                    distribution_strategy: str = 'none',
+                    cpu_replicas: Optional[int] = None,
+                    trainer_machine_type: str = vertex_configs.TRAINER_MACHINE_TYPE,
+                    trainer_worker_count: int = 0,
+                    trainer_worker_machine_type: Optional[str] = None,
+                    tuner_parallel_trials: int = 0,
+                    tuner_max_epochs: int = vertex_configs.TUNER_MAX_EPOCHS,
+                    epochs: float = vertex_configs.TRAIN_EPOCHS,
+                    warm_start: bool = False,
+                    warm_start_epochs: float = vertex_configs.WARM_START_EPOCHS,
+                    incremental: bool = False,
+                    span_column: Optional[str] = None,
+                    span: Optional[int] = None,
+                    span_window: int = vertex_configs.SPAN_WINDOW,
+                    skip_unchanged_data: bool = False,
+                    drift_threshold: float = vertex_configs.DRIFT_THRESHOLD,
+                    num_examples_threshold: float = vertex_configs.NUM_EXAMPLES_THRESHOLD,
+                    eval_sample_rate: Optional[float] = None,
+                    eval_margin: float = vertex_configs.EVAL_MARGIN,
+                    eval_num_workers: Optional[int] = None,
+                    velocity_features: bool = False,
+                    jit_compile: bool = False,
+                    steps_per_execution: int = 1,
+                    mixed_precision: str = 'none',
+                    export_variants: Optional[List[str]] = None,
+                    variant_tolerance: float = vertex_configs.VARIANT_TOLERANCE,
+                    pruning_sparsity: float = vertex_configs.PRUNING_SPARSITY,
+                    pruning_epochs: float = vertex_configs.PRUNING_EPOCHS,
+                    gbt_num_trees: int = vertex_configs.GBT_NUM_TREES,
+                    gbt_max_depth: int = vertex_configs.GBT_MAX_DEPTH) -> tfx.dsl.Pipeline:
     ## -----
     ## Input
     ## -----
-    # Get data from BigQuery
-    example_gen: BigQueryExampleGen = tfx.extensions.google_cloud_big_query.BigQueryExampleGen(query=query)
+    # Get data from BigQuery, or from local files if data_path is set
+    example_gen = _create_example_gen(query=query,
+                                      data_path=data_path,
+                                      data_format=data_format,
+                                      split_ratio=split_ratio,
+                                      output_num_shards=output_num_shards,
+                                      output_compression=output_compression,
+                                      incremental=incremental,
+                                      span_column=span_column,
+                                      span=span,
+                                      example_format=example_format)
 
     ## ---------------
     ## Data validation
     ## ---------------
     # Computes statistics over data for visualization and example validation.
+    # If incremental, only over the new span
+    if stats_batch_size:
+        stats_options = tfdv.StatsOptions(desired_batch_size=stats_batch_size)
+    else:
+        stats_options = None
     statistics_gen: StatisticsGen = StatisticsGen(
-        examples=example_gen.outputs['examples'])
+        examples=example_gen.outputs['examples'],
+        stats_options=stats_options)
 
     # Schema inferred from stats
     schema_gen: SchemaGen = SchemaGen(
@@ -72,109 +300,284 @@ def create_pipeline(pipeline_name: str,
     # These are the types of anomalies that are detected:
     # https://github.com/tensorflow/metadata/blob/master/tensorflow_metadata/proto/v0/anomalies.proto
 
-    ## -------------------
-    ## Feature engineering
-    ## -------------------
-    transform: Transform = Transform(
-        examples=example_gen.outputs['examples'],
-        schema=schema_gen.outputs['schema'],
-        module_file=transform_fn_file)  # see feature_engineering_fn.py
+    ## ----------
+    ## Drift gate
+    ## ----------
+    # If skip_unchanged_data, the training branch only runs if the data changed materially since the
+    # data of the last blessed model. The decision and its reason are outputs of the drift_gate component
+    gate_components = []
+    training_gate = contextlib.nullcontext()
+    if skip_unchanged_data:
+        baseline_resolver = tfx.dsl.Resolver(
+            strategy_class=tfx.dsl.experimental.LatestArtifactStrategy,
+            baseline_statistics=tfx.dsl.Channel(type=drift_gate.BaselineStatistics)
+        ).with_id('baseline_statistics_resolver')
+        data_drift_gate = drift_gate.DriftGate(
+            statistics=statistics_gen.outputs['statistics'],
+            schema=schema_gen.outputs['schema'],
+            baseline_statistics=baseline_resolver.outputs['baseline_statistics'],
+            drift_threshold=drift_threshold,
+            num_examples_threshold=num_examples_threshold).with_id('drift_gate')
+        gate_components += [baseline_resolver, data_drift_gate]
+        training_gate = tfx.dsl.Cond(data_drift_gate.outputs['should_train'].future()[0].value == 1)
 
-    ## --------
-    ## Training
-    ## --------
-    if local_connection_config:
-        trainer = tfx.components.Trainer(
-            module_file=trainer_fn_file,
-            examples=transform.outputs['transformed_examples'],
-            transform_graph=transform.outputs['transform_graph'],
-            custom_config={
-                'batch_size': vertex_configs.BATCH_SIZE,
-                'dataset_size': vertex_configs.DATASET_SIZE
-            })
-    else:  # We are training in Vertex
-        vertex_job_spec = vertex_configs.get_vertex_training_config(project_id=project_id,
-                                                                    service_account=service_account)
-
-        trainer = tfx.extensions.google_cloud_ai_platform.Trainer(
-            module_file=trainer_fn_file,
-            examples=transform.outputs['transformed_examples'],
-            transform_graph=transform.outputs['transform_graph'],
-            custom_config={
-                tfx.extensions.google_cloud_ai_platform.ENABLE_VERTEX_KEY:
-                    True,
-                tfx.extensions.google_cloud_ai_platform.VERTEX_REGION_KEY:
-                    region,
-                tfx.extensions.google_cloud_ai_platform.TRAINING_ARGS_KEY:
-                    vertex_job_spec,
-                'batch_size': vertex_configs.BATCH_SIZE,
-                'dataset_size': vertex_configs.DATASET_SIZE,
-                'experiment_name': experiment_name,
-                'experiment_run_name': experiment_run_name,
-                'project_id': project_id,
-                'location': region
-            })
+    with training_gate:
+        ## -------------------
+        ## Feature engineering
+        ## -------------------
+        # If incremental, Transform analyzes the last span_window spans. The analyzer cache of the
+        # previous run holds the accumulators of the spans already seen, so only the new span is read
+        span_components = []
+        transform_examples = example_gen.outputs['examples']
+        analyzer_cache = None
+        if incremental:
+            if local_connection_config:
+                span_window_resolver = tfx.dsl.Resolver(
+                    strategy_class=tfx.dsl.experimental.SpanRangeStrategy,
+                    config={'range_config': tfx.proto.RangeConfig(
+                        rolling_range=tfx.proto.RollingRange(num_spans=span_window))},
+                    examples=tfx.dsl.Channel(type=tfx.types.standard_artifacts.Examples,
+                                             producer_component_id=example_gen.id)).with_id('span_window_resolver')
+                # Not connected through a channel, the window must include the span ingested in this run
+                span_window_resolver.add_upstream_node(example_gen)
+                transform_examples = span_window_resolver.outputs['examples']
+                span_components.append(span_window_resolver)
+            elif span_window > 1:
+                # Vertex pipelines only support the latest artifact resolvers, so there the window is the new span
+                logging.warning(f"Vertex pipelines can't resolve a window of {span_window} spans, "
+                                f"Transform and the Trainer use the new span only")
 
-    ## ---------------------------------
-    ## Evaluate model (against baseline)
-    ## ---------------------------------
-    model_resolver = tfx.dsl.Resolver(
-        strategy_class=tfx.dsl.experimental.LatestBlessedModelStrategy,
-        model=tfx.dsl.Channel(type=tfx.types.standard_artifacts.Model),
-        model_blessing=tfx.dsl.Channel(
-            type=tfx.types.standard_artifacts.ModelBlessing)).with_id(
-        'latest_blessed_model_resolver')
+            analyzer_cache_resolver = tfx.dsl.Resolver(
+                strategy_class=tfx.dsl.experimental.LatestArtifactStrategy,
+                cache=tfx.dsl.Channel(type=tfx.types.standard_artifacts.TransformCache,
+                                      producer_component_id=Transform.__name__)).with_id('analyzer_cache_resolver')
+            analyzer_cache = analyzer_cache_resolver.outputs['cache']
+            span_components.append(analyzer_cache_resolver)
 
-    # Metrics to be checked
-    eval_config = tfma.EvalConfig(
-        model_specs=[tfma.ModelSpec(label_key='Class')],
-        slicing_specs=[tfma.SlicingSpec()],
-        metrics_specs=[
-            tfma.MetricsSpec(per_slice_thresholds={
-                'binary_accuracy':
-                    tfma.PerSliceMetricThresholds(thresholds=[
-                        tfma.PerSliceMetricThreshold(
-                            slicing_specs=[tfma.SlicingSpec()],
-                            threshold=tfma.MetricThreshold(
-                                value_threshold=tfma.GenericValueThreshold(
-                                    lower_bound={'value': 0.6}))
-                        )]),
-            })])
+        # The stock executor would write the transformed examples of Parquet examples as Parquet files too
+        transform_class = _TFRecordTransform if example_format == 'parquet' else Transform
+        transform: Transform = transform_class(
+            examples=transform_examples,
+            schema=schema_gen.outputs['schema'],
+            analyzer_cache=analyzer_cache,
+            module_file=transform_fn_file,  # see feature_engineering_fn.py
+            custom_config={'packed_features': packed_features,
+                           'fused_analyzers': fused_analyzers,
+                           'velocity_features': velocity_features}).with_id(Transform.__name__)
 
-    evaluator = tfx.components.Evaluator(
-        examples=transform.outputs['transformed_examples'],
-        model=trainer.outputs['model'],
-        baseline_model=model_resolver.outputs['model'],
-        eval_config=eval_config)
+        ## --------
+        ## Training
+        ## --------
+        trainer_config = {
+            # Per replica, the trainer multiplies it by the number of replicas of the distribution strategy
+            'batch_size': vertex_configs.BATCH_SIZE,
+            'distribution_strategy': distribution_strategy,
+            # Same features as Transform, the packed vector and the raw signatures include the velocity features
+            'velocity_features': velocity_features,
+            # XLA for the training steps and the model in the serving signatures, steps per call of the
+            # training function and policy of the hidden layers
+            'jit_compile': jit_compile,
+            'steps_per_execution': steps_per_execution,
+            'mixed_precision': mixed_precision,
+            # Quantized and pruned variants saved next to the model, see model_variants
+            'export_variants': export_variants or [],
+            'pruning_sparsity': pruning_sparsity,
+            'pruning_epochs': pruning_epochs,
+            # Only read by the gradient boosted trees module, trainer_gbt_fn.py
+            'gbt_num_trees': gbt_num_trees,
+            'gbt_max_depth': gbt_max_depth,
+            # Passes over the training data, warm_start_epochs when starting from the latest blessed model
+            'epochs': epochs,
+            'warm_start_epochs': warm_start_epochs,
+            # The trainer counts the examples of each split once and caches the counts here
+            'split_size_cache_dir': os.path.join(pipeline_root, 'split_sizes'),
+            **(input_config or {})
+        }
+        if profile_steps:
+            trainer_config['profile_steps'] = profile_steps
+        if cpu_replicas:
+            trainer_config['cpu_replicas'] = cpu_replicas
 
-    ## --------------------------------------------------------------------------
-    ## Push to endpoint (and publish in model registry if this is the first time)
-    ## --------------------------------------------------------------------------
-    if local_connection_config:
-        pusher = tfx.components.Pusher(
-            model=trainer.outputs['model'],
-            model_blessing=evaluator.outputs['blessing'],
-            push_destination=tfx.proto.PushDestination(
-                filesystem=tfx.proto.PushDestination.Filesystem(
-                    base_directory=vertex_configs.SERVING_MODEL_DIR)))
-    else:
-        serving_image = 'europe-docker.pkg.dev/vertex-ai/prediction/tf2-cpu.2-9:latest'
-        vertex_serving_spec = vertex_configs.get_vertex_endpoint_config(
-            project_id,
-            endpoint_name="fraud-detection")
-        pusher = tfx.extensions.google_cloud_ai_platform.Pusher(
-            model=trainer.outputs['model'],
-            model_blessing=evaluator.outputs['blessing'],
-            custom_config={
-                tfx.extensions.google_cloud_ai_platform.ENABLE_VERTEX_KEY:
-                    True,
-                tfx.extensions.google_cloud_ai_platform.VERTEX_REGION_KEY:
-                    region,
-                tfx.extensions.google_cloud_ai_platform.VERTEX_CONTAINER_IMAGE_URI_KEY:
-                    serving_image,
-                tfx.extensions.google_cloud_ai_platform.SERVING_ARGS_KEY:
-                    vertex_serving_spec,
-            })
+        # Latest blessed model, baseline of the Evaluator and optionally the starting point of the Trainer
+        model_resolver = _create_model_resolver()
+
+        ## ------
+        ## Tuning
+        ## ------
+        # The search space and the tuner_fn are in trainer_fn.py, the Trainer uses the best hyperparameters
+        tuner = None
+        if tuner_parallel_trials > 0:
+            tuner_config = {**trainer_config, 'tuner_max_epochs': tuner_max_epochs}
+            tune_args = tfx.proto.TuneArgs(num_parallel_trials=tuner_parallel_trials)
+            if local_connection_config:
+                tuner = local_tuner.Tuner(
+                    module_file=trainer_fn_file,
+                    examples=transform.outputs['transformed_examples'],
+                    transform_graph=transform.outputs['transform_graph'],
+                    tune_args=tune_args,
+                    custom_config=tuner_config)
+            else:
+                vertex_tuner_spec = vertex_configs.get_vertex_tuner_config(project_id=project_id,
+                                                                           service_account=service_account,
+                                                                           machine_type=trainer_machine_type)
+                tuner = tfx.extensions.google_cloud_ai_platform.Tuner(
+                    module_file=trainer_fn_file,
+                    examples=transform.outputs['transformed_examples'],
+                    transform_graph=transform.outputs['transform_graph'],
+                    tune_args=tune_args,
+                    custom_config={
+                        tfx.extensions.google_cloud_ai_platform.ENABLE_VERTEX_KEY:
+                            True,
+                        tfx.extensions.google_cloud_ai_platform.VERTEX_REGION_KEY:
+                            region,
+                        tfx.extensions.google_cloud_ai_platform.experimental.TUNING_ARGS_KEY:
+                            vertex_tuner_spec,
+                        tfx.extensions.google_cloud_ai_platform.experimental.REMOTE_TRIALS_WORKING_DIR_KEY:
+                            os.path.join(pipeline_root, 'tuner_trials'),
+                        **tuner_config
+                    })
+        hyperparameters = tuner.outputs['best_hyperparameters'] if tuner else None
+        base_model = model_resolver.outputs['model'] if warm_start else None
+
+        if local_connection_config:
+            trainer = tfx.components.Trainer(
+                module_file=trainer_fn_file,
+                examples=transform.outputs['transformed_examples'],
+                transform_graph=transform.outputs['transform_graph'],
+                hyperparameters=hyperparameters,
+                base_model=base_model,
+                custom_config=trainer_config)
+        else:  # We are training in Vertex
+            vertex_job_spec = vertex_configs.get_vertex_training_config(project_id=project_id,
+                                                                        service_account=service_account,
+                                                                        machine_type=trainer_machine_type,
+                                                                        worker_count=trainer_worker_count,
+                                                                        worker_machine_type=trainer_worker_machine_type)
+
+            trainer = tfx.extensions.google_cloud_ai_platform.Trainer(
+                module_file=trainer_fn_file,
+                examples=transform.outputs['transformed_examples'],
+                transform_graph=transform.outputs['transform_graph'],
+                hyperparameters=hyperparameters,
+                base_model=base_model,
+                custom_config={
+                    tfx.extensions.google_cloud_ai_platform.ENABLE_VERTEX_KEY:
+                        True,
+                    tfx.extensions.google_cloud_ai_platform.VERTEX_REGION_KEY:
+                        region,
+                    tfx.extensions.google_cloud_ai_platform.TRAINING_ARGS_KEY:
+                        vertex_job_spec,
+                    **trainer_config,
+                    'experiment_name': experiment_name,
+                    'experiment_run_name': experiment_run_name,
+                    'project_id': project_id,
+                    'location': region
+                })
+
+        ## ---------------------------------
+        ## Evaluate model (against baseline)
+        ## ---------------------------------
+        # The serving signature parses raw columns, which are not present in the packed transformed examples
+        if packed_features:
+            eval_examples = example_gen.outputs['examples']
+        else:
+            eval_examples = transform.outputs['transformed_examples']
+
+        # The Evaluator imports the gradient boosted trees module, which registers the TF-DF ops of the model,
+        # also in the Beam workers (see trainer_gbt_fn.custom_eval_shared_model)
+        gbt_engine = os.path.basename(trainer_fn_file) == vertex_configs.GBT_TRAINER_MODULE
+        evaluator_module_file = trainer_fn_file if gbt_engine else None
+
+        def create_evaluator(examples, eval_config: tfma.EvalConfig, model=None, baseline_model=None,
+                             evaluator_class=tfx.components.Evaluator):
+            evaluator = evaluator_class(
+                examples=examples,
+                model=model or trainer.outputs['model'],
+                baseline_model=baseline_model or model_resolver.outputs['model'],
+                eval_config=eval_config,
+                module_file=evaluator_module_file)
+            if eval_num_workers:
+                evaluator.with_beam_pipeline_args(_get_worker_beam_args(beam_pipeline_args, eval_num_workers))
+            return evaluator
+
+        # Each evaluation has its pusher, to the endpoint (and the model registry if this is the first time)
+        sampled_eval_components = []
+        if eval_sample_rate:
+            # Evaluate a sample first, and the full eval split only if the result is near the threshold
+            eval_sample = sampled_evaluation.StratifiedSample(
+                examples=eval_examples,
+                sample_rate=eval_sample_rate).with_id('eval_sample')
+            sampled_evaluator = create_evaluator(
+                eval_sample.outputs['sampled_examples'],
+                _get_eval_config(example_weight_key=sampled_evaluation.SAMPLE_WEIGHT_KEY,
+                                 confidence_intervals=True)).with_id('sampled_evaluator')
+            evaluation_gate = sampled_evaluation.EvaluationGate(
+                evaluation=sampled_evaluator.outputs['evaluation'],
+                threshold=vertex_configs.ACCURACY_THRESHOLD,
+                margin=eval_margin).with_id('evaluation_gate')
+            full_evaluation = evaluation_gate.outputs['full_evaluation'].future()[0].value
+
+            with tfx.dsl.Cond(full_evaluation == 0):
+                sampled_pusher = _create_pusher(trainer.outputs['model'],
+                                                sampled_evaluator.outputs['blessing'],
+                                                local_connection_config=local_connection_config,
+                                                project_id=project_id,
+                                                region=region).with_id('sampled_pusher')
+                # The statistics of the data of a blessed model are the baseline of the next runs
+                if skip_unchanged_data:
+                    sampled_blessing = sampled_evaluator.outputs['blessing'].future()[0]
+                    with tfx.dsl.Cond(sampled_blessing.custom_property('blessed') == 1):
+                        sampled_record_baseline = drift_gate.RecordBaseline(
+                            statistics=statistics_gen.outputs['statistics']).with_id(
+                            f'sampled_{drift_gate.RECORD_BASELINE_ID}')
+                    gate_components.append(sampled_record_baseline)
+            sampled_eval_components += [eval_sample, sampled_evaluator, evaluation_gate, sampled_pusher]
+            full_evaluation_gate = tfx.dsl.Cond(full_evaluation == 1)
+        else:
+            full_evaluation_gate = contextlib.nullcontext()
+
+        variant_components = []
+        with full_evaluation_gate:
+            evaluator = create_evaluator(eval_examples, _get_eval_config())
+            pushed_model = trainer.outputs['model']
+            pushed_blessing = evaluator.outputs['blessing']
+
+            if export_variants:
+                # Each variant is validated against the float model, the smallest valid model is pushed
+                variant_inputs = {}
+                for variant in export_variants:
+                    export_variant = model_variants.ExportVariant(
+                        model_run=trainer.outputs['model_run'],
+                        variant=variant).with_id(f'export_{variant}')
+                    variant_evaluator = create_evaluator(
+                        eval_examples,
+                        _get_eval_config(variant_tolerance=variant_tolerance),
+                        model=export_variant.outputs['model'],
+                        baseline_model=trainer.outputs['model'],
+                        evaluator_class=model_variants.VariantEvaluator).with_id(f'{variant}_evaluator')
+                    variant_inputs[f'{variant}_model'] = export_variant.outputs['model']
+                    variant_inputs[f'{variant}_evaluation'] = variant_evaluator.outputs['evaluation']
+                    variant_components += [export_variant, variant_evaluator]
+                select_variant = model_variants.SelectVariant(
+                    model=trainer.outputs['model'],
+                    model_blessing=evaluator.outputs['blessing'],
+                    **variant_inputs).with_id('select_variant')
+                variant_components.append(select_variant)
+                pushed_model = select_variant.outputs['selected_model']
+                pushed_blessing = select_variant.outputs['selected_blessing']
+
+            pusher = _create_pusher(pushed_model,
+                                    pushed_blessing,
+                                    local_connection_config=local_connection_config,
+                                    project_id=project_id,
+                                    region=region)
+
+            # The statistics of the data of a blessed model are the baseline of the next runs
+            if skip_unchanged_data:
+                with tfx.dsl.Cond(evaluator.outputs['blessing'].future()[0].custom_property('blessed') == 1):
+                    record_baseline = drift_gate.RecordBaseline(
+                        statistics=statistics_gen.outputs['statistics']).with_id(drift_gate.RECORD_BASELINE_ID)
+                gate_components.append(record_baseline)
 
     if local_connection_config:
         components = [example_gen,
@@ -186,6 +589,9 @@ def create_pipeline(pipeline_name: str,
                       pusher,
                       model_resolver,
                       evaluator]
+        if tuner:
+            components.append(tuner)
+        components += span_components + gate_components + sampled_eval_components + variant_components
         pipeline = tfx.dsl.Pipeline(pipeline_name=pipeline_name,
                                     pipeline_root=pipeline_root,
                                     components=components,
@@ -202,6 +608,9 @@ def create_pipeline(pipeline_name: str,
                       pusher,
                       model_resolver,
                       evaluator]
+        if tuner:
+            components.append(tuner)
+        components += span_components + gate_components + sampled_eval_components + variant_components
 
         pipeline = tfx.dsl.Pipeline(pipeline_name=pipeline_name,
                                     pipeline_root=pipeline_root,
@@ -210,3 +619,66 @@ def create_pipeline(pipeline_name: str,
                                     enable_cache=True)
 
     return pipeline
+
+
+def create_batch_scoring_pipeline(pipeline_name: str,
+                                  pipeline_root: str,
+                                  query: Optional[str],
+                                  beam_pipeline_args: Optional[List[str]],
+                                  local_connection_config: Optional[str],
+                                  data_path: Optional[str] = None,
+                                  data_format: str = 'csv',
+                                  output_num_shards: Optional[int] = None,
+                                  output_compression: bool = True,
+                                  score_batch_size: int = vertex_configs.SCORE_BATCH_SIZE,
+                                  score_num_workers: Optional[int] = None) -> tfx.dsl.Pipeline:
+    """Pipeline that scores all the rows of the query (or the files in data_path) with the latest blessed model.
+
+    It must have the same name as the training pipeline, the resolver looks for the
+    blessed models in the metadata of the pipeline with that name.
+    """
+    # All the rows in a single split, with an id different from the ExampleGen of the training pipeline,
+    # so the resolvers of that pipeline never get the examples to score
+    output_config = tfx.proto.Output(
+        split_config=tfx.proto.SplitConfig(splits=[
+            tfx.proto.SplitConfig.Split(name=batch_scoring.SCORING_SPLIT, hash_buckets=1)]))
+    example_gen = _create_example_gen(query=query,
+                                      data_path=data_path,
+                                      data_format=data_format,
+                                      split_ratio=(1, 0),
+                                      output_num_shards=output_num_shards,
+                                      output_compression=output_compression,
+                                      output_config=output_config).with_id('scoring_example_gen')
+
+    model_resolver = _create_model_resolver()
+    # The raw feature spec of the training data, the columns and types of the scores besides the model features
+    transform_graph_resolver = tfx.dsl.Resolver(
+        strategy_class=tfx.dsl.experimental.LatestArtifactStrategy,
+        transform_graph=tfx.dsl.Channel(type=tfx.types.standard_artifacts.TransformGraph,
+                                        producer_component_id=Transform.__name__)).with_id(
+        'transform_graph_resolver')
+
+    # Batched inference in the Beam workers, writing the scores as Parquet files
+    batch_score = batch_scoring.BatchScore(
+        examples=example_gen.outputs['examples'],
+        model=model_resolver.outputs['model'],
+        transform_graph=transform_graph_resolver.outputs['transform_graph'],
+        batch_size=score_batch_size).with_id('batch_score')
+    if score_num_workers:
+        batch_score.with_beam_pipeline_args(_get_worker_beam_args(beam_pipeline_args, score_num_workers))
+
+    # The same query or files may return new rows, the outputs of previous runs are never reused
+    components = [example_gen, model_resolver, transform_graph_resolver, batch_score]
+    if local_connection_config:
+        return tfx.dsl.Pipeline(pipeline_name=pipeline_name,
+                                pipeline_root=pipeline_root,
+                                components=components,
+                                beam_pipeline_args=beam_pipeline_args,
+                                metadata_connection_config=local_connection_config,
+                                enable_cache=False)
+
+    return tfx.dsl.Pipeline(pipeline_name=pipeline_name,
+                            pipeline_root=pipeline_root,
+                            components=components,
+                            beam_pipeline_args=beam_pipeline_args,
+                            enable_cache=False)
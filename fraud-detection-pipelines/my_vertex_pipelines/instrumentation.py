@@ -0,0 +1,204 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Collects performance metrics of a pipeline run into a single JSON file.
+
+The metrics file of a run is written to <pipeline_root>/run_metrics/<run id>.json
+and contains, for every component: start and end times, state, bytes read and
+written per artifact, and the Beam counters and distributions of the
+components that run Beam (local runs only). The trainer adds its own per-epoch
+timings, see trainer_fn.TRAINER_METRICS_FILE.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, List, Optional
+
+import tensorflow as tf
+from ml_metadata.metadata_store import metadata_store
+from ml_metadata.proto import metadata_store_pb2
+from tfx.dsl.components.base import base_beam_executor
+
+# Must match trainer_fn.TRAINER_METRICS_FILE
+TRAINER_METRICS_FILE = 'trainer_metrics.json'
+RUN_METRICS_DIR = 'run_metrics'
+
+
+def _metric_results_to_dicts(results, distribution: bool = False) -> List[Dict[str, Any]]:
+    metrics = []
+    for result in results:
+        value = result.committed if result.committed is not None else result.attempted
+        if distribution and value is not None:
+            value = {'count': value.count, 'sum': value.sum, 'min': value.min, 'max': value.max, 'mean': value.mean}
+        metrics.append({'namespace': result.key.metric.namespace,
+                        'name': result.key.metric.name,
+                        'step': result.key.step,
+                        'value': value})
+    return metrics
+
+
+def _read_beam_metrics(result) -> Optional[Dict[str, Any]]:
+    try:
+        query = result.metrics().query()
+    except Exception as e:  # Not every runner supports querying metrics
+        logging.warning(f"Could not read the Beam metrics: {e}")
+        return None
+    return {'counters': _metric_results_to_dicts(query['counters']),
+            'distributions': _metric_results_to_dicts(query['distributions'], distribution=True)}
+
+
+@contextlib.contextmanager
+def capture_beam_metrics():
+    """Records the metrics of the Beam pipelines of the TFX components run in this process while the context is active.
+
+    The TFX executors discard the result of their Beam pipelines, so the pipelines made by
+    BaseBeamExecutor._make_beam_pipeline keep their result here, and the metrics are read from
+    the results when the context is closed. Other Beam pipelines are not affected.
+    """
+    captured = []
+    results = []
+    original_make_beam_pipeline = base_beam_executor.BaseBeamExecutor._make_beam_pipeline
+
+    def make_beam_pipeline(executor):
+        pipeline = original_make_beam_pipeline(executor)
+        original_run = pipeline.run
+
+        def run_and_keep_result(*args, **kwargs):
+            result = original_run(*args, **kwargs)
+            # The DirectRunner returns when the pipeline has finished
+            results.append((time.time(), result))
+            return result
+
+        # Only this pipeline, Pipeline.__exit__ runs it with self.run()
+        pipeline.run = run_and_keep_result
+        return pipeline
+
+    base_beam_executor.BaseBeamExecutor._make_beam_pipeline = make_beam_pipeline
+    try:
+        yield captured
+    finally:
+        base_beam_executor.BaseBeamExecutor._make_beam_pipeline = original_make_beam_pipeline
+        for end_time, result in results:
+            metrics = _read_beam_metrics(result)
+            if metrics is not None:
+                captured.append({'end_time': end_time, **metrics})
+
+
+def _artifact_bytes(uri: str) -> int:
+    if not uri or not tf.io.gfile.exists(uri):
+        return 0
+    if not tf.io.gfile.isdir(uri):
+        return tf.io.gfile.stat(uri).length
+    total = 0
+    for root, _, files in tf.io.gfile.walk(uri):
+        total += sum(tf.io.gfile.stat(os.path.join(root, f)).length for f in files)
+    return total
+
+
+def _read_trainer_metrics(uris: List[str]) -> Optional[Dict[str, Any]]:
+    for uri in uris:
+        path = os.path.join(uri, TRAINER_METRICS_FILE)
+        if uri and tf.io.gfile.exists(path):
+            with tf.io.gfile.GFile(path, 'r') as f:
+                return json.load(f)
+    return None
+
+
+def collect_local_run_metrics(metadata_connection_config: metadata_store_pb2.ConnectionConfig,
+                              pipeline_name: str,
+                              beam_metrics: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """Returns the metrics of the last run of the pipeline recorded in the local metadata store."""
+    store = metadata_store.MetadataStore(metadata_connection_config)
+
+    pipeline_context = store.get_context_by_type_and_name('pipeline', pipeline_name)
+    pipeline_execution_ids = {e.id for e in store.get_executions_by_context(pipeline_context.id)}
+    runs = [c for c in store.get_contexts_by_type('pipeline_run')
+            if any(e.id in pipeline_execution_ids for e in store.get_executions_by_context(c.id))]
+    run = max(runs, key=lambda c: c.create_time_since_epoch)
+
+    node_type_id = store.get_context_type('node').id
+    components = {}
+    for execution in store.get_executions_by_context(run.id):
+        node = [c for c in store.get_contexts_by_execution(execution.id) if c.type_id == node_type_id]
+        # Node contexts are named <pipeline name>.<component id>
+        component_id = node[0].name[len(pipeline_name) + 1:] if node else str(execution.id)
+
+        artifacts = {'inputs': [], 'outputs': []}
+        events = store.get_events_by_execution_ids([execution.id])
+        artifacts_by_id = {a.id: a for a in store.get_artifacts_by_id([e.artifact_id for e in events])}
+        for event in events:
+            direction = 'inputs' if event.type in (metadata_store_pb2.Event.INPUT,
+                                                   metadata_store_pb2.Event.DECLARED_INPUT) else 'outputs'
+            artifact = artifacts_by_id[event.artifact_id]
+            artifacts[direction].append({'uri': artifact.uri, 'bytes': _artifact_bytes(artifact.uri)})
+
+        start = execution.create_time_since_epoch / 1000
+        end = execution.last_update_time_since_epoch / 1000
+        components[component_id] = {
+            'state': metadata_store_pb2.Execution.State.Name(execution.last_known_state),
+            'start_time': start,
+            'end_time': end,
+            'wall_secs': end - start,
+            'bytes_read': sum(a['bytes'] for a in artifacts['inputs']),
+            'bytes_written': sum(a['bytes'] for a in artifacts['outputs']),
+            'artifacts': artifacts,
+            # Beam pipelines that finished while this component was running
+            'beam_metrics': [m for m in beam_metrics or [] if start <= m['end_time'] <= end],
+        }
+        trainer_metrics = _read_trainer_metrics([a['uri'] for a in artifacts['outputs']])
+        if trainer_metrics:
+            components[component_id]['trainer_metrics'] = trainer_metrics
+
+    return {'pipeline_name': pipeline_name, 'run_id': run.name, 'components': components}
+
+
+def collect_vertex_run_metrics(job) -> Dict[str, Any]:
+    """Returns the metrics of a finished aiplatform.PipelineJob."""
+    components = {}
+    for task in job.task_details:
+        start = task.start_time.timestamp() if task.start_time else None
+        end = task.end_time.timestamp() if task.end_time else None
+        outputs = [{'uri': a.uri, 'bytes': _artifact_bytes(a.uri)}
+                   for artifact_list in task.outputs.values() for a in artifact_list.artifacts]
+        inputs = [{'uri': a.uri, 'bytes': _artifact_bytes(a.uri)}
+                  for artifact_list in task.inputs.values() for a in artifact_list.artifacts]
+        components[task.task_name] = {
+            'state': task.state.name,
+            'start_time': start,
+            'end_time': end,
+            'wall_secs': end - start if start and end else None,
+            'bytes_read': sum(a['bytes'] for a in inputs),
+            'bytes_written': sum(a['bytes'] for a in outputs),
+            'artifacts': {'inputs': inputs, 'outputs': outputs},
+        }
+        trainer_metrics = _read_trainer_metrics([a['uri'] for a in outputs])
+        if trainer_metrics:
+            components[task.task_name]['trainer_metrics'] = trainer_metrics
+
+    return {'pipeline_name': job.display_name, 'run_id': job.name, 'components': components}
+
+
+def write_run_metrics(pipeline_root: str, run_metrics: Dict[str, Any]) -> str:
+    """Writes the metrics of a run next to the pipeline root and returns the path of the file."""
+    metrics_dir = os.path.join(pipeline_root, RUN_METRICS_DIR)
+    tf.io.gfile.makedirs(metrics_dir)
+    # Run ids of the LocalDagRunner are timestamps with colons, not valid in every file system
+    file_name = run_metrics['run_id'].replace(':', '').replace('/', '_') + '.json'
+    path = os.path.join(metrics_dir, file_name)
+    with tf.io.gfile.GFile(path, 'w') as f:
+        json.dump(run_metrics, f, indent=2, default=str)
+    logging.info(f"Run metrics written to {path}")
+    return path
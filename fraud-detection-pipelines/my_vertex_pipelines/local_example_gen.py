@@ -0,0 +1,296 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""ExampleGen executors for local files that control the sharding, compression and format of the output.
+
+The stock ExampleGen executors always write gzipped TFRecords and let the runner
+choose the number of shards. These executors read the same inputs, but write
+the number of shards and the compression given in the component custom_config,
+as tf.Example TFRecords or as Parquet files with a column per feature. With
+Parquet, StatisticsGen and Transform read Arrow record batches of the columns
+they need, instead of parsing every tf.Example. ParquetBigQueryExecutor does the
+same with the rows of the BigQuery query. TFRecordTransformExecutor keeps the
+output of Transform in tf.Example TFRecords, read by the Trainer and the Evaluator.
+"""
+
+import os
+from typing import Any, Dict, List, Optional
+
+import apache_beam as beam
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tensorflow as tf
+from apache_beam.io import fileio
+from google.protobuf import json_format
+from google.protobuf import struct_pb2
+from tfx import types
+from tfx.components.example_gen import utils
+from tfx.components.example_gen import write_split
+from tfx.components.example_gen.csv_example_gen import executor as csv_executor
+from tfx.components.example_gen.custom_executors import parquet_executor
+from tfx.components.example_gen.import_example_gen import executor as import_executor
+from tfx.components.transform import executor as transform_executor
+from tfx.extensions.google_cloud_big_query.example_gen import executor as big_query_executor
+from tfx.components.util import examples_utils
+from tfx.proto import example_gen_pb2
+from tfx.types import artifact_utils
+from tfx.types import standard_component_specs
+from tfx.utils import proto_utils
+
+NUM_SHARDS_KEY = 'num_shards'
+COMPRESSION_KEY = 'compression'
+FILE_FORMAT_KEY = 'file_format'
+# Must match vertex_configs.EXAMPLE_FORMATS
+EXAMPLE_FORMATS = ['tfrecord', 'parquet']
+# Rows buffered before writing them as a row group of a Parquet file, also the unit read by the readers
+PARQUET_ROW_GROUP_SIZE = 65536
+_ARROW_TYPES = {'float_list': pa.float32(), 'int64_list': pa.int64(), 'bytes_list': pa.binary()}
+# Values private to TFX (1.12), to be checked when upgrading it: the file name prefix of the splits of the
+# stock ExampleGen executors (write_split.DEFAULT_FILE_NAME, deprecated), and the file_format properties
+# of the examples read by tfxio_utils and Transform (write_split.to_file_format_str only knows TFRecords)
+_OUTPUT_FILE_PREFIX = 'data_tfrecord'
+_TFRECORDS_FILE_FORMAT = 'tfrecords_gzip'
+_PARQUET_FILE_FORMAT = example_gen_pb2.FileFormat.Name(example_gen_pb2.FileFormat.FILE_FORMAT_PARQUET)
+
+
+def make_custom_config(num_shards: Optional[int], compress: bool,
+                       file_format: str = 'tfrecord') -> example_gen_pb2.CustomConfig:
+    """Returns the ExampleGen custom_config read by the executors of this module."""
+    if file_format not in EXAMPLE_FORMATS:
+        raise ValueError(f"Unknown example format {file_format}. Valid formats are {EXAMPLE_FORMATS}")
+    config = struct_pb2.Struct()
+    config.update({NUM_SHARDS_KEY: num_shards or 0,
+                   COMPRESSION_KEY: 'gzip' if compress else 'none',
+                   FILE_FORMAT_KEY: file_format})
+    custom_config = example_gen_pb2.CustomConfig()
+    custom_config.custom_config.Pack(config)
+    return custom_config
+
+
+def _read_custom_config(exec_properties: Dict[str, Any]) -> Dict[str, Any]:
+    custom_config_json = exec_properties.get(standard_component_specs.CUSTOM_CONFIG_KEY)
+    if not custom_config_json:
+        return {}
+    custom_config = proto_utils.json_to_proto(custom_config_json, example_gen_pb2.CustomConfig())
+    config = struct_pb2.Struct()
+    custom_config.custom_config.Unpack(config)
+    return json_format.MessageToDict(config)
+
+
+@beam.ptransform_fn
+def _WriteShardedSplit(example_split: beam.pvalue.PCollection,
+                       output_split_path: str,
+                       num_shards: int,
+                       compress: bool) -> beam.pvalue.PDone:
+    # Downstream readers detect the compression from the file suffix. Serialized as the stock executors do,
+    # with the same num_instances counter
+    return (example_split
+            | 'MaybeSerialize' >> beam.ParDo(write_split.MaybeSerialize())
+            | 'Shuffle' >> beam.transforms.Reshuffle()
+            | 'Write' >> beam.io.WriteToTFRecord(
+                os.path.join(output_split_path, _OUTPUT_FILE_PREFIX),
+                file_name_suffix='.gz' if compress else '',
+                num_shards=num_shards,
+                compression_type=(beam.io.filesystem.CompressionTypes.GZIP if compress
+                                  else beam.io.filesystem.CompressionTypes.UNCOMPRESSED)))
+
+
+def examples_to_table(examples: List[tf.train.Example], schema: Optional[pa.Schema] = None) -> pa.Table:
+    """Returns the examples as a table with a column per feature, and nulls where a feature is missing.
+
+    Every feature has a single value, as in the tabular data of this pipeline. Without a schema,
+    the type of each column is that of the feature (float32, int64 or binary).
+    """
+    columns: Dict[str, list] = {}
+    types: Dict[str, pa.DataType] = {}
+    for n, example in enumerate(examples):
+        for name, feature in example.features.feature.items():
+            kind = feature.WhichOneof('kind')
+            values = getattr(feature, kind).value if kind else []
+            if len(values) > 1:
+                raise ValueError(f"Feature {name} has {len(values)} values, Parquet examples have a single value")
+            if name not in columns:
+                columns[name] = [None] * n
+                types[name] = _ARROW_TYPES.get(kind, pa.float32())
+            columns[name].append(values[0] if values else None)
+        for values in columns.values():
+            if len(values) == n:
+                values.append(None)
+
+    if schema is None:
+        schema = pa.schema([pa.field(name, types[name]) for name in columns])
+    unknown = set(columns) - set(schema.names)
+    if unknown:
+        raise ValueError(f"Features {sorted(unknown)} are not in the schema of the Parquet file: {schema.names}")
+    return pa.Table.from_pydict({name: columns.get(name, [None] * len(examples)) for name in schema.names},
+                                schema=schema)
+
+
+class _ParquetSink(fileio.FileSink):
+    """Writes the examples of a file in row groups, the schema is that of the first row group."""
+
+    def __init__(self, compress: bool, row_group_size: int = PARQUET_ROW_GROUP_SIZE):
+        self._compression = 'snappy' if compress else 'none'
+        self._row_group_size = row_group_size
+        self._file_handle = None
+        self._writer = None
+        self._examples = []
+
+    def open(self, fh):
+        self._file_handle = fh
+        self._writer = None
+        self._examples = []
+
+    def write(self, record):
+        example = tf.train.Example.FromString(record) if isinstance(record, bytes) else record
+        self._examples.append(example)
+        if len(self._examples) >= self._row_group_size:
+            self._write_row_group()
+
+    def flush(self):
+        if self._examples:
+            self._write_row_group()
+        if self._writer is not None:
+            self._writer.close()
+
+    def _write_row_group(self):
+        table = examples_to_table(self._examples, self._writer.schema if self._writer else None)
+        if self._writer is None:
+            self._writer = pq.ParquetWriter(self._file_handle, table.schema, compression=self._compression)
+        self._writer.write_table(table)
+        self._examples = []
+
+
+@beam.ptransform_fn
+def _WriteParquetSplit(example_split: beam.pvalue.PCollection,
+                       output_split_path: str,
+                       num_shards: int,
+                       compress: bool,
+                       temp_directory: str) -> beam.pvalue.PCollection:
+    # WriteToFiles writes to the temp directory and moves the files when complete, so retries don't duplicate rows
+    return (example_split
+            | 'Shuffle' >> beam.transforms.Reshuffle()
+            | 'Write' >> fileio.WriteToFiles(
+                output_split_path,
+                file_naming=fileio.default_file_naming(_OUTPUT_FILE_PREFIX, '.parquet'),
+                sink=lambda _: _ParquetSink(compress),
+                shards=num_shards or None,
+                temp_directory=temp_directory))
+
+
+class _ShardedOutputMixin:
+    """Same as BaseExampleGenExecutor.Do, writing the splits with _WriteShardedSplit or _WriteParquetSplit."""
+
+    # Format of the output when the custom_config does not set it
+    DEFAULT_FILE_FORMAT = 'tfrecord'
+
+    def Do(self,
+           input_dict: Dict[str, List[types.Artifact]],
+           output_dict: Dict[str, List[types.Artifact]],
+           exec_properties: Dict[str, Any]) -> None:
+        self._log_startup(input_dict, output_dict, exec_properties)
+
+        input_config = proto_utils.json_to_proto(exec_properties[standard_component_specs.INPUT_CONFIG_KEY],
+                                                 example_gen_pb2.Input())
+        output_config = proto_utils.json_to_proto(exec_properties[standard_component_specs.OUTPUT_CONFIG_KEY],
+                                                  example_gen_pb2.Output())
+        custom_config = _read_custom_config(exec_properties)
+        num_shards = int(custom_config.get(NUM_SHARDS_KEY, 0))
+        compress = custom_config.get(COMPRESSION_KEY, 'gzip') != 'none'
+        file_format = custom_config.get(FILE_FORMAT_KEY, self.DEFAULT_FILE_FORMAT)
+
+        examples_artifacts = output_dict[standard_component_specs.EXAMPLES_KEY]
+        examples_artifact = artifact_utils.get_single_instance(examples_artifacts)
+        examples_artifact.split_names = artifact_utils.encode_split_names(
+            utils.generate_output_split_names(input_config, output_config))
+
+        temp_directory = os.path.join(examples_artifact.uri, '.tmp')
+        with self._make_beam_pipeline() as pipeline:
+            example_splits = self.GenerateExamplesByBeam(pipeline, exec_properties)
+            for split_name, example_split in example_splits.items():
+                output_split_path = artifact_utils.get_split_uri(examples_artifacts, split_name)
+                if file_format == 'parquet':
+                    _ = (example_split
+                         | f'WriteSplit[{split_name}]' >> _WriteParquetSplit(
+                                output_split_path,
+                                num_shards,
+                                compress,
+                                os.path.join(temp_directory, split_name)))
+                else:
+                    _ = (example_split
+                         | f'WriteSplit[{split_name}]' >> _WriteShardedSplit(
+                                output_split_path,
+                                num_shards,
+                                compress))
+
+        if file_format == 'parquet':
+            if tf.io.gfile.exists(temp_directory):
+                tf.io.gfile.rmtree(temp_directory)
+            # The readers (TFXIO) of StatisticsGen and Transform choose the Parquet reader with these properties
+            for artifact in examples_artifacts:
+                examples_utils.set_payload_format(artifact, example_gen_pb2.PayloadFormat.FORMAT_PARQUET)
+                examples_utils.set_file_format(artifact, _PARQUET_FILE_FORMAT)
+            return
+
+        output_payload_format = exec_properties.get(standard_component_specs.OUTPUT_DATA_FORMAT_KEY)
+        if output_payload_format:
+            for artifact in examples_artifacts:
+                examples_utils.set_payload_format(artifact, output_payload_format)
+        # TFRecord readers detect the compression from the file suffix, so uncompressed files
+        # are still readable as the (only) TFRecord file format known by TFX
+        output_file_format = exec_properties.get(standard_component_specs.OUTPUT_FILE_FORMAT_KEY)
+        if output_file_format:
+            for artifact in examples_artifacts:
+                examples_utils.set_file_format(artifact, _TFRECORDS_FILE_FORMAT)
+
+
+class CsvExecutor(_ShardedOutputMixin, csv_executor.Executor):
+    pass
+
+
+class ParquetExecutor(_ShardedOutputMixin, parquet_executor.Executor):
+    pass
+
+
+class TFRecordExecutor(_ShardedOutputMixin, import_executor.Executor):
+    pass
+
+
+class ParquetBigQueryExecutor(_ShardedOutputMixin, big_query_executor.Executor):
+    """BigQueryExampleGen executor writing Parquet files (the component has no custom_config)."""
+    DEFAULT_FILE_FORMAT = 'parquet'
+
+
+class TFRecordTransformExecutor(transform_executor.Executor):
+    """Transform executor that always materializes the transformed examples as gzipped tf.Example TFRecords.
+
+    The stock executor writes them in the file format of its input examples, so Parquet
+    examples are transformed into Parquet files, while the transformed examples artifact
+    has no format properties and the Trainer and the Evaluator read it as tf.Examples.
+    The input is read with the reader of its payload format, the file format of the
+    input artifacts only chooses the format of the materialized output.
+    """
+
+    def Do(self,
+           input_dict: Dict[str, List[types.Artifact]],
+           output_dict: Dict[str, List[types.Artifact]],
+           exec_properties: Dict[str, Any]) -> None:
+        examples_artifacts = input_dict[standard_component_specs.EXAMPLES_KEY]
+        file_formats = [examples_utils.get_file_format(artifact) for artifact in examples_artifacts]
+        for artifact in examples_artifacts:
+            examples_utils.set_file_format(artifact, _TFRECORDS_FILE_FORMAT)
+        try:
+            super().Do(input_dict, output_dict, exec_properties)
+        finally:
+            for artifact, file_format in zip(examples_artifacts, file_formats):
+                examples_utils.set_file_format(artifact, file_format)
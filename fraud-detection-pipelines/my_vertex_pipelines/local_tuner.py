@@ -0,0 +1,113 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Tuner that runs the trials in parallel processes of the local machine.
+
+The stock Tuner executor runs one trial at a time and rejects TuneArgs. This
+executor follows the distributed KerasTuner protocol used by the Vertex Tuner:
+a chief oracle process hands out the trials, and num_parallel_trials tuner
+processes (one of them the executor process itself) train them concurrently.
+"""
+
+import logging
+import multiprocessing
+import os
+import socket
+from typing import Any, Dict, List
+
+from tfx import types
+from tfx.components.tuner import executor as tuner_executor
+from tfx.dsl.components.base import base_executor
+from tfx.dsl.components.base import executor_spec
+import tfx.v1 as tfx
+
+
+def _free_port() -> str:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(('127.0.0.1', 0))
+        return str(s.getsockname()[1])
+
+
+def _set_tuner_env(port: str, tuner_id: str):
+    # KerasTuner reads the distribution config from these variables
+    os.environ['KERASTUNER_ORACLE_IP'] = '127.0.0.1'
+    os.environ['KERASTUNER_ORACLE_PORT'] = port
+    os.environ['KERASTUNER_TUNER_ID'] = tuner_id
+
+
+def _run_search(input_dict: Dict[str, List[types.Artifact]],
+                exec_properties: Dict[str, Any],
+                working_dir: str,
+                port: str,
+                tuner_id: str):
+    _set_tuner_env(port, tuner_id)
+    # The chief blocks forever serving the oracle, the others return when there are no trials left
+    tuner_executor.search(input_dict, exec_properties, working_dir)
+
+
+class Executor(base_executor.BaseExecutor):
+
+    def Do(self, input_dict: Dict[str, List[types.Artifact]],
+           output_dict: Dict[str, List[types.Artifact]],
+           exec_properties: Dict[str, Any]) -> None:
+        tune_args = tuner_executor.get_tune_args(exec_properties)
+        num_parallel_trials = tune_args.num_parallel_trials if tune_args else 1
+        working_dir = self._get_tmp_dir()
+
+        if num_parallel_trials <= 1:
+            tuner = tuner_executor.search(input_dict, exec_properties, working_dir)
+            tuner_executor.write_best_hyperparameters(tuner, output_dict)
+            return
+
+        # Spawned, not forked: the executor process already runs TensorFlow and Beam threads,
+        # which a forked child would inherit in an unknown state
+        context = multiprocessing.get_context('spawn')
+        port = _free_port()
+        chief = context.Process(target=_run_search,
+                                args=(input_dict, exec_properties, working_dir, port, 'chief'))
+        chief.start()
+        logging.info(f"Chief oracle started at PID {chief.pid}, port {port}")
+
+        workers = [context.Process(target=_run_search,
+                                   args=(input_dict, exec_properties, working_dir, port, f'tuner{n}'))
+                   for n in range(1, num_parallel_trials)]
+        saved_env = {k: os.environ.get(k) for k in
+                     ('KERASTUNER_ORACLE_IP', 'KERASTUNER_ORACLE_PORT', 'KERASTUNER_TUNER_ID')}
+        try:
+            for worker in workers:
+                worker.start()
+
+            # This process is a tuner too, and asks the oracle for the best trial at the end
+            _set_tuner_env(port, 'tuner0')
+            tuner = tuner_executor.search(input_dict, exec_properties, working_dir)
+            for worker in workers:
+                worker.join()
+            failed = [w.pid for w in workers if w.exitcode != 0]
+            if failed:
+                raise RuntimeError(f"Tuner processes {failed} failed")
+            tuner_executor.write_best_hyperparameters(tuner, output_dict)
+        finally:
+            for k, v in saved_env.items():
+                if v is None:
+                    os.environ.pop(k, None)
+                else:
+                    os.environ[k] = v
+            for process in workers + [chief]:
+                if process.is_alive():
+                    process.terminate()
+
+
+class Tuner(tfx.components.Tuner):
+    """Tuner component that honors TuneArgs.num_parallel_trials in local runs."""
+
+    EXECUTOR_SPEC = executor_spec.ExecutorClassSpec(Executor)
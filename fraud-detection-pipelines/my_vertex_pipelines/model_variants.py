@@ -0,0 +1,180 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Components of the lightweight variants of the model.
+
+The trainer saves the quantized (int8, float16) and pruned variants of the model in
+its model run directory. ExportVariant turns each one into a Model artifact, with
+its size and latency, so VariantEvaluator can validate it against the float model.
+SelectVariant picks the smallest model whose evaluation is valid, which is the one
+pushed.
+
+The variants are never blessed: VariantEvaluator leaves its blessing output without
+the blessed property, and the blessing of SelectVariant names the float model of the
+Trainer. The latest blessed model resolvers, which in Vertex pipelines don't filter
+the blessings by producer, only resolve models of the Trainer.
+"""
+
+import os
+import shutil
+import tempfile
+from typing import Any, Dict, List, Optional, Tuple
+
+import tensorflow_model_analysis as tfma
+import tfx.v1 as tfx
+from tfx import types
+from tfx.components.evaluator import constants
+from tfx.components.evaluator import executor as evaluator_executor
+from tfx.dsl.components.base import executor_spec
+from tfx.types import standard_component_specs
+from tfx.utils import io_utils
+from tfx.utils import path_utils
+
+from my_vertex_pipelines import serving_utils
+
+# Must match trainer_fn.VARIANTS_DIR
+VARIANTS_DIR = 'variants'
+FLOAT_MODEL = 'float32'
+
+SIZE_PROPERTY = 'size_bytes'
+GZIP_SIZE_PROPERTY = 'gzip_size_bytes'
+LATENCY_PROPERTY = 'latency_ms'
+
+
+def _serving_model_path(model: tfx.types.standard_artifacts.Model) -> str:
+    return path_utils.serving_model_path(model.uri, path_utils.is_old_model_artifact(model))
+
+
+@tfx.dsl.components.component
+def ExportVariant(model_run: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.ModelRun],
+                  model: tfx.dsl.components.OutputArtifact[tfx.types.standard_artifacts.Model],
+                  variant: tfx.dsl.components.Parameter[str],
+                  latency_batch_size: tfx.dsl.components.Parameter[int] = 1):
+    variant_dir = os.path.join(model_run.uri, VARIANTS_DIR, variant)
+    if not tfx.dsl.io.fileio.isdir(variant_dir):
+        raise FileNotFoundError(f"The trainer did not export the {variant} variant to {variant_dir}")
+    model_dir = path_utils.serving_model_dir(model.uri)
+    io_utils.copy_dir(variant_dir, model_dir)
+
+    size, gzip_size = serving_utils.get_model_size(model_dir)
+    model.set_string_custom_property('variant', variant)
+    model.set_int_custom_property(SIZE_PROPERTY, size)
+    model.set_int_custom_property(GZIP_SIZE_PROPERTY, gzip_size)
+    model.set_float_custom_property(LATENCY_PROPERTY,
+                                    serving_utils.measure_raw_latency_ms(model_dir, latency_batch_size))
+
+
+def _is_blessed(blessing: Optional[tfx.types.standard_artifacts.ModelBlessing]) -> bool:
+    return (blessing is not None
+            and blessing.has_custom_property(constants.ARTIFACT_PROPERTY_BLESSED_KEY)
+            and blessing.get_int_custom_property(constants.ARTIFACT_PROPERTY_BLESSED_KEY) == 1)
+
+
+def _is_valid(evaluation: Optional[tfx.types.standard_artifacts.ModelEvaluation]) -> bool:
+    return evaluation is not None and tfma.load_validation_result(evaluation.uri).validation_ok
+
+
+class VariantEvaluatorExecutor(evaluator_executor.Executor):
+    """Evaluator executor that validates the model, but never blesses it.
+
+    The validation result is in the evaluation artifact. The blessing written by the
+    stock executor goes to a scratch artifact, the blessing output is left empty.
+    """
+
+    def Do(self,
+           input_dict: Dict[str, List[types.Artifact]],
+           output_dict: Dict[str, List[types.Artifact]],
+           exec_properties: Dict[str, Any]) -> None:
+        scratch_blessing = tfx.types.standard_artifacts.ModelBlessing()
+        scratch_blessing.uri = tempfile.mkdtemp()
+        try:
+            super().Do(input_dict, {**output_dict, standard_component_specs.BLESSING_KEY: [scratch_blessing]},
+                       exec_properties)
+        finally:
+            shutil.rmtree(scratch_blessing.uri, ignore_errors=True)
+
+
+class VariantEvaluator(tfx.components.Evaluator):
+    """Evaluator of a variant, see VariantEvaluatorExecutor."""
+    EXECUTOR_SPEC = executor_spec.BeamExecutorSpec(VariantEvaluatorExecutor)
+
+
+def _describe(name: str, candidate: Tuple[int, int, float]) -> str:
+    size, gzip_size, latency_ms = candidate
+    return f"{name} ({size} bytes, {gzip_size} gzipped, {latency_ms:.2f} ms)"
+
+
+def _write_blessing(blessing: tfx.types.standard_artifacts.ModelBlessing,
+                    model: tfx.types.standard_artifacts.Model,
+                    blessed: bool):
+    # Same properties as the blessing of the Evaluator, the resolvers look the model up by its id
+    file_name = constants.BLESSED_FILE_NAME if blessed else constants.NOT_BLESSED_FILE_NAME
+    io_utils.write_string_file(os.path.join(blessing.uri, file_name), '')
+    blessing.set_int_custom_property(constants.ARTIFACT_PROPERTY_BLESSED_KEY,
+                                     constants.BLESSED_VALUE if blessed else constants.NOT_BLESSED_VALUE)
+    blessing.set_string_custom_property(constants.ARTIFACT_PROPERTY_CURRENT_MODEL_URI_KEY, model.uri)
+    blessing.set_int_custom_property(constants.ARTIFACT_PROPERTY_CURRENT_MODEL_ID_KEY, model.id)
+
+
+@tfx.dsl.components.component
+def SelectVariant(model: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.Model],
+                  model_blessing: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.ModelBlessing],
+                  selected_model: tfx.dsl.components.OutputArtifact[tfx.types.standard_artifacts.Model],
+                  selected_blessing: tfx.dsl.components.OutputArtifact[tfx.types.standard_artifacts.ModelBlessing],
+                  int8_model: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.Model] = None,
+                  int8_evaluation: tfx.dsl.components.InputArtifact[
+                      tfx.types.standard_artifacts.ModelEvaluation] = None,
+                  float16_model: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.Model] = None,
+                  float16_evaluation: tfx.dsl.components.InputArtifact[
+                      tfx.types.standard_artifacts.ModelEvaluation] = None,
+                  pruned_model: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.Model] = None,
+                  pruned_evaluation: tfx.dsl.components.InputArtifact[
+                      tfx.types.standard_artifacts.ModelEvaluation] = None,
+                  latency_batch_size: tfx.dsl.components.Parameter[int] = 1
+                  ) -> tfx.dsl.components.OutputDict(variant=str, reason=str):
+    # The variants are only pushed instead of a blessed float model, never instead of no model at all
+    if not _is_blessed(model_blessing):
+        io_utils.copy_dir(_serving_model_path(model), path_utils.serving_model_dir(selected_model.uri))
+        _write_blessing(selected_blessing, model, blessed=False)
+        return {'variant': FLOAT_MODEL, 'reason': "The float model is not blessed, nothing to push"}
+
+    float_model_dir = _serving_model_path(model)
+    models = {FLOAT_MODEL: model}
+    candidates: Dict[str, Tuple[int, int, float]] = {
+        FLOAT_MODEL: (*serving_utils.get_model_size(float_model_dir),
+                      serving_utils.measure_raw_latency_ms(float_model_dir, latency_batch_size))}
+    rejected = []
+    for name, variant_model, variant_evaluation in [('int8', int8_model, int8_evaluation),
+                                                    ('float16', float16_model, float16_evaluation),
+                                                    ('pruned', pruned_model, pruned_evaluation)]:
+        if variant_model is None:
+            continue
+        if not _is_valid(variant_evaluation):
+            rejected.append(name)
+            continue
+        models[name] = variant_model
+        candidates[name] = (variant_model.get_int_custom_property(SIZE_PROPERTY),
+                            variant_model.get_int_custom_property(GZIP_SIZE_PROPERTY),
+                            variant_model.get_float_custom_property(LATENCY_PROPERTY))
+
+    # Smallest to download and load, the latencies are in the reason to check they are not worse
+    variant = min(candidates, key=lambda name: candidates[name][1])
+    io_utils.copy_dir(_serving_model_path(models[variant]), path_utils.serving_model_dir(selected_model.uri))
+    selected_model.set_string_custom_property('variant', variant)
+    # Names the float model also when a variant is pushed, the variants are never resolved as baselines
+    _write_blessing(selected_blessing, model, blessed=True)
+
+    reason = "Candidates: " + ", ".join(_describe(name, candidates[name]) for name in candidates)
+    if rejected:
+        reason += ". Not valid: " + ", ".join(rejected)
+    return {'variant': variant, 'reason': reason}
@@ -0,0 +1,78 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Cache of the compiled Vertex pipeline definitions, to skip building and compiling unchanged pipelines.
+
+The key is a hash of the arguments of the pipeline, the content of the module
+files, the source of this package and the TFX version. The id of the job is the
+only value of the definition that changes in every run: the pipeline is compiled
+with JOB_ID_PLACEHOLDER, which is replaced by the id of each job.
+"""
+
+import glob
+import hashlib
+import json
+import logging
+import os
+from importlib import metadata
+from typing import Any, Dict, List, Optional
+
+JOB_ID_PLACEHOLDER = '__FRAUD_DETECTION_JOB_ID__'
+
+_PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def _update_with_file(digest, path: str):
+    # Module files in GCS are part of the key by path only
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    else:
+        digest.update(path.encode())
+
+
+def get_cache_key(arguments: Dict[str, Any], module_files: List[str]) -> str:
+    digest = hashlib.sha256()
+    digest.update(json.dumps(arguments, sort_keys=True, default=str).encode())
+    for path in module_files + sorted(glob.glob(os.path.join(_PACKAGE_DIR, '*.py'))):
+        _update_with_file(digest, path)
+    try:
+        digest.update(metadata.version('tfx').encode())
+    except metadata.PackageNotFoundError:
+        pass
+    return digest.hexdigest()
+
+
+def _get_cache_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, f"{key}.json")
+
+
+def load(cache_dir: str, key: str, job_id: str) -> Optional[str]:
+    """Returns the cached pipeline definition for the key with the id of the job, or None if not cached."""
+    path = _get_cache_path(cache_dir, key)
+    if not os.path.exists(path):
+        return None
+    logging.info(f"Using the compiled pipeline definition {path}")
+    with open(path) as f:
+        return f.read().replace(JOB_ID_PLACEHOLDER, job_id)
+
+
+def save(cache_dir: str, key: str, pipeline_definition: str):
+    """Caches a pipeline definition compiled with JOB_ID_PLACEHOLDER as the id of the job."""
+    os.makedirs(cache_dir, exist_ok=True)
+    path = _get_cache_path(cache_dir, key)
+    # Written to a temporary file first, so concurrent launches never read a partial definition
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        f.write(pipeline_definition)
+    os.replace(tmp_path, path)
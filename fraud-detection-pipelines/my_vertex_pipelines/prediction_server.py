@@ -0,0 +1,277 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Local prediction server with micro-batching for the models pushed to SERVING_MODEL_DIR.
+
+Clients connect over TCP and send one JSON object per line, with the raw
+features of one transaction ({"V1": ..., "V28": ..., "Amount": ...}). The server
+replies with one JSON line per request: {"score": ..., "model_version": ...}.
+A line {"stats": true} returns the latency and throughput stats instead.
+
+Concurrent requests are grouped in batches of up to max_batch_size, waiting at
+most max_wait_ms for a batch to fill, and scored with the serving_raw signature.
+The server loads newer model versions as they are pushed and swaps them in
+without dropping requests: batches already running finish with the old model.
+A request without one of the features of the model gets an error reply, the
+other requests of its batch are still scored. On shutdown, the queued and
+running batches are scored before the inference threads stop.
+
+    python -m my_vertex_pipelines.prediction_server --port=8500 --max-batch-size=64 --max-wait-ms=2
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import logging
+import time
+from typing import Any, Dict, List, NamedTuple, Optional, Set
+
+import numpy as np
+import tensorflow as tf
+
+from my_vertex_pipelines import serving_utils
+from my_vertex_pipelines import vertex_configs
+
+
+class LoadedModel(NamedTuple):
+    version: str
+    raw_fn: Any
+    raw_feature_keys: List[str]
+
+
+def load_model(base_dir: str, version: str) -> LoadedModel:
+    model = serving_utils.load_model(f"{base_dir.rstrip('/')}/{version}")
+    raw_fn = model.signatures[serving_utils.RAW_TENSOR_SIGNATURE]
+    raw_feature_keys = serving_utils.get_raw_feature_keys(model)
+    # Trace and warm up before the model receives traffic
+    raw_fn(features=tf.zeros([1, len(raw_feature_keys)], tf.float32))
+    return LoadedModel(version=version, raw_fn=raw_fn, raw_feature_keys=raw_feature_keys)
+
+
+class LatencyStats:
+    """Keeps the latencies of the last requests and counts the requests since the start."""
+
+    def __init__(self, window: int = 100000):
+        self._window = window
+        self._latencies: List[float] = []
+        self._batch_sizes: List[int] = []
+        self._start = time.perf_counter()
+        self._count = 0
+
+    def record_request(self, latency_secs: float):
+        self._count += 1
+        self._latencies.append(latency_secs)
+        if len(self._latencies) > self._window:
+            del self._latencies[:len(self._latencies) - self._window]
+
+    def record_batch(self, batch_size: int):
+        self._batch_sizes.append(batch_size)
+        if len(self._batch_sizes) > self._window:
+            del self._batch_sizes[:len(self._batch_sizes) - self._window]
+
+    def summary(self) -> Dict[str, float]:
+        latencies = np.array(self._latencies) if self._latencies else np.zeros(1)
+        return {'requests': self._count,
+                'requests_per_sec': self._count / (time.perf_counter() - self._start),
+                'p50_ms': float(np.percentile(latencies, 50) * 1000),
+                'p99_ms': float(np.percentile(latencies, 99) * 1000),
+                'mean_batch_size': float(np.mean(self._batch_sizes)) if self._batch_sizes else 0.0}
+
+
+class MicroBatchingPredictor:
+    """Groups concurrent predict calls in batches and scores them with the current model."""
+
+    def __init__(self,
+                 base_dir: str,
+                 max_batch_size: int = 64,
+                 max_wait_ms: float = 2.0,
+                 poll_secs: float = 10.0,
+                 num_inference_threads: int = 1):
+        self._base_dir = base_dir
+        self._max_batch_size = max_batch_size
+        self._max_wait_secs = max_wait_ms / 1000
+        self._poll_secs = poll_secs
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=num_inference_threads)
+        self._inference_slots = asyncio.Semaphore(num_inference_threads)
+        self._queue: Optional[asyncio.Queue] = None
+        self._batching_task: Optional[asyncio.Task] = None
+        self._watch_task: Optional[asyncio.Task] = None
+        # The event loop only keeps weak references to the tasks, a running batch must not be collected
+        self._score_tasks: Set[asyncio.Task] = set()
+        self._stopping = False
+        self.model: Optional[LoadedModel] = None
+        self.stats = LatencyStats()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue()
+        versions = serving_utils.get_model_versions(self._base_dir)
+        if not versions:
+            raise FileNotFoundError(f"No model versions found in {self._base_dir}, "
+                                    f"the server needs a model pushed there first")
+        self.model = await loop.run_in_executor(None, load_model, self._base_dir, versions[-1])
+        logging.info(f"Serving model version {versions[-1]}")
+        self._batching_task = asyncio.create_task(self._batching_loop())
+        self._watch_task = asyncio.create_task(self._watch_versions())
+
+    async def stop(self):
+        # New requests are rejected, the queued ones are batched and scored before the threads stop
+        self._stopping = True
+        self._watch_task.cancel()
+        await self._queue.join()
+        self._batching_task.cancel()
+        await asyncio.gather(self._watch_task, self._batching_task, *self._score_tasks, return_exceptions=True)
+        self._executor.shutdown(wait=True)
+
+    async def predict(self, features: Dict[str, float]) -> Dict[str, Any]:
+        if self._stopping:
+            raise RuntimeError("The server is stopping")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((features, future, time.perf_counter()))
+        return await future
+
+    async def _watch_versions(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self._poll_secs)
+            try:
+                versions = serving_utils.get_model_versions(self._base_dir)
+                if versions and int(versions[-1]) > int(self.model.version):
+                    # Load and warm up outside the event loop, then swap: new batches use the new model
+                    new_model = await loop.run_in_executor(None, load_model, self._base_dir, versions[-1])
+                    self.model = new_model
+                    logging.info(f"Serving model version {new_model.version}")
+            except Exception:
+                logging.exception("Could not load the latest model version, keeping the current one")
+
+    async def _batching_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self._max_wait_secs
+            while len(batch) < self._max_batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Wait for a free inference thread, the next batch keeps filling in the meantime
+            await self._inference_slots.acquire()
+            task = asyncio.create_task(self._score(batch, self.model))
+            self._score_tasks.add(task)
+            task.add_done_callback(self._score_tasks.discard)
+
+    async def _score(self, batch, model: LoadedModel):
+        try:
+            # Requests without all the features fail alone, they are not scored with made up values
+            valid, rows = [], []
+            for features, future, received in batch:
+                missing = [k for k in model.raw_feature_keys if k not in features]
+                try:
+                    if missing:
+                        raise ValueError(f"Missing features {missing}, model version {model.version} "
+                                         f"needs {model.raw_feature_keys}")
+                    rows.append([float(features[k]) for k in model.raw_feature_keys])
+                    valid.append((future, received))
+                except (TypeError, ValueError) as e:
+                    if not future.done():
+                        future.set_exception(ValueError(str(e)))
+            if not valid:
+                return
+            dense = np.array(rows, dtype=np.float32)
+            scores = await asyncio.get_running_loop().run_in_executor(self._executor, _run_model, model, dense)
+            now = time.perf_counter()
+            self.stats.record_batch(len(valid))
+            for (future, received), score in zip(valid, scores):
+                self.stats.record_request(now - received)
+                if not future.done():
+                    future.set_result({'score': float(score), 'model_version': model.version})
+        except Exception as e:
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self._inference_slots.release()
+            for _ in batch:
+                self._queue.task_done()
+
+
+def _run_model(model: LoadedModel, dense: np.ndarray) -> np.ndarray:
+    outputs = model.raw_fn(features=tf.constant(dense))
+    return next(iter(outputs.values())).numpy().reshape(-1)
+
+
+async def _handle_connection(predictor: MicroBatchingPredictor, reader: asyncio.StreamReader,
+                             writer: asyncio.StreamWriter):
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                request = json.loads(line)
+                if request.get('stats'):
+                    response = predictor.stats.summary()
+                else:
+                    response = await predictor.predict(request)
+            except Exception as e:
+                response = {'error': str(e)}
+            writer.write(json.dumps(response).encode() + b'\n')
+            await writer.drain()
+    finally:
+        writer.close()
+
+
+async def serve(base_dir: str, host: str, port: int, max_batch_size: int, max_wait_ms: float,
+                poll_secs: float, num_inference_threads: int, stats_interval_secs: float = 30.0):
+    predictor = MicroBatchingPredictor(base_dir=base_dir,
+                                       max_batch_size=max_batch_size,
+                                       max_wait_ms=max_wait_ms,
+                                       poll_secs=poll_secs,
+                                       num_inference_threads=num_inference_threads)
+    await predictor.start()
+    server = await asyncio.start_server(lambda r, w: _handle_connection(predictor, r, w), host, port)
+    logging.info(f"Listening on {host}:{port}")
+    try:
+        async with server:
+            while True:
+                await asyncio.sleep(stats_interval_secs)
+                logging.info(f"Stats: {predictor.stats.summary()}")
+    finally:
+        await predictor.stop()
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model-dir", default=vertex_configs.SERVING_MODEL_DIR,
+                        help="Directory where the Pusher writes the model versions")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8500)
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    parser.add_argument("--max-wait-ms", type=float, default=2.0)
+    parser.add_argument("--poll-secs", type=float, default=10.0, help="How often to look for new model versions")
+    parser.add_argument("--num-inference-threads", type=int, default=1)
+    args = parser.parse_args()
+
+    asyncio.run(serve(base_dir=args.model_dir,
+                      host=args.host,
+                      port=args.port,
+                      max_batch_size=args.max_batch_size,
+                      max_wait_ms=args.max_wait_ms,
+                      poll_secs=args.poll_secs,
+                      num_inference_threads=args.num_inference_threads))
@@ -0,0 +1,101 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Components of the sampled evaluation mode.
+
+StratifiedSample keeps all the fraud examples of the eval split and a deterministic
+sample of the rest, weighted so the weighted metrics estimate those of the full split.
+EvaluationGate looks at the confidence interval of the metric of the evaluation of
+that sample, and asks for the full evaluation only if the interval is near the
+blessing threshold.
+"""
+
+import hashlib
+import os
+
+import apache_beam as beam
+import tensorflow as tf
+import tensorflow_model_analysis as tfma
+import tfx.v1 as tfx
+from tfx.components.util import examples_utils
+from tfx.types import artifact_utils
+
+LABEL_KEY = 'Class'
+SAMPLE_WEIGHT_KEY = 'sample_weight'
+EVAL_SPLIT = 'eval'
+
+
+def _sample(record: bytes, sample_rate: float):
+    example = tf.train.Example.FromString(record)
+    label = example.features.feature[LABEL_KEY]
+    label_values = list(label.int64_list.value) or list(label.float_list.value)
+    if label_values and label_values[0] == 1:
+        weight = 1.0
+    else:
+        # Deterministic: the same example is always either in or out of the sample
+        fraction = int.from_bytes(hashlib.md5(record).digest()[:8], 'big') / 2 ** 64
+        if fraction >= sample_rate:
+            return
+        weight = 1.0 / sample_rate
+    example.features.feature[SAMPLE_WEIGHT_KEY].float_list.value[:] = [weight]
+    yield example.SerializeToString()
+
+
+@tfx.dsl.components.component(use_beam=True)
+def StratifiedSample(examples: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.Examples],
+                     sampled_examples: tfx.dsl.components.OutputArtifact[tfx.types.standard_artifacts.Examples],
+                     sample_rate: tfx.dsl.components.Parameter[float] = 0.1,
+                     beam_pipeline: tfx.dsl.components.BeamComponentParameter[beam.Pipeline] = None):
+    input_pattern = os.path.join(artifact_utils.get_split_uri([examples], EVAL_SPLIT), '*')
+    output_prefix = os.path.join(sampled_examples.uri, f'Split-{EVAL_SPLIT}', 'data_tfrecord')
+    with beam_pipeline as p:
+        _ = (p
+             | 'ReadExamples' >> beam.io.ReadFromTFRecord(input_pattern)
+             | 'Sample' >> beam.FlatMap(_sample, sample_rate=sample_rate)
+             | 'WriteExamples' >> beam.io.WriteToTFRecord(output_prefix, file_name_suffix='.gz'))
+    sampled_examples.split_names = artifact_utils.encode_split_names([EVAL_SPLIT])
+    examples_utils.set_payload_format(sampled_examples, examples_utils.get_payload_format(examples))
+
+
+def _get_overall_metric(evaluation_uri: str, metric_name: str):
+    """Returns the value and the confidence interval of the metric of the candidate model, for all the data."""
+    for metrics_for_slice in tfma.load_metrics(evaluation_uri):
+        if metrics_for_slice.slice_key.single_slice_keys:
+            continue
+        for key_and_value in metrics_for_slice.metric_keys_and_values:
+            key = key_and_value.key
+            if key.name != metric_name or key.is_diff or key.model_name not in ('', 'candidate'):
+                continue
+            value = key_and_value.value.double_value.value
+            if key_and_value.value.HasField('confidence_interval'):
+                interval = key_and_value.value.confidence_interval
+                return value, interval.lower_bound.double_value.value, interval.upper_bound.double_value.value
+            return value, value, value
+    return None
+
+
+@tfx.dsl.components.component
+def EvaluationGate(evaluation: tfx.dsl.components.InputArtifact[tfx.types.standard_artifacts.ModelEvaluation],
+                   threshold: tfx.dsl.components.Parameter[float],
+                   margin: tfx.dsl.components.Parameter[float] = 0.01,
+                   metric_name: tfx.dsl.components.Parameter[str] = 'binary_accuracy'
+                   ) -> tfx.dsl.components.OutputDict(full_evaluation=int, reason=str):
+    metric = _get_overall_metric(evaluation.uri, metric_name)
+    if metric is None:
+        return {'full_evaluation': 1, 'reason': f"{metric_name} not found in the sampled evaluation"}
+
+    value, lower, upper = metric
+    summary = f"sampled {metric_name} {value:.4f} [{lower:.4f}, {upper:.4f}], threshold {threshold}"
+    if lower - margin <= threshold <= upper + margin:
+        return {'full_evaluation': 1, 'reason': f"Near the threshold: {summary}"}
+    return {'full_evaluation': 0, 'reason': f"Far from the threshold: {summary}"}
@@ -0,0 +1,100 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Helpers to load and call the models pushed to a filesystem destination."""
+
+import gzip
+import os
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+import tensorflow as tf
+
+try:
+    # Registers the ops of the gradient boosted trees models (trainer_gbt_fn.py), needed to load them
+    import tensorflow_decision_forests  # noqa: F401
+except ImportError:
+    pass
+
+RAW_TENSOR_SIGNATURE = 'serving_raw'
+EXAMPLES_SIGNATURE = 'serving_default'
+FEATURE_KEYS_SIGNATURE = 'feature_keys'
+
+
+def get_model_versions(base_dir: str) -> List[str]:
+    """Returns the model versions pushed to base_dir, oldest first.
+
+    The Pusher writes every model to a subdirectory named with the push timestamp.
+    """
+    if not tf.io.gfile.isdir(base_dir):
+        return []
+    versions = [v.rstrip('/') for v in tf.io.gfile.listdir(base_dir) if v.rstrip('/').isdigit()]
+    return sorted(versions, key=int)
+
+
+def get_latest_model_dir(base_dir: str) -> str:
+    versions = get_model_versions(base_dir)
+    if not versions:
+        raise FileNotFoundError(f"No model versions found in {base_dir}")
+    return os.path.join(base_dir, versions[-1])
+
+
+def load_model(model_dir: str):
+    """Loads a SavedModel of either trainer engine, the TF-DF ops are registered if the package is installed."""
+    return tf.saved_model.load(model_dir)
+
+
+def get_raw_feature_keys(model) -> List[str]:
+    """Returns the order of the columns of the raw tensor signature of the model."""
+    keys = model.signatures[FEATURE_KEYS_SIGNATURE]()['raw_feature_keys'].numpy()
+    return [k.decode() for k in keys]
+
+
+def rows_to_tf_examples(rows: Dict[str, np.ndarray]) -> List[bytes]:
+    """Serializes columns of float values as tf.Examples, like a client of the Example signature does."""
+    num_rows = len(next(iter(rows.values())))
+    examples = []
+    for n in range(num_rows):
+        feature = {k: tf.train.Feature(float_list=tf.train.FloatList(value=[v[n]])) for k, v in rows.items()}
+        examples.append(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+    return examples
+
+
+def get_model_size(model_dir: str) -> Tuple[int, int]:
+    """Returns the size of the files of a SavedModel, and their size compressed with gzip.
+
+    The compressed size is what matters to download the model, and the only one smaller for a pruned model.
+    """
+    size, gzip_size = 0, 0
+    for dir_name, _, file_names in tf.io.gfile.walk(model_dir):
+        for file_name in file_names:
+            with tf.io.gfile.GFile(os.path.join(dir_name, file_name), 'rb') as f:
+                content = f.read()
+            size += len(content)
+            gzip_size += len(gzip.compress(content))
+    return size, gzip_size
+
+
+def measure_raw_latency_ms(model_dir: str, batch_size: int = 1, iterations: int = 100) -> float:
+    """Returns the median latency of the raw tensor signature of a SavedModel, in milliseconds."""
+    model = load_model(model_dir)
+    raw_fn = model.signatures[RAW_TENSOR_SIGNATURE]
+    features = tf.zeros([batch_size, len(get_raw_feature_keys(model))], dtype=tf.float32)
+    raw_fn(features=features)  # warm up
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        raw_fn(features=features)
+        latencies.append(time.perf_counter() - start)
+    return float(np.median(latencies) * 1000)
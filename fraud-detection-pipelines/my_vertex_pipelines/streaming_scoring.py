@@ -0,0 +1,219 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Streaming scoring of transactions, with the velocity features of each card kept in Beam state.
+
+Every transaction gets the velocity features of its card (see velocity_features),
+computed with the transactions of the card in the state, and is scored in
+micro-batches of up to --batch-size transactions, waiting at most --max-wait-ms
+for a batch to fill. The state of a card is dropped when it has no transactions
+in the largest window. The bounded sources (memory and file) are not read in
+time order, their transactions are replayed in time order per card like in the
+training data (velocity_features.AddVelocityFeatures) instead of using the state.
+
+Sources:
+  * memory:N: N synthetic transactions, for local tests and benchmarks.
+  * file:PATTERN: files with a JSON transaction per line.
+  * pubsub:SUBSCRIPTION: JSON transactions, the production source (streaming).
+    The publishers set the Time of the transaction, in milliseconds since the epoch
+    (Time * 1000), in the PUBSUB_TIMESTAMP_ATTRIBUTE attribute, the event time.
+
+Sinks:
+  * log: logs the transactions with a score above --alert-threshold.
+  * pubsub:TOPIC: publishes every scored transaction as JSON.
+
+    python -m my_vertex_pipelines.streaming_scoring --source=pubsub:projects/p/subscriptions/s \
+        --sink=pubsub:projects/p/topics/t --runner=DataflowRunner ...
+"""
+
+import argparse
+import json
+import logging
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import apache_beam as beam
+from apache_beam.coders import PickleCoder
+from apache_beam.metrics import Metrics
+from apache_beam.options.pipeline_options import PipelineOptions, StandardOptions
+from apache_beam.runners.runner import PipelineResult
+from apache_beam.transforms.timeutil import TimeDomain
+from apache_beam.transforms.userstate import ReadModifyWriteStateSpec, TimerSpec, on_timer
+from apache_beam.utils.timestamp import Duration, Timestamp
+
+from my_vertex_pipelines import batch_scoring
+from my_vertex_pipelines import serving_utils
+from my_vertex_pipelines import synthetic_data
+from my_vertex_pipelines import vertex_configs
+from my_vertex_pipelines import velocity_features
+
+METRICS_NAMESPACE = 'streaming_scoring'
+# Wall time when the transaction entered the pipeline, removed before the sink
+RECEIVED_AT_KEY = '_received_at'
+# Attribute of the Pub/Sub messages with the event time, like the Time of the bounded sources
+PUBSUB_TIMESTAMP_ATTRIBUTE = 'event_time'
+
+
+class _VelocityFeaturesFn(beam.DoFn):
+    """Adds the velocity features to the transactions of a card, with the recent transactions in the state."""
+
+    HISTORY = ReadModifyWriteStateSpec('history', PickleCoder())
+    EXPIRY = TimerSpec('expiry', TimeDomain.WATERMARK)
+
+    def process(self,
+                element: Tuple[Any, Dict[str, Any]],
+                history=beam.DoFn.StateParam(HISTORY),
+                expiry=beam.DoFn.TimerParam(EXPIRY)) -> Iterable[Dict[str, Any]]:
+        _, row = element
+        time_value, amount = row[velocity_features.TIME_KEY], row[velocity_features.AMOUNT_KEY]
+        updated, features = velocity_features.add_transaction(history.read() or [], time_value, amount)
+        history.write(updated)
+        # Bounded state: drop the card when no transaction arrives in the largest window of the newest one
+        # (the last of the history), so a late transaction never moves the expiry earlier
+        expiry.set(Timestamp.of(updated[-1][0]) + Duration(seconds=max(velocity_features.WINDOWS_SECONDS)))
+        yield {**row, **features}
+
+    @on_timer(EXPIRY)
+    def expire(self, history=beam.DoFn.StateParam(HISTORY)):
+        history.clear()
+
+
+def _record_latency(row: Dict[str, Any]) -> Dict[str, Any]:
+    row = dict(row)
+    received_at = row.pop(RECEIVED_AT_KEY)
+    Metrics.distribution(METRICS_NAMESPACE, 'latency_ms').update(
+        int((time.time() - received_at) * 1000))
+    return row
+
+
+@beam.ptransform_fn
+def ScoreTransactions(transactions: beam.pvalue.PCollection,
+                      model_dir: str,
+                      batch_size: int = vertex_configs.STREAM_BATCH_SIZE,
+                      max_wait_ms: int = vertex_configs.STREAM_MAX_WAIT_MS,
+                      num_shards: int = vertex_configs.STREAM_NUM_SHARDS,
+                      bounded: bool = False) -> beam.pvalue.PCollection:
+    """Adds the velocity features and the score of the model to every transaction.
+
+    The input can be any PCollection of transaction dicts (beam.Create or TestStream in tests).
+    With bounded, the transactions of each card are sorted by time before computing the features.
+    """
+    transactions = transactions | 'SetReceivedAt' >> beam.Map(lambda row: {**row, RECEIVED_AT_KEY: time.time()})
+    if bounded:
+        with_features = transactions | 'VelocityFeatures' >> velocity_features.AddVelocityFeatures()
+    else:
+        with_features = (transactions
+                         | 'KeyByEntity' >> beam.Map(lambda row: (row[velocity_features.ENTITY_KEY], row))
+                         | 'VelocityFeatures' >> beam.ParDo(_VelocityFeaturesFn()))
+    return (with_features
+            # Micro-batches per shard, so several workers score in parallel
+            | 'KeyByShard' >> beam.Map(lambda row: (hash(row[velocity_features.ENTITY_KEY]) % num_shards, row))
+            | 'MicroBatch' >> beam.GroupIntoBatches(batch_size, max_buffering_duration_secs=max_wait_ms / 1000)
+            | 'DropShard' >> beam.Map(lambda shard_and_rows: list(shard_and_rows[1]))
+            | 'Score' >> beam.ParDo(batch_scoring.ScoreBatch(model_dir))
+            | 'RecordLatency' >> beam.Map(_record_latency))
+
+
+def _synthetic_transactions(num_rows: int, num_cards: int) -> Iterable[Dict[str, Any]]:
+    columns = synthetic_data.generate_chunk(num_rows, first_row=0, seed=0, num_cards=num_cards)
+    for n in range(num_rows):
+        yield {k: v[n].item() for k, v in columns.items()}
+
+
+def read_transactions(p: beam.Pipeline, source: str, num_cards: int = 1000) -> beam.pvalue.PCollection:
+    """Returns the transactions of the source, with the Time of the transaction as event time."""
+    kind, _, location = source.partition(':')
+    if kind == 'memory':
+        rows = p | 'ReadMemory' >> beam.Create(list(_synthetic_transactions(int(location), num_cards)))
+    elif kind == 'file':
+        rows = (p
+                | 'ReadFiles' >> beam.io.ReadFromText(location)
+                | 'ParseJson' >> beam.Map(json.loads))
+    elif kind == 'pubsub':
+        # The event time is the Time of the transaction set by the publisher, not the publish time
+        return (p
+                | 'ReadPubSub' >> beam.io.ReadFromPubSub(subscription=location,
+                                                         timestamp_attribute=PUBSUB_TIMESTAMP_ATTRIBUTE)
+                | 'ParseJson' >> beam.Map(json.loads))
+    else:
+        raise ValueError(f"Unknown source {source}. Valid sources are memory:N, file:PATTERN, pubsub:SUBSCRIPTION")
+    return rows | 'SetEventTime' >> beam.Map(
+        lambda row: beam.window.TimestampedValue(row, row[velocity_features.TIME_KEY]))
+
+
+def write_scores(scores: beam.pvalue.PCollection, sink: str, alert_threshold: float):
+    kind, _, location = sink.partition(':')
+    if kind == 'log':
+        _ = (scores
+             | 'FilterAlerts' >> beam.Filter(lambda row: row[batch_scoring.SCORE_COLUMN] >= alert_threshold)
+             | 'LogAlerts' >> beam.Map(lambda row: logging.info(f"Fraud alert: {json.dumps(row)}")))
+    elif kind == 'pubsub':
+        _ = (scores
+             | 'ToJson' >> beam.Map(lambda row: json.dumps(row).encode())
+             | 'WritePubSub' >> beam.io.WriteToPubSub(topic=location))
+    else:
+        raise ValueError(f"Unknown sink {sink}. Valid sinks are log, pubsub:TOPIC")
+
+
+def run(source: str,
+        sink: str,
+        model_dir: str,
+        batch_size: int = vertex_configs.STREAM_BATCH_SIZE,
+        max_wait_ms: int = vertex_configs.STREAM_MAX_WAIT_MS,
+        num_shards: int = vertex_configs.STREAM_NUM_SHARDS,
+        alert_threshold: float = 0.5,
+        num_cards: int = 1000,
+        beam_pipeline_args: Optional[List[str]] = None) -> PipelineResult:
+    options = PipelineOptions(beam_pipeline_args or [])
+    bounded = not source.startswith('pubsub:')
+    if not bounded:
+        options.view_as(StandardOptions).streaming = True
+
+    p = beam.Pipeline(options=options)
+    scores = (read_transactions(p, source, num_cards)
+              | 'ScoreTransactions' >> ScoreTransactions(model_dir=model_dir,
+                                                         batch_size=batch_size,
+                                                         max_wait_ms=max_wait_ms,
+                                                         num_shards=num_shards,
+                                                         bounded=bounded))
+    write_scores(scores, sink, alert_threshold)
+    result = p.run()
+    result.wait_until_finish()
+    return result
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--source", required=True, help="memory:N, file:PATTERN or pubsub:SUBSCRIPTION")
+    parser.add_argument("--sink", default="log", help="log or pubsub:TOPIC")
+    parser.add_argument("--model-dir", required=False,
+                        help="SavedModel to score with (default: latest version in SERVING_MODEL_DIR)")
+    parser.add_argument("--batch-size", type=int, default=vertex_configs.STREAM_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=int, default=vertex_configs.STREAM_MAX_WAIT_MS)
+    parser.add_argument("--num-shards", type=int, default=vertex_configs.STREAM_NUM_SHARDS,
+                        help="Micro-batches are formed per shard, scored in parallel")
+    parser.add_argument("--alert-threshold", type=float, default=0.5, help="Score of the alerts of the log sink")
+    parser.add_argument("--num-cards", type=int, default=1000, help="Cards of the memory source")
+    args, beam_args = parser.parse_known_args()
+
+    run(source=args.source,
+        sink=args.sink,
+        model_dir=args.model_dir or serving_utils.get_latest_model_dir(vertex_configs.SERVING_MODEL_DIR),
+        batch_size=args.batch_size,
+        max_wait_ms=args.max_wait_ms,
+        num_shards=args.num_shards,
+        alert_threshold=args.alert_threshold,
+        num_cards=args.num_cards,
+        beam_pipeline_args=beam_args)
@@ -0,0 +1,244 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Launches a sweep of variants of the pipeline in Vertex and waits for all of them.
+
+The variants are compiled in parallel processes, submitted concurrently (at most
+--max-concurrent-submissions at a time) and their states are polled with
+exponential backoff. A summary with the timings and the final state of every
+variant is printed at the end. The sweep is a JSON file with the arguments of
+fraud_detection_main.main shared by all the variants, and the arguments of each
+variant. They are checked and completed like the flags of the CLI (see
+fraud_detection_main.resolve_arguments), so "split_ratio": "3:1" or
+"trainer_engine" work as the flags do, and an invalid variant stops the sweep
+before any compilation:
+
+    {"base": {"project_id": "my-project", "region": "europe-west4", "pipeline_root": "gs://...",
+              "pipeline_name": "fraud-detect-pipeline", "query": "SELECT ...",
+              "transform_fn_file": "...", "trainer_fn_file": "...", "temp_location": "gs://...",
+              "service_account": "..."},
+     "variants": [{"name": "one-epoch"}, {"name": "two-epochs", "epochs": 2}]}
+
+    python -m my_vertex_pipelines.sweep_launcher --sweep=sweep.json
+
+With --fake-client, the jobs are not submitted to Vertex, a local fake runs them.
+"""
+
+import argparse
+import asyncio
+import concurrent.futures
+import dataclasses
+import functools
+import json
+import logging
+import random
+import re
+import threading
+import time
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+from my_vertex_pipelines import fraud_detection_main
+
+# Arguments of fraud_detection_main.main that the CLI derives from its flags
+DEFAULT_ARGUMENTS = {
+    'running_locally': False,
+    'use_dataflow': False,
+    'query': None,
+    'service_account_dataflow': None,
+    'dataflow_network': None,
+    'packed_features': False,
+    'fused_analyzers': False,
+    'input_config': {},
+}
+
+SUCCEEDED = 'SUCCEEDED'
+TERMINAL_STATES = [SUCCEEDED, 'FAILED', 'CANCELLED']
+
+
+class VertexClient:
+    """Submits the pipeline jobs to Vertex and gets their states."""
+
+    def __init__(self):
+        # aiplatform.init sets global defaults, the jobs are created one at a time
+        self._create_lock = threading.Lock()
+
+    def submit(self, variant: 'Variant', pipeline_definition: str):
+        from my_vertex_pipelines import vertex_run
+
+        arguments = variant.arguments
+        with self._create_lock:
+            job = vertex_run.create_job(project_id=arguments['project_id'],
+                                        region=arguments['region'],
+                                        pipeline_definition=pipeline_definition,
+                                        pipeline_name=arguments['pipeline_name'],
+                                        experiment_name=variant.experiment_name,
+                                        job_id=variant.job_id)
+        job.submit(service_account=arguments['service_account'], experiment=variant.experiment_name)
+        return job
+
+    def get_state(self, job) -> str:
+        # PIPELINE_STATE_SUCCEEDED -> SUCCEEDED
+        return job.state.name.replace('PIPELINE_STATE_', '')
+
+
+class FakeClient:
+    """Runs every job for a random time locally, to try the launcher without Vertex."""
+
+    def __init__(self, min_secs: float = 1.0, max_secs: float = 5.0, failure_rate: float = 0.0, seed: int = 0):
+        self._min_secs = min_secs
+        self._max_secs = max_secs
+        self._failure_rate = failure_rate
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def submit(self, variant: 'Variant', pipeline_definition: str):
+        with self._lock:
+            duration = self._rng.uniform(self._min_secs, self._max_secs)
+            failed = self._rng.random() < self._failure_rate
+        return {'end': time.time() + duration, 'final_state': 'FAILED' if failed else SUCCEEDED}
+
+    def get_state(self, job) -> str:
+        return job['final_state'] if time.time() >= job['end'] else 'RUNNING'
+
+
+@dataclasses.dataclass
+class Variant:
+    name: str
+    arguments: Dict[str, Any]
+    job_id: str
+    experiment_name: str
+    state: str = 'PENDING'
+    error: Optional[str] = None
+    compile_secs: float = 0.0
+    submit_secs: float = 0.0
+    run_secs: float = 0.0
+
+
+def load_variants(sweep: Dict[str, Any]) -> List[Variant]:
+    this_moment = datetime.now().strftime("%Y%m%d%H%M%S")
+    variants = []
+    for variant in sweep['variants']:
+        variant = dict(variant)
+        name = variant.pop('name')
+        try:
+            arguments = fraud_detection_main.resolve_arguments({**DEFAULT_ARGUMENTS, **sweep.get('base', {}),
+                                                                **variant})
+        except ValueError as e:
+            raise ValueError(f"Variant {name}: {e}") from e
+        # Vertex job ids only have lowercase letters, digits and dashes
+        job_id = re.sub('[^a-z0-9-]', '-', f"{arguments['pipeline_name']}-{name}-{this_moment}".lower())
+        variants.append(Variant(name=name,
+                                arguments=arguments,
+                                job_id=job_id,
+                                experiment_name=fraud_detection_main.get_experiment_name(arguments['pipeline_name'])))
+    if len({v.job_id for v in variants}) != len(variants):
+        raise ValueError("The names of the variants must be unique")
+    return variants
+
+
+def _compile(arguments: Dict[str, Any], job_id: str) -> str:
+    # Runs in a separate process, TFX is imported and the pipeline compiled there
+    return fraud_detection_main.main(**arguments, job_id=job_id, submit=False)
+
+
+async def _wait(client, variant: Variant, job, initial_poll_secs: float, max_poll_secs: float):
+    loop = asyncio.get_running_loop()
+    poll_secs = initial_poll_secs
+    while True:
+        state = await loop.run_in_executor(None, client.get_state, job)
+        if state != variant.state:
+            logging.info(f"{variant.name}: {state}")
+            variant.state = state
+        if state in TERMINAL_STATES:
+            return
+        # Exponential backoff with jitter, so the polls of the variants do not align
+        await asyncio.sleep(poll_secs * random.uniform(0.8, 1.2))
+        poll_secs = min(poll_secs * 2, max_poll_secs)
+
+
+async def _run_variant(client, variant: Variant, compile_pool: concurrent.futures.Executor,
+                       submissions: asyncio.Semaphore, initial_poll_secs: float, max_poll_secs: float):
+    loop = asyncio.get_running_loop()
+    try:
+        variant.state = 'COMPILING'
+        start = time.perf_counter()
+        pipeline_definition = await loop.run_in_executor(
+            compile_pool, functools.partial(_compile, variant.arguments, variant.job_id))
+        variant.compile_secs = time.perf_counter() - start
+
+        async with submissions:
+            variant.state = 'SUBMITTING'
+            start = time.perf_counter()
+            job = await loop.run_in_executor(None, client.submit, variant, pipeline_definition)
+            variant.submit_secs = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await _wait(client, variant, job, initial_poll_secs, max_poll_secs)
+        variant.run_secs = time.perf_counter() - start
+    except Exception as e:  # One variant failing does not stop the others
+        logging.exception(f"{variant.name} failed in state {variant.state}")
+        variant.error = f"{type(e).__name__}: {e}"
+        variant.state = 'ERROR'
+
+
+async def run_sweep(variants: List[Variant],
+                    client,
+                    compile_workers: Optional[int] = None,
+                    max_concurrent_submissions: int = 4,
+                    initial_poll_secs: float = 10.0,
+                    max_poll_secs: float = 120.0) -> List[Variant]:
+    submissions = asyncio.Semaphore(max_concurrent_submissions)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=compile_workers) as compile_pool:
+        await asyncio.gather(*[_run_variant(client, v, compile_pool, submissions, initial_poll_secs, max_poll_secs)
+                               for v in variants])
+    return variants
+
+
+def format_summary(variants: List[Variant]) -> str:
+    columns = ['name', 'state', 'compile_secs', 'submit_secs', 'run_secs', 'job_id', 'error']
+    rows = [{c: f"{v:.1f}" if isinstance(v, float) else f"{v or ''}"
+             for c, v in dataclasses.asdict(variant).items() if c in columns}
+            for variant in variants]
+    widths = [max(len(c), *(len(r[c]) for r in rows)) for c in columns]
+    lines = ["  ".join(c.ljust(w) for c, w in zip(columns, widths))]
+    lines += ["  ".join(r[c].ljust(w) for c, w in zip(columns, widths)) for r in rows]
+    return "\n".join(lines)
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sweep", required=True, help="JSON file with the base arguments and the variants")
+    parser.add_argument("--compile-workers", type=int, help="Processes compiling variants (default: one per CPU)")
+    parser.add_argument("--max-concurrent-submissions", type=int, default=4)
+    parser.add_argument("--initial-poll-secs", type=float, default=10.0)
+    parser.add_argument("--max-poll-secs", type=float, default=120.0)
+    parser.add_argument("--fake-client", action="store_true", default=False,
+                        help="Do not submit to Vertex, run the jobs with a local fake")
+    args = parser.parse_args()
+
+    with open(args.sweep) as f:
+        sweep_variants = load_variants(json.load(f))
+
+    sweep_start = time.perf_counter()
+    asyncio.run(run_sweep(sweep_variants,
+                          client=FakeClient() if args.fake_client else VertexClient(),
+                          compile_workers=args.compile_workers,
+                          max_concurrent_submissions=args.max_concurrent_submissions,
+                          initial_poll_secs=args.initial_poll_secs,
+                          max_poll_secs=args.max_poll_secs))
+
+    print(format_summary(sweep_variants))
+    print(f"All results known in {time.perf_counter() - sweep_start:.1f} secs")
@@ -0,0 +1,173 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Generates synthetic data with the same schema as the creditcard transactions table.
+
+The columns are Time, V1..V28, Amount and Class, with about 0.17% of fraud rows
+like the original data, and optionally a Card column with the card of each
+transaction, needed by the velocity features. The data is written in shards, in parallel, and every
+shard is deterministic given the seed, so the same arguments always produce
+the same files.
+
+    python -m my_vertex_pipelines.synthetic_data --num-rows=10000000 \
+        --output-dir=/tmp/creditcard_10m --data-format=parquet
+"""
+
+import argparse
+import concurrent.futures
+import logging
+import os
+from typing import Dict, List, Optional
+
+import numpy as np
+
+FEATURE_KEYS = [f"V{i}" for i in range(1, 29)]
+COLUMNS = ["Time"] + FEATURE_KEYS + ["Amount", "Class"]
+ENTITY_KEY = "Card"  # Must match velocity_features.ENTITY_KEY
+INT_COLUMNS = ["Class", ENTITY_KEY]
+
+FRAUD_RATE = 0.00172  # 492 fraud rows out of 284807 in the original data
+SECONDS_PER_ROW = 172792 / 284807  # Two days of transactions in the original data
+ROWS_PER_CHUNK = 1000000
+FILE_EXTENSIONS = {'csv': '.csv', 'parquet': '.parquet', 'tfrecord': '.tfrecord'}
+
+
+def generate_chunk(num_rows: int, first_row: int, seed: int, fraud_rate: float = FRAUD_RATE,
+                   num_cards: int = 0) -> Dict[str, np.ndarray]:
+    """Returns the columns of num_rows rows, starting at row number first_row, with a Card column if num_cards."""
+    rng = np.random.default_rng([seed, first_row])
+    labels = (rng.random(num_rows) < fraud_rate).astype(np.int64)
+
+    # The V columns are PCA components in the original data: zero mean, decreasing variance.
+    # Fraud rows are shifted in a fixed direction, so the data is learnable.
+    scales = np.linspace(2.0, 0.3, len(FEATURE_KEYS), dtype=np.float32)
+    fraud_shift = np.random.default_rng(seed).normal(0, 3, len(FEATURE_KEYS)).astype(np.float32)
+    features = rng.normal(size=(num_rows, len(FEATURE_KEYS))).astype(np.float32) * scales
+    features += labels[:, None].astype(np.float32) * fraud_shift
+
+    columns = {'Time': ((first_row + np.arange(num_rows)) * SECONDS_PER_ROW).astype(np.float32)}
+    columns.update({k: features[:, i] for i, k in enumerate(FEATURE_KEYS)})
+    columns['Amount'] = np.round(rng.lognormal(3.0, 1.5, num_rows), 2).astype(np.float32)
+    columns['Class'] = labels
+    if num_cards:
+        columns[ENTITY_KEY] = rng.integers(num_cards, size=num_rows, dtype=np.int64)
+    return columns
+
+
+def _write_csv(columns: Dict[str, np.ndarray], path: str, header: bool):
+    data = np.column_stack([v.astype(np.float64) for v in columns.values()])
+    fmt = ['%d' if c in INT_COLUMNS else '%.6f' for c in columns]
+    with open(path, 'ab') as f:
+        np.savetxt(f, data, fmt=fmt, delimiter=',', header=','.join(columns) if header else '', comments='')
+
+
+def _write_tfrecord(columns: Dict[str, np.ndarray], writer):
+    import tensorflow as tf
+
+    num_rows = len(columns['Class'])
+    for n in range(num_rows):
+        feature = {c: tf.train.Feature(float_list=tf.train.FloatList(value=[v[n]]))
+                   for c, v in columns.items() if c not in INT_COLUMNS}
+        feature.update({c: tf.train.Feature(int64_list=tf.train.Int64List(value=[v[n]]))
+                        for c, v in columns.items() if c in INT_COLUMNS})
+        writer.write(tf.train.Example(features=tf.train.Features(feature=feature)).SerializeToString())
+
+
+def write_shard(output_dir: str, data_format: str, shard: int, num_shards: int, first_row: int, num_rows: int,
+                seed: int, fraud_rate: float = FRAUD_RATE, num_cards: int = 0) -> str:
+    path = os.path.join(output_dir, f"creditcard-{shard:05d}-of-{num_shards:05d}{FILE_EXTENSIONS[data_format]}")
+    if os.path.exists(path):
+        os.remove(path)
+
+    parquet_writer = None
+    tfrecord_writer = None
+    written = 0
+    try:
+        while written < num_rows:
+            chunk_rows = min(ROWS_PER_CHUNK, num_rows - written)
+            columns = generate_chunk(chunk_rows, first_row + written, seed, fraud_rate, num_cards)
+            if data_format == 'csv':
+                _write_csv(columns, path, header=written == 0)
+            elif data_format == 'parquet':
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+
+                table = pa.table(columns)
+                if parquet_writer is None:
+                    parquet_writer = pq.ParquetWriter(path, table.schema)
+                parquet_writer.write_table(table)
+            else:
+                import tensorflow as tf
+
+                if tfrecord_writer is None:
+                    tfrecord_writer = tf.io.TFRecordWriter(path)
+                _write_tfrecord(columns, tfrecord_writer)
+            written += chunk_rows
+    finally:
+        if parquet_writer is not None:
+            parquet_writer.close()
+        if tfrecord_writer is not None:
+            tfrecord_writer.close()
+
+    return path
+
+
+def generate(output_dir: str,
+             num_rows: int,
+             data_format: str = 'csv',
+             num_shards: Optional[int] = None,
+             seed: int = 0,
+             fraud_rate: float = FRAUD_RATE,
+             num_processes: Optional[int] = None,
+             num_cards: int = 0) -> List[str]:
+    """Writes num_rows synthetic rows in output_dir and returns the paths of the written files."""
+    if data_format not in FILE_EXTENSIONS:
+        raise ValueError(f"Unknown data format {data_format}. Valid formats are {list(FILE_EXTENSIONS)}")
+    # About 10M rows per shard by default, so shards can be read in parallel
+    num_shards = num_shards or max(1, -(-num_rows // 10000000))
+    os.makedirs(output_dir, exist_ok=True)
+
+    rows_per_shard = [num_rows // num_shards + (1 if s < num_rows % num_shards else 0) for s in range(num_shards)]
+    first_rows = np.cumsum([0] + rows_per_shard[:-1]).tolist()
+
+    logging.info(f"Writing {num_rows} rows in {num_shards} {data_format} files to {output_dir}")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_processes) as executor:
+        futures = [executor.submit(write_shard, output_dir, data_format, s, num_shards, first_rows[s],
+                                   rows_per_shard[s], seed, fraud_rate, num_cards)
+                   for s in range(num_shards)]
+        return [f.result() for f in futures]
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--num-rows", required=True, type=int)
+    parser.add_argument("--data-format", choices=list(FILE_EXTENSIONS), default="csv")
+    parser.add_argument("--num-shards", type=int, help="Default: one shard per 10M rows")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--fraud-rate", type=float, default=FRAUD_RATE)
+    parser.add_argument("--num-processes", type=int, help="Default: one per CPU")
+    parser.add_argument("--num-cards", type=int, default=0,
+                        help="Add a Card column with this number of different cards (default: no Card column)")
+    args = parser.parse_args()
+
+    generate(output_dir=args.output_dir,
+             num_rows=args.num_rows,
+             data_format=args.data_format,
+             num_shards=args.num_shards,
+             seed=args.seed,
+             fraud_rate=args.fraud_rate,
+             num_processes=args.num_processes,
+             num_cards=args.num_cards)
@@ -12,10 +12,19 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import atexit
+import hashlib
+import json
 import logging
-from typing import List
+import math
+import os
+import shutil
+import tempfile
+import time
+from typing import Any, Dict, List, Optional, Tuple
 
 import keras_tuner
+import numpy as np
 import tensorflow as tf
 import tensorflow_transform as tft
 import tfx.v1 as tfx
@@ -27,47 +36,310 @@ from tensorflow_metadata.proto.v0 import schema_pb2
 from tensorflow_metadata.proto.v0.schema_pb2 import Schema
 
 LABEL_KEY = "Class"
+# Must match feature_engineering_fn.PACKED_FEATURES_KEY
+PACKED_FEATURES_KEY = "features"
+# Per-epoch timings written to the model run directory, must match instrumentation.TRAINER_METRICS_FILE
+TRAINER_METRICS_FILE = "trainer_metrics.json"
+# Must match vertex_configs.DISTRIBUTION_STRATEGIES
+DISTRIBUTION_STRATEGIES = ['none', 'mirrored', 'multi_worker']
+# Must match feature_engineering_fn.VELOCITY_FEATURES_PREFIX
+VELOCITY_FEATURES_PREFIX = "velocity_"
+# Directory of the model variants in the model run directory, must match model_variants.VARIANTS_DIR
+VARIANTS_DIR = "variants"
+# Disk caches of read_using_tfx, removed at the end of run_fn or when the process exits
+# (the Tuner trains after tuner_fn returns)
+_input_cache_dirs: List[str] = []
+
+
+def remove_input_cache_dirs():
+    while _input_cache_dirs:
+        shutil.rmtree(_input_cache_dirs.pop(), ignore_errors=True)
+
+
+atexit.register(remove_input_cache_dirs)
 
 
 def get_feature_keys(d: dict) -> List[str]:
-    keys_to_select = [k for k in d.keys() if k.startswith("V") or k.startswith("Amount")]
+    # The transformed data only has velocity features if Transform was run with velocity_features
+    keys_to_select = [k for k in d.keys()
+                      if k.startswith("V") or k.startswith("Amount") or k.startswith(VELOCITY_FEATURES_PREFIX)]
     return keys_to_select
 
 
+def get_packed_feature_keys(d: dict, velocity_features: bool = False) -> List[str]:
+    # Column order of the packed vector, must match feature_engineering_fn.get_packed_feature_keys
+    v_keys = sorted([k for k in d.keys() if k.startswith("V")], key=lambda k: int(k[1:]))
+    velocity_keys = sorted([k for k in d.keys() if k.startswith(VELOCITY_FEATURES_PREFIX)]) if velocity_features else []
+    return v_keys + ["Amount"] + velocity_keys
+
+
 def read_using_tfx(file_pattern: List[str],
                    data_accessor: tfx.components.DataAccessor,
                    schema: schema_pb2.Schema,
-                   batch_size: int) -> tf.data.Dataset:
-    return data_accessor.tf_dataset_factory(
+                   batch_size: int,
+                   input_config: Optional[Dict[str, Any]] = None,
+                   shuffle: bool = True,
+                   auto_shard_policy: Optional[tf.data.experimental.AutoShardPolicy] = None) -> tf.data.Dataset:
+    # input_config holds the input_* keys of the Trainer custom_config, see fraud_detection_pipeline.py
+    input_config = input_config or {}
+    cache = input_config.get('input_cache', '')
+    deterministic = input_config.get('input_deterministic', True)
+    shuffle_buffer_size = input_config.get('input_shuffle_buffer_size', 10000) if shuffle else 0
+    shuffle_seed = input_config.get('input_shuffle_seed')
+
+    dataset = data_accessor.tf_dataset_factory(
         file_pattern,
-        tfxio.TensorFlowDatasetOptions(batch_size=batch_size, label_key=LABEL_KEY),
-        schema=schema).repeat()
-
-
-def build_model(hparams: keras_tuner.HyperParameters, feature_keys: List[str]) -> tf.keras.Model:
-    inputs = [tf.keras.layers.Input(shape=(1,), name=f) for f in feature_keys]
-    d = tf.keras.layers.concatenate(inputs)
+        tfxio.TensorFlowDatasetOptions(batch_size=batch_size,
+                                       label_key=LABEL_KEY,
+                                       # With a cache, read the files once and repeat the cached data
+                                       num_epochs=1 if cache else None,
+                                       shuffle=shuffle_buffer_size > 0,
+                                       shuffle_buffer_size=max(shuffle_buffer_size, 1),
+                                       shuffle_seed=shuffle_seed,
+                                       sloppy_ordering=not deterministic,
+                                       prefetch_buffer_size=tf.data.AUTOTUNE,
+                                       reader_num_threads=tf.data.AUTOTUNE,
+                                       parser_num_threads=tf.data.AUTOTUNE),
+        schema=schema)
+
+    if cache == 'memory':
+        dataset = dataset.cache()
+    elif cache == 'disk':
+        # Unique directory per dataset, so a stale cache from a previous run is never reused
+        cache_dir = tempfile.mkdtemp(prefix='tfx_input_cache_', dir=input_config.get('input_cache_dir'))
+        _input_cache_dirs.append(cache_dir)
+        dataset = dataset.cache(os.path.join(cache_dir, 'cache'))
+    elif cache:
+        raise ValueError(f"Unknown input_cache value: {cache}. Valid values are 'memory' and 'disk'")
+
+    if cache:
+        if shuffle_buffer_size > 0:
+            # The cache replays the order of the first epoch, so shuffle whole batches in every epoch
+            dataset = dataset.shuffle(max(shuffle_buffer_size // batch_size, 1),
+                                      seed=shuffle_seed,
+                                      reshuffle_each_iteration=True)
+        dataset = dataset.repeat().prefetch(tf.data.AUTOTUNE)
+    else:
+        dataset = dataset.repeat()
+
+    options = tf.data.Options()
+    options.deterministic = deterministic
+    options.autotune.enabled = True
+    if auto_shard_policy is not None:
+        options.experimental_distribute.auto_shard_policy = auto_shard_policy
+    return dataset.with_options(options)
+
+
+def _time_input_pipeline(dataset: tf.data.Dataset, num_batches: int) -> float:
+    """Returns the seconds per batch needed to only read the dataset, without training."""
+    iterator = iter(dataset)
+    next(iterator)  # Exclude the time to start the readers
+    start = time.perf_counter()
+    for _ in range(num_batches):
+        next(iterator)
+    return (time.perf_counter() - start) / num_batches
+
+
+class EpochTimer(tf.keras.callbacks.Callback):
+    """Records the training and evaluation time of each epoch.
+
+    If the time needed to only read a batch is known, it also logs whether each epoch is
+    bound by the input pipeline or by the model compute.
+    """
+
+    def __init__(self, steps_per_epoch: int, input_secs_per_batch: Optional[float] = None):
+        super().__init__()
+        self._steps_per_epoch = steps_per_epoch
+        self._input_secs_per_batch = input_secs_per_batch
+        self._epoch_start = None
+        self._eval_start = None
+        self.epochs = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._epoch_start = time.perf_counter()
+        self._eval_start = None
+
+    def on_test_begin(self, logs=None):
+        # Validation runs at the end of the epoch, so this is the end of the training steps
+        if self._epoch_start is not None and self._eval_start is None:
+            self._eval_start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        now = time.perf_counter()
+        eval_start = self._eval_start or now
+        train_secs = eval_start - self._epoch_start
+        step_secs = train_secs / self._steps_per_epoch
+        record = {'epoch': epoch,
+                  'train_secs': train_secs,
+                  'eval_secs': now - eval_start,
+                  'train_step_ms': step_secs * 1000,
+                  'metrics': {k: float(v) for k, v in (logs or {}).items()}}
+
+        if self._input_secs_per_batch is not None:
+            # When reading a batch takes almost as long as a whole training step, the step waits for data
+            bound = 'input-bound' if self._input_secs_per_batch >= 0.8 * step_secs else 'compute-bound'
+            record['input_ms_per_batch'] = self._input_secs_per_batch * 1000
+            record['estimated_input_wait_secs'] = min(self._input_secs_per_batch, step_secs) * self._steps_per_epoch
+            record['bound'] = bound
+            logging.info(f"Epoch {epoch}: {step_secs * 1000:.1f} ms/step, "
+                         f"input pipeline alone {self._input_secs_per_batch * 1000:.1f} ms/batch -> {bound}")
+
+        self.epochs.append(record)
+
+
+def _write_trainer_metrics(model_run_dir: str, trainer_metrics: Dict[str, Any]):
+    # Read by instrumentation.collect_*_run_metrics, which looks for this file in the Trainer outputs
+    tf.io.gfile.makedirs(model_run_dir)
+    with tf.io.gfile.GFile(os.path.join(model_run_dir, TRAINER_METRICS_FILE), 'w') as f:
+        json.dump(trainer_metrics, f, indent=2)
+
+
+def get_distribution_strategy(name: str, cpu_replicas: Optional[int] = None) -> tf.distribute.Strategy:
+    """Returns the tf.distribute strategy of the trainer.
+
+    'mirrored' replicates the model in the local GPUs or, without GPUs, in cpu_replicas
+    logical CPU devices. 'multi_worker' replicates it in all the replicas of the Vertex
+    job, described by the TF_CONFIG environment variable. Must be called before any other
+    TensorFlow operation, the logical devices can only be configured at startup: in a process
+    where TensorFlow already runs (the LocalDagRunner), mirroring on CPUs raises a RuntimeError.
+    """
+    if name == 'none':
+        return tf.distribute.get_strategy()
+    elif name == 'mirrored':
+        if not tf.config.list_physical_devices('GPU'):
+            cpu_replicas = cpu_replicas or max((os.cpu_count() or 1) // 2, 1)
+            cpu = tf.config.list_physical_devices('CPU')[0]
+            try:
+                tf.config.set_logical_device_configuration(
+                    cpu, [tf.config.LogicalDeviceConfiguration()] * cpu_replicas)
+            except RuntimeError:
+                # Already initialized, the existing logical devices are checked below
+                pass
+            devices = [d.name for d in tf.config.list_logical_devices('CPU')]
+            if len(devices) < cpu_replicas:
+                raise RuntimeError(f"Can't mirror the model in {cpu_replicas} CPU devices, TensorFlow is already "
+                                   f"initialized with {len(devices)}. Without GPUs, the mirrored strategy needs "
+                                   f"a Trainer in its own process (not the LocalDagRunner)")
+            return tf.distribute.MirroredStrategy(devices=devices[:cpu_replicas])
+        return tf.distribute.MirroredStrategy()
+    elif name == 'multi_worker':
+        return tf.distribute.MultiWorkerMirroredStrategy()
+    raise ValueError(f"Unknown distribution strategy {name}. Valid strategies are {DISTRIBUTION_STRATEGIES}")
+
+
+def _is_chief(strategy: tf.distribute.Strategy) -> bool:
+    cluster_resolver = getattr(strategy, 'cluster_resolver', None)
+    if cluster_resolver is None or not cluster_resolver.task_type:
+        return True
+    # Vertex names the first worker pool 'chief', plain TF_CONFIG clusters may only have workers
+    return (cluster_resolver.task_type == 'chief' or
+            (cluster_resolver.task_type == 'worker' and cluster_resolver.task_id == 0 and
+             'chief' not in cluster_resolver.cluster_spec().as_dict()))
+
+
+def _get_auto_shard_policy(file_pattern: List[str],
+                           strategy: tf.distribute.Strategy) -> Optional[tf.data.experimental.AutoShardPolicy]:
+    if not isinstance(strategy, tf.distribute.MultiWorkerMirroredStrategy):
+        return None
+    cluster_spec = strategy.cluster_resolver.cluster_spec()
+    num_workers = sum(cluster_spec.num_tasks(job) for job in cluster_spec.jobs if job in ('chief', 'worker'))
+    num_files = len([f for pattern in file_pattern for f in tf.io.gfile.glob(pattern)])
+    # Every worker reads its own files if there are enough, otherwise all read and skip the other batches
+    if num_files >= num_workers:
+        return tf.data.experimental.AutoShardPolicy.FILE
+    return tf.data.experimental.AutoShardPolicy.DATA
+
+
+def _count_examples(file_pattern: List[str]) -> int:
+    files = sorted(f for pattern in file_pattern for f in tf.io.gfile.glob(pattern))
+    # Only the records are counted, they are not parsed
+    compression = 'GZIP' if all(f.endswith('.gz') for f in files) else ''
+    dataset = tf.data.Dataset.from_tensor_slices(files).interleave(
+        lambda f: tf.data.TFRecordDataset(f, compression_type=compression),
+        num_parallel_calls=tf.data.AUTOTUNE)
+    count = dataset.batch(10000).reduce(tf.constant(0, tf.int64),
+                                        lambda acc, batch: acc + tf.cast(tf.shape(batch)[0], tf.int64))
+    return int(count)
+
+
+def get_split_size(file_pattern: List[str], cache_dir: Optional[str] = None) -> int:
+    """Returns the number of examples in the files, counting them only once per set of files."""
+    if not cache_dir:
+        return _count_examples(file_pattern)
+
+    # Artifacts are never modified once written, so their paths and sizes identify the split
+    files = sorted(f for pattern in file_pattern for f in tf.io.gfile.glob(pattern))
+    key_source = json.dumps([(f, tf.io.gfile.stat(f).length) for f in files])
+    cache_file = os.path.join(cache_dir, hashlib.sha256(key_source.encode()).hexdigest() + '.json')
+
+    if tf.io.gfile.exists(cache_file):
+        with tf.io.gfile.GFile(cache_file, 'r') as f:
+            return json.load(f)['num_examples']
+
+    num_examples = _count_examples(file_pattern)
+    tf.io.gfile.makedirs(cache_dir)
+    with tf.io.gfile.GFile(cache_file, 'w') as f:
+        json.dump({'files': files, 'num_examples': num_examples}, f)
+    return num_examples
+
+
+def build_model(hparams: keras_tuner.HyperParameters,
+                feature_keys: List[str],
+                packed: bool = False,
+                jit_compile: bool = False,
+                steps_per_execution: int = 1,
+                mixed_precision: Optional[str] = None) -> tf.keras.Model:
+    """Builds and compiles the model.
+
+    jit_compile compiles the training and evaluation steps with XLA, and steps_per_execution runs
+    that number of steps in each call of the step function, to reduce the per-step Python overhead.
+    With mixed_precision (mixed_bfloat16), the hidden layer computes in bfloat16 with float32
+    variables, and the output is computed in float32.
+    """
+    # Per layer policy instead of the global one, so other models of the process are not affected
+    hidden_dtype = tf.keras.mixed_precision.Policy(mixed_precision) if mixed_precision else None
+    if packed:
+        # A single [batch, n_features] input, columns in the order given by feature_keys
+        inputs = tf.keras.layers.Input(shape=(len(feature_keys),), name=PACKED_FEATURES_KEY)
+        d = inputs
+    else:
+        inputs = [tf.keras.layers.Input(shape=(1,), name=f) for f in feature_keys]
+        d = tf.keras.layers.concatenate(inputs)
     layer_size = hparams.get("num_neurons")
-    d = tf.keras.layers.Dense(layer_size, activation=tf.keras.activations.relu)(d)
-    outputs = tf.keras.layers.Dense(1, activation=tf.keras.activations.sigmoid)(d)
+    d = tf.keras.layers.Dense(layer_size, activation=tf.keras.activations.relu, dtype=hidden_dtype)(d)
+    outputs = tf.keras.layers.Dense(1, activation=tf.keras.activations.sigmoid, dtype='float32')(d)
     model = tf.keras.Model(inputs=inputs, outputs=outputs)
 
     model.compile(
         optimizer=tf.keras.optimizers.RMSprop(),
         loss=tf.keras.losses.binary_crossentropy,
-        metrics=[tf.keras.metrics.binary_accuracy])
+        metrics=[tf.keras.metrics.binary_accuracy],
+        jit_compile=jit_compile,
+        steps_per_execution=steps_per_execution)
 
     model.summary(print_fn=logging.info)
 
     return model
 
 
-def _get_serve_tf_examples_fn(model, tf_transform_output):
+def _get_model_call(model: tf.keras.Model, jit_compile: bool = False):
+    """Returns the function that calls the model in the serving signatures.
+
+    Only the model is compiled with XLA: the parsing of the examples and the Transform
+    layer have ops without XLA kernels, and run as usual.
+    """
+    if not jit_compile:
+        return model
+    return tf.function(lambda features: model(features), jit_compile=True)
+
+
+def _get_serve_tf_examples_fn(model, tf_transform_output, jit_compile: bool = False):
     """Returns a function that parses a serialized tf.Example."""
 
     # the layer is added as an attribute to the model in order to make sure that
     # the model assets are handled correctly when exporting.
     tft_layer = tf_transform_output.transform_features_layer()
+    model_call = _get_model_call(model, jit_compile)
 
     @tf.function(input_signature=[tf.TensorSpec(shape=[None], dtype=tf.string, name='examples')])
     def serve_tf_examples_fn(serialized_tf_examples):
@@ -80,11 +352,63 @@ def _get_serve_tf_examples_fn(model, tf_transform_output):
 
         transformed_features = tft_layer(parsed_features)
 
-        return model(transformed_features)
+        return model_call(transformed_features)
 
     return serve_tf_examples_fn
 
 
+def _get_serve_raw_tensor_fn(model, tf_transform_output, raw_feature_keys: List[str], jit_compile: bool = False):
+    """Returns a function that takes the raw features as a single [batch, n_features] float tensor."""
+
+    tft_layer = tf_transform_output.transform_features_layer()
+    raw_feature_spec = tf_transform_output.raw_feature_spec()
+    model_call = _get_model_call(model, jit_compile)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None, len(raw_feature_keys)], dtype=tf.float32,
+                                                name='features')])
+    def serve_raw_tensor_fn(features):
+        """Returns the output to be used in the raw tensor serving signature."""
+        # No tf.Example serialization in the client nor parsing in the server, columns in raw_feature_keys order
+        raw_features = {k: _to_raw_feature(features[:, i], raw_feature_spec[k])
+                        for i, k in enumerate(raw_feature_keys)}
+        return model_call(tft_layer(raw_features))
+
+    return serve_raw_tensor_fn
+
+
+def _get_serve_named_tensors_fn(model, tf_transform_output, raw_feature_keys: List[str],
+                                jit_compile: bool = False):
+    """Returns a function that takes each raw feature as a [batch] float tensor with the name of the feature."""
+
+    tft_layer = tf_transform_output.transform_features_layer()
+    raw_feature_spec = tf_transform_output.raw_feature_spec()
+    model_call = _get_model_call(model, jit_compile)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None], dtype=tf.float32, name=k) for k in raw_feature_keys])
+    def serve_named_tensors_fn(*columns):
+        """Returns the output to be used in the named tensors serving signature."""
+        raw_features = {k: _to_raw_feature(c, raw_feature_spec[k]) for k, c in zip(raw_feature_keys, columns)}
+        return model_call(tft_layer(raw_features))
+
+    return serve_named_tensors_fn
+
+
+def _to_raw_feature(column: tf.Tensor, spec: tf.io.FixedLenFeature) -> tf.Tensor:
+    # Same shape and dtype as tf.io.parse_example would return for this feature
+    return tf.cast(tf.reshape(column, [-1] + list(spec.shape)), spec.dtype)
+
+
+def _get_feature_keys_fn(feature_keys: List[str], raw_feature_keys: List[str]):
+    """Returns a function that records the order of the features expected by the model and the raw signatures."""
+
+    @tf.function(input_signature=[])
+    def feature_keys_fn():
+        return {'feature_keys': tf.constant(feature_keys),
+                'raw_feature_keys': tf.constant(raw_feature_keys)}
+
+    return feature_keys_fn
+
+
 def _get_hyperparameters() -> keras_tuner.HyperParameters:
     """Returns hyperparameters for building Keras model."""
     hp = keras_tuner.HyperParameters()
@@ -106,14 +430,210 @@ def _report_params_and_metrics(num_neurons: int,
     aiplatform.log_metrics({'accuracy': accuracy})
 
 
+def warm_start(model: tf.keras.Model, base_model_dir: str) -> bool:
+    """Copies the weights of the model in base_model_dir to model, if both have the same layout.
+
+    The layouts are compatible if the inputs have the same names and shapes and all the weights
+    have the same shapes, e.g. not if the feature engineering or the hyperparameters changed.
+    Packed inputs always have their columns in the same order, so the same width is enough.
+    """
+    try:
+        base_model = tf.keras.models.load_model(base_model_dir, compile=False)
+    except (IOError, ValueError, KeyError, tf.errors.OpError) as e:
+        # e.g. a gbt model (ops not registered here) or a SavedModel without the Keras metadata
+        logging.warning(f"Could not load the base model {base_model_dir}, training from scratch: {e}")
+        return False
+    if not getattr(base_model, 'inputs', None):
+        logging.info("The base model has no Keras inputs, training from scratch")
+        return False
+
+    def input_layout(m: tf.keras.Model):
+        return sorted((i.name.split(':')[0], tuple(i.shape.as_list())) for i in m.inputs)
+
+    if input_layout(base_model) != input_layout(model):
+        logging.info("The inputs of the base model changed, training from scratch")
+        return False
+    base_weights = base_model.get_weights()
+    if [w.shape for w in base_weights] != [w.shape for w in model.get_weights()]:
+        logging.info("The weights of the base model have a different shape, training from scratch")
+        return False
+
+    model.set_weights(base_weights)
+    logging.info(f"Warm starting from {base_model_dir}")
+    return True
+
+
+def _get_epoch_budget(passes: float, steps_per_pass: int) -> Tuple[int, int]:
+    """Returns the epochs and steps per epoch of a number of passes over the data, which may be fractional."""
+    epochs = max(math.ceil(passes), 1)
+    steps_per_epoch = max(round(passes * steps_per_pass / epochs), 1)
+    return epochs, steps_per_epoch
+
+
+def _get_compile_options(custom_config: Dict[str, Any]) -> Dict[str, Any]:
+    """Returns the XLA, steps per execution and mixed precision options of build_model in the custom_config."""
+    mixed_precision = custom_config.get('mixed_precision', 'none')
+    return {'jit_compile': custom_config.get('jit_compile', False),
+            'steps_per_execution': custom_config.get('steps_per_execution', 1),
+            'mixed_precision': None if mixed_precision == 'none' else mixed_precision}
+
+
+class QuantizedDense(tf.keras.layers.Layer):
+    """Dense layer with the kernel stored in int8 (with a scale per output unit) or float16.
+
+    The kernel is converted back to float in every call, so the model is smaller (on disk,
+    to download and to load) and computes in float32 like the original one.
+    """
+
+    def __init__(self, dense: tf.keras.layers.Dense, kernel_dtype: str, **kwargs):
+        super().__init__(name=dense.name, **kwargs)
+        self.kernel_dtype = kernel_dtype
+        self.activation = dense.activation
+        self._kernel_value, self._bias_value = [w.numpy().astype('float32') for w in (dense.kernel, dense.bias)]
+
+    def build(self, input_shape):
+        kernel = self._kernel_value
+        if self.kernel_dtype == 'int8':
+            # Symmetric quantization, the largest weight of each output unit is 127
+            scale = np.maximum(np.abs(kernel).max(axis=0), 1e-12) / 127
+            self.scale = self.add_weight('scale', shape=scale.shape, dtype=tf.float32, trainable=False,
+                                         initializer=tf.keras.initializers.Constant(scale))
+            kernel = np.round(kernel / scale).astype(np.int8)
+        self.kernel = self.add_weight('kernel', shape=kernel.shape, dtype=self.kernel_dtype, trainable=False,
+                                      initializer=tf.keras.initializers.Constant(kernel))
+        self.bias = self.add_weight('bias', shape=self._bias_value.shape, dtype=tf.float32, trainable=False,
+                                    initializer=tf.keras.initializers.Constant(self._bias_value))
+
+    def call(self, inputs):
+        kernel = tf.cast(self.kernel, tf.float32)
+        if self.kernel_dtype == 'int8':
+            kernel = kernel * self.scale
+        return self.activation(tf.matmul(tf.cast(inputs, tf.float32), kernel) + self.bias)
+
+
+def quantize_model(model: tf.keras.Model, kernel_dtype: str) -> tf.keras.Model:
+    """Returns a copy of the model with the Dense layers replaced by QuantizedDense layers."""
+    def clone_layer(layer):
+        if isinstance(layer, tf.keras.layers.Dense):
+            return QuantizedDense(layer, kernel_dtype)
+        return layer.__class__.from_config(layer.get_config())
+
+    return tf.keras.models.clone_model(model, clone_function=clone_layer)
+
+
+def prune_model(model: tf.keras.Model, train_ds: tf.data.Dataset, sparsity: float, steps: int) -> tf.keras.Model:
+    """Returns a copy of the model with the smallest weights set to zero, fine-tuned for the given steps.
+
+    The zeros are not smaller on disk, but compress well: the pruned model is smaller to download.
+    """
+    try:
+        import tensorflow_model_optimization as tfmot
+    except ImportError as e:
+        raise ImportError("The pruned variant needs the tensorflow-model-optimization package") from e
+
+    # The wrappers of prune_low_magnitude keep the trained weights of the layers
+    trained = tf.keras.models.clone_model(model)
+    trained.set_weights(model.get_weights())
+    pruned = tfmot.sparsity.keras.prune_low_magnitude(
+        trained, pruning_schedule=tfmot.sparsity.keras.ConstantSparsity(sparsity, begin_step=0))
+    pruned.compile(optimizer=tf.keras.optimizers.RMSprop(),
+                   loss=tf.keras.losses.binary_crossentropy,
+                   metrics=[tf.keras.metrics.binary_accuracy])
+    pruned.fit(train_ds, epochs=1, steps_per_epoch=steps,
+               callbacks=[tfmot.sparsity.keras.UpdatePruningStep()])
+    return tfmot.sparsity.keras.strip_pruning(pruned)
+
+
+def _get_signatures(model: tf.keras.Model,
+                    tf_transform_output: TFTransformOutput,
+                    feature_keys: List[str],
+                    raw_feature_keys: List[str],
+                    jit_compile: bool = False) -> Dict[str, Any]:
+    return {
+        'serving_default': _get_serve_tf_examples_fn(model, tf_transform_output, jit_compile),
+        'serving_raw': _get_serve_raw_tensor_fn(model, tf_transform_output, raw_feature_keys, jit_compile),
+        'serving_raw_named': _get_serve_named_tensors_fn(model, tf_transform_output, raw_feature_keys, jit_compile),
+        'feature_keys': _get_feature_keys_fn(feature_keys, raw_feature_keys)}
+
+
+def _get_model_features(tf_transform_output: TFTransformOutput,
+                        velocity_features: bool = False) -> Tuple[List[str], bool]:
+    """Returns the input features of the model and whether they are packed in a single vector."""
+    transformed_feature_spec = tf_transform_output.transformed_feature_spec()
+    packed = PACKED_FEATURES_KEY in transformed_feature_spec
+    if packed:
+        feature_keys = get_packed_feature_keys(tf_transform_output.raw_feature_spec(), velocity_features)
+        packed_width = transformed_feature_spec[PACKED_FEATURES_KEY].shape[-1]
+        if packed_width != len(feature_keys):
+            raise ValueError(f"Packed feature vector has {packed_width} columns, "
+                             f"expected {len(feature_keys)}: {feature_keys}")
+    else:
+        feature_keys = get_feature_keys(transformed_feature_spec)
+    return feature_keys, packed
+
+
+def tuner_fn(fn_args: tfx.components.FnArgs) -> tfx.components.TunerFnResult:
+    """Hyperband search over the space of _get_hyperparameters.
+
+    A Hyperband epoch is a fraction of the training data, so the trials that reach
+    tuner_max_epochs train on the same number of examples as the Trainer (one pass).
+    Worse trials are stopped after fewer epochs.
+    """
+    tf_transform_output: TFTransformOutput = tft.TFTransformOutput(fn_args.transform_graph_path)
+    schema: Schema = tf_transform_output.transformed_metadata.schema
+    feature_keys, packed = _get_model_features(tf_transform_output,
+                                                fn_args.custom_config.get('velocity_features', False))
+
+    batch_size = fn_args.custom_config['batch_size']
+    max_epochs = fn_args.custom_config.get('tuner_max_epochs', 9)
+    split_size_cache_dir = fn_args.custom_config.get('split_size_cache_dir')
+    train_size = get_split_size(fn_args.train_files, split_size_cache_dir)
+    eval_size = get_split_size(fn_args.eval_files, split_size_cache_dir)
+    steps_per_epoch = max(train_size // batch_size // max_epochs, 1)
+    validation_steps = max(eval_size // batch_size, 1)
+
+    input_config = {k: v for k, v in fn_args.custom_config.items() if k.startswith('input_')}
+    train_ds = read_using_tfx(fn_args.train_files, fn_args.data_accessor, schema, batch_size, input_config)
+    eval_ds = read_using_tfx(fn_args.eval_files, fn_args.data_accessor, schema, batch_size, input_config,
+                             shuffle=False)
+
+    # In Vertex, the trials of all the workers must be written to a shared directory.
+    # The key must match tfx.extensions.google_cloud_ai_platform.experimental.REMOTE_TRIALS_WORKING_DIR_KEY
+    working_dir = fn_args.custom_config.get('remote_trials_working_dir', fn_args.working_dir)
+    tuner = keras_tuner.Hyperband(
+        hypermodel=lambda hp: build_model(hparams=hp, feature_keys=feature_keys, packed=packed,
+                                          **_get_compile_options(fn_args.custom_config)),
+        objective=keras_tuner.Objective('val_binary_accuracy', 'max'),
+        max_epochs=max_epochs,
+        factor=3,
+        hyperparameters=_get_hyperparameters(),
+        directory=working_dir,
+        project_name='fraud_detection_tuning')
+
+    return tfx.components.TunerFnResult(
+        tuner=tuner,
+        fit_kwargs={'x': train_ds,
+                    'validation_data': eval_ds,
+                    'steps_per_epoch': steps_per_epoch,
+                    'validation_steps': validation_steps,
+                    'callbacks': [tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=3)]})
+
+
 def run_fn(fn_args: tfx.components.FnArgs):
+    # Created first, the logical CPU devices of the mirrored strategy can't be set after TF starts
+    strategy = get_distribution_strategy(fn_args.custom_config.get('distribution_strategy', 'none'),
+                                         fn_args.custom_config.get('cpu_replicas'))
+    is_chief = _is_chief(strategy)
+    logging.info(f"Training with {strategy.num_replicas_in_sync} replicas")
+
     tf_transform_output: TFTransformOutput = tft.TFTransformOutput(fn_args.transform_graph_path)
     schema: Schema = tf_transform_output.transformed_metadata.schema
     data_accesor = fn_args.data_accessor
     train_files = fn_args.train_files
     eval_files = fn_args.eval_files
 
-    feature_keys = get_feature_keys(tf_transform_output.transformed_feature_spec())
+    feature_keys, packed = _get_model_features(tf_transform_output,
+                                                fn_args.custom_config.get('velocity_features', False))
 
     if fn_args.hyperparameters:
         hparams = keras_tuner.HyperParameters.from_config(fn_args.hyperparameters)
@@ -121,30 +641,94 @@ def run_fn(fn_args: tfx.components.FnArgs):
         # Default hyperparams if Tuner is not used or imported
         hparams = _get_hyperparameters()
 
-    batch_size = fn_args.custom_config['batch_size']
-    dataset_size = fn_args.custom_config['dataset_size']
-
-    steps_per_epoch = (dataset_size * 2 / 3) // batch_size
-    validation_steps = (dataset_size * 1 / 3) // batch_size
+    # batch_size is per replica, every step processes a batch in each replica
+    batch_size = fn_args.custom_config['batch_size'] * strategy.num_replicas_in_sync
+    split_size_cache_dir = fn_args.custom_config.get('split_size_cache_dir')
+    train_size = get_split_size(train_files, split_size_cache_dir)
+    eval_size = get_split_size(eval_files, split_size_cache_dir)
+    logging.info(f"Training with {train_size} examples, evaluating with {eval_size} examples")
+
+    with strategy.scope():
+        model: tf.keras.Model = build_model(hparams=hparams, feature_keys=feature_keys, packed=packed,
+                                            **_get_compile_options(fn_args.custom_config))
+    warm_started = bool(fn_args.base_model) and warm_start(model, fn_args.base_model)
+
+    # Training budget in passes over the training data, shorter when starting from the previous model
+    if warm_started:
+        passes = fn_args.custom_config.get('warm_start_epochs', 0.25)
+    else:
+        passes = fn_args.custom_config.get('epochs', 1)
+    epochs, steps_per_epoch = _get_epoch_budget(passes, steps_per_pass=max(train_size // batch_size, 1))
+    validation_steps = max(eval_size // batch_size, 1)
 
-    train_ds = read_using_tfx(train_files, data_accesor, schema, batch_size)
-    eval_ds = read_using_tfx(eval_files, data_accesor, schema, batch_size)
+    input_config = {k: v for k, v in fn_args.custom_config.items() if k.startswith('input_')}
+    train_ds = read_using_tfx(train_files, data_accesor, schema, batch_size, input_config,
+                              auto_shard_policy=_get_auto_shard_policy(train_files, strategy))
+    eval_ds = read_using_tfx(eval_files, data_accesor, schema, batch_size, input_config, shuffle=False,
+                             auto_shard_policy=_get_auto_shard_policy(eval_files, strategy))
 
     early_stop_cb = tf.keras.callbacks.EarlyStopping(monitor='val_loss', patience=3)
 
-    model: tf.keras.Model = build_model(hparams=hparams, feature_keys=feature_keys)
+    input_secs_per_batch = None
+    if fn_args.custom_config.get('input_profile', False):
+        # Time the reads without the cache, i.e. the cost of the first epoch
+        uncached_config = dict(input_config, input_cache='')
+        probe_ds = read_using_tfx(train_files, data_accesor, schema, batch_size, uncached_config)
+        input_secs_per_batch = _time_input_pipeline(probe_ds, num_batches=min(steps_per_epoch, 50))
+    epoch_timer = EpochTimer(steps_per_epoch, input_secs_per_batch)
+    callbacks = [early_stop_cb, epoch_timer]
+
+    profile_steps = fn_args.custom_config.get('profile_steps')
+    if profile_steps and is_chief:
+        # TensorFlow profiler trace of the training steps in the range "first,last", viewable in TensorBoard
+        callbacks.append(tf.keras.callbacks.TensorBoard(log_dir=os.path.join(fn_args.model_run_dir, 'profile'),
+                                                        profile_batch=profile_steps))
 
     h = model.fit(
         train_ds,
+        epochs=epochs,
         steps_per_epoch=steps_per_epoch,
         validation_data=eval_ds,
         validation_steps=validation_steps,
-        callbacks=[early_stop_cb])
-
-    signatures = {
-        'serving_default': _get_serve_tf_examples_fn(model, tf_transform_output)}
-
-    model.save(fn_args.serving_model_dir, signatures=signatures)
+        callbacks=callbacks)
+
+    if is_chief:
+        _write_trainer_metrics(fn_args.model_run_dir, {'train_examples': train_size,
+                                                       'eval_examples': eval_size,
+                                                       'batch_size': batch_size,
+                                                       'replicas': strategy.num_replicas_in_sync,
+                                                       'warm_started': warm_started,
+                                                       'steps_per_epoch': steps_per_epoch,
+                                                       'validation_steps': validation_steps,
+                                                       'epochs': epoch_timer.epochs})
+
+    # Raw numeric features read by preprocessing_fn, in the same order as the packed features
+    raw_feature_keys = get_packed_feature_keys(tf_transform_output.raw_feature_spec(),
+                                               fn_args.custom_config.get('velocity_features', False))
+    jit_compile = fn_args.custom_config.get('jit_compile', False)
+    signatures = _get_signatures(model, tf_transform_output, feature_keys, raw_feature_keys, jit_compile)
+
+    if is_chief:
+        model.save(fn_args.serving_model_dir, signatures=signatures)
+        # Smaller variants of the model, with the same signatures, in the model run directory
+        for variant in fn_args.custom_config.get('export_variants') or []:
+            if variant == 'pruned':
+                pruning_steps = _get_epoch_budget(fn_args.custom_config.get('pruning_epochs', 0.1),
+                                                  steps_per_pass=max(train_size // batch_size, 1))[1]
+                variant_model = prune_model(model, train_ds, fn_args.custom_config.get('pruning_sparsity', 0.5),
+                                            pruning_steps)
+            else:
+                variant_model = quantize_model(model, kernel_dtype=variant)
+            variant_model.save(os.path.join(fn_args.model_run_dir, VARIANTS_DIR, variant),
+                               signatures=_get_signatures(variant_model, tf_transform_output, feature_keys,
+                                                          raw_feature_keys, jit_compile))
+    else:
+        # All the workers take part in saving a multi-worker model, only the chief keeps the result
+        worker_dir = tempfile.mkdtemp(prefix='tfx_worker_model_')
+        model.save(worker_dir, signatures=signatures)
+        tf.io.gfile.rmtree(worker_dir)
+    # The pruned variant is the last one to read the training data
+    remove_input_cache_dirs()
 
     # TODO: This part is still under development
     # Report parameters and metrics
@@ -0,0 +1,254 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Trainer module of the gradient boosted trees engine (--trainer-engine=gbt).
+
+Trains a TensorFlow Decision Forests model with the same Transform output as
+trainer_fn.py, in a single pass over the data, and exports the same serving
+signatures. Loading the model needs the TF-DF ops: the Evaluator gets this module
+as its module_file, and its custom_eval_shared_model loads the model in the Beam
+workers, and serving_utils.load_model imports the package. Like
+trainer_fn.py, it is a standalone module file, it does not import it.
+"""
+
+import functools
+import json
+import logging
+import os
+import time
+from typing import Any, Callable, Dict, List, Tuple
+
+import tensorflow as tf
+import tensorflow_decision_forests as tfdf
+import tensorflow_model_analysis as tfma
+import tensorflow_transform as tft
+import tfx.v1 as tfx
+from tensorflow_transform import TFTransformOutput
+from tfx_bsl.public import tfxio
+
+from tensorflow_metadata.proto.v0 import schema_pb2
+
+LABEL_KEY = "Class"
+# Must match feature_engineering_fn.PACKED_FEATURES_KEY
+PACKED_FEATURES_KEY = "features"
+# Must match instrumentation.TRAINER_METRICS_FILE
+TRAINER_METRICS_FILE = "trainer_metrics.json"
+# Must match feature_engineering_fn.VELOCITY_FEATURES_PREFIX
+VELOCITY_FEATURES_PREFIX = "velocity_"
+# Must match vertex_configs.GBT_NUM_TREES and vertex_configs.GBT_MAX_DEPTH
+NUM_TREES = 300
+MAX_DEPTH = 6
+
+
+def get_raw_feature_keys(d: dict, velocity_features: bool = False) -> List[str]:
+    # Same order as trainer_fn.get_packed_feature_keys, the column order of the raw tensor signature
+    v_keys = sorted([k for k in d.keys() if k.startswith("V")], key=lambda k: int(k[1:]))
+    velocity_keys = sorted([k for k in d.keys() if k.startswith(VELOCITY_FEATURES_PREFIX)]) if velocity_features else []
+    return v_keys + ["Amount"] + velocity_keys
+
+
+def get_model_feature_keys(transformed_feature_spec: dict) -> List[str]:
+    """Returns the transformed features used by the model, the packed vector or one feature per column."""
+    if PACKED_FEATURES_KEY in transformed_feature_spec:
+        return [PACKED_FEATURES_KEY]
+    return [k for k in transformed_feature_spec.keys()
+            if k.startswith("V") or k.startswith("Amount") or k.startswith(VELOCITY_FEATURES_PREFIX)]
+
+
+def read_using_tfx(file_pattern: List[str],
+                   data_accessor: tfx.components.DataAccessor,
+                   schema: schema_pb2.Schema,
+                   feature_keys: List[str],
+                   batch_size: int) -> tf.data.Dataset:
+    # The trees are grown from all the examples in memory, so the data is read once, in order
+    dataset = data_accessor.tf_dataset_factory(
+        file_pattern,
+        tfxio.TensorFlowDatasetOptions(batch_size=batch_size,
+                                       label_key=LABEL_KEY,
+                                       num_epochs=1,
+                                       shuffle=False,
+                                       prefetch_buffer_size=tf.data.AUTOTUNE,
+                                       reader_num_threads=tf.data.AUTOTUNE,
+                                       parser_num_threads=tf.data.AUTOTUNE),
+        schema=schema)
+    # A packed vector is unrolled by TF-DF in one numerical feature per column
+    return dataset.map(lambda features, label: ({k: features[k] for k in feature_keys}, tf.reshape(label, [-1])),
+                       num_parallel_calls=tf.data.AUTOTUNE)
+
+
+def build_model(num_trees: int = NUM_TREES, max_depth: int = MAX_DEPTH) -> tf.keras.Model:
+    """Builds and compiles the gradient boosted trees model.
+
+    The output is the probability of fraud, shape [batch, 1], like the output of trainer_fn.build_model.
+    """
+    model = tfdf.keras.GradientBoostedTreesModel(task=tfdf.keras.Task.CLASSIFICATION,
+                                                 num_trees=num_trees,
+                                                 max_depth=max_depth,
+                                                 verbose=1)
+    model.compile(metrics=[tf.keras.metrics.binary_accuracy])
+    return model
+
+
+def _get_model_call(model: tf.keras.Model, feature_keys: List[str]):
+    # The model was trained with these features only, the Transform layer may output more
+    return lambda transformed_features: model({k: transformed_features[k] for k in feature_keys})
+
+
+def _get_serve_tf_examples_fn(model, tf_transform_output, feature_keys: List[str]):
+    """Returns a function that parses a serialized tf.Example."""
+
+    tft_layer = tf_transform_output.transform_features_layer()
+    model_call = _get_model_call(model, feature_keys)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None], dtype=tf.string, name='examples')])
+    def serve_tf_examples_fn(serialized_tf_examples):
+        """Returns the output to be used in the serving signature."""
+        feature_spec = tf_transform_output.raw_feature_spec()
+        if LABEL_KEY in feature_spec:
+            del feature_spec[LABEL_KEY]
+
+        parsed_features = tf.io.parse_example(serialized_tf_examples, feature_spec)
+        return model_call(tft_layer(parsed_features))
+
+    return serve_tf_examples_fn
+
+
+def _get_serve_raw_tensor_fn(model, tf_transform_output, feature_keys: List[str], raw_feature_keys: List[str]):
+    """Returns a function that takes the raw features as a single [batch, n_features] float tensor."""
+
+    tft_layer = tf_transform_output.transform_features_layer()
+    raw_feature_spec = tf_transform_output.raw_feature_spec()
+    model_call = _get_model_call(model, feature_keys)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None, len(raw_feature_keys)], dtype=tf.float32,
+                                                name='features')])
+    def serve_raw_tensor_fn(features):
+        """Returns the output to be used in the raw tensor serving signature."""
+        raw_features = {k: _to_raw_feature(features[:, i], raw_feature_spec[k])
+                        for i, k in enumerate(raw_feature_keys)}
+        return model_call(tft_layer(raw_features))
+
+    return serve_raw_tensor_fn
+
+
+def _get_serve_named_tensors_fn(model, tf_transform_output, feature_keys: List[str], raw_feature_keys: List[str]):
+    """Returns a function that takes each raw feature as a [batch] float tensor with the name of the feature."""
+
+    tft_layer = tf_transform_output.transform_features_layer()
+    raw_feature_spec = tf_transform_output.raw_feature_spec()
+    model_call = _get_model_call(model, feature_keys)
+
+    @tf.function(input_signature=[tf.TensorSpec(shape=[None], dtype=tf.float32, name=k) for k in raw_feature_keys])
+    def serve_named_tensors_fn(*columns):
+        """Returns the output to be used in the named tensors serving signature."""
+        raw_features = {k: _to_raw_feature(c, raw_feature_spec[k]) for k, c in zip(raw_feature_keys, columns)}
+        return model_call(tft_layer(raw_features))
+
+    return serve_named_tensors_fn
+
+
+def _to_raw_feature(column: tf.Tensor, spec: tf.io.FixedLenFeature) -> tf.Tensor:
+    # Same shape and dtype as tf.io.parse_example would return for this feature
+    return tf.cast(tf.reshape(column, [-1] + list(spec.shape)), spec.dtype)
+
+
+def _get_feature_keys_fn(feature_keys: List[str], raw_feature_keys: List[str]):
+    """Returns a function that records the order of the features expected by the model and the raw signatures."""
+
+    @tf.function(input_signature=[])
+    def feature_keys_fn():
+        return {'feature_keys': tf.constant(feature_keys),
+                'raw_feature_keys': tf.constant(raw_feature_keys)}
+
+    return feature_keys_fn
+
+
+def get_signatures(model: tf.keras.Model,
+                   tf_transform_output: TFTransformOutput,
+                   velocity_features: bool = False) -> Dict[str, Any]:
+    """Returns the same serving signatures as trainer_fn.py."""
+    feature_keys = get_model_feature_keys(tf_transform_output.transformed_feature_spec())
+    raw_feature_keys = get_raw_feature_keys(tf_transform_output.raw_feature_spec(), velocity_features)
+    return {
+        'serving_default': _get_serve_tf_examples_fn(model, tf_transform_output, feature_keys),
+        'serving_raw': _get_serve_raw_tensor_fn(model, tf_transform_output, feature_keys, raw_feature_keys),
+        'serving_raw_named': _get_serve_named_tensors_fn(model, tf_transform_output, feature_keys,
+                                                         raw_feature_keys),
+        'feature_keys': _get_feature_keys_fn(feature_keys, raw_feature_keys)}
+
+
+def train(model: tf.keras.Model, train_ds: tf.data.Dataset, eval_ds: tf.data.Dataset) -> Tuple[float, float]:
+    """Trains the model, the eval data is used for early stopping. Returns the training and evaluation seconds."""
+    start = time.perf_counter()
+    model.fit(train_ds, validation_data=eval_ds)
+    train_secs = time.perf_counter() - start
+    start = time.perf_counter()
+    model.evaluate(eval_ds)
+    return train_secs, time.perf_counter() - start
+
+
+def run_fn(fn_args: tfx.components.FnArgs):
+    tf_transform_output: TFTransformOutput = tft.TFTransformOutput(fn_args.transform_graph_path)
+    schema = tf_transform_output.transformed_metadata.schema
+    feature_keys = get_model_feature_keys(tf_transform_output.transformed_feature_spec())
+    velocity_features = fn_args.custom_config.get('velocity_features', False)
+
+    batch_size = fn_args.custom_config['batch_size']
+    train_ds = read_using_tfx(fn_args.train_files, fn_args.data_accessor, schema, feature_keys, batch_size)
+    eval_ds = read_using_tfx(fn_args.eval_files, fn_args.data_accessor, schema, feature_keys, batch_size)
+
+    num_trees = fn_args.custom_config.get('gbt_num_trees', NUM_TREES)
+    max_depth = fn_args.custom_config.get('gbt_max_depth', MAX_DEPTH)
+    model = build_model(num_trees=num_trees, max_depth=max_depth)
+    train_secs, eval_secs = train(model, train_ds, eval_ds)
+
+    # The trees are grown in a single pass, it is reported as one epoch like the Keras trainer
+    metrics = model.make_inspector().evaluation()
+    trainer_metrics = {'engine': 'gbt',
+                       'batch_size': batch_size,
+                       'num_trees': model.make_inspector().num_trees(),
+                       'max_depth': max_depth,
+                       'epochs': [{'epoch': 0,
+                                   'train_secs': train_secs,
+                                   'eval_secs': eval_secs,
+                                   'metrics': {k: float(v) for k, v in [('val_accuracy', metrics.accuracy),
+                                                                        ('val_loss', metrics.loss)]
+                                               if v is not None}}]}
+    logging.info(f"Trained {trainer_metrics['num_trees']} trees in {train_secs:.1f} secs")
+    tf.io.gfile.makedirs(fn_args.model_run_dir)
+    with tf.io.gfile.GFile(os.path.join(fn_args.model_run_dir, TRAINER_METRICS_FILE), 'w') as f:
+        json.dump(trainer_metrics, f, indent=2)
+
+    model.save(fn_args.serving_model_dir, signatures=get_signatures(model, tf_transform_output, velocity_features))
+
+
+def _load_with_tfdf_ops(construct_fn: Callable[[], Any]):
+    # Unpickling this function in a Beam worker imports this module, which registers the TF-DF ops
+    return construct_fn()
+
+
+def custom_eval_shared_model(eval_saved_model_path: str, model_name: str, eval_config: tfma.EvalConfig,
+                             **kwargs) -> tfma.EvalSharedModel:
+    """Called by the Evaluator, the default shared model of TFMA, loaded with the TF-DF ops registered.
+
+    With several Beam workers (--eval-num-workers or a multi_processing local profile), the model is
+    loaded in worker processes that would not import tensorflow_decision_forests otherwise.
+    """
+    eval_shared_model = tfma.default_eval_shared_model(eval_saved_model_path=eval_saved_model_path,
+                                                       model_name=model_name,
+                                                       eval_config=eval_config,
+                                                       **kwargs)
+    model_loader = tfma.types.ModelLoader(
+        construct_fn=functools.partial(_load_with_tfdf_ops, eval_shared_model.model_loader.construct_fn),
+        tags=eval_shared_model.model_loader.tags)
+    return eval_shared_model._replace(model_loader=model_loader)
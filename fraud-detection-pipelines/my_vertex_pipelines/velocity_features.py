@@ -0,0 +1,163 @@
+#  Copyright 2023 Google LLC
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+"""Velocity features: number of transactions and sum of their amounts per card in sliding windows.
+
+The features of a transaction are computed with the previous transactions of the
+same card in the last WINDOWS_SECONDS (and the transaction itself). The same code
+computes them for the training data (add_velocity_features, a batch Beam job
+over the files of the transactions) and for the streaming scoring, so the model
+gets the same values in training and serving.
+
+    python -m my_vertex_pipelines.velocity_features --input-path=/tmp/creditcard \
+        --output-dir=/tmp/creditcard_velocity
+"""
+
+import argparse
+import bisect
+import csv
+import io
+import logging
+import os
+from typing import Any, Dict, Iterable, List, Tuple
+
+import apache_beam as beam
+import pyarrow as pa
+import pyarrow.parquet as pq
+import tensorflow as tf
+
+ENTITY_KEY = 'Card'
+TIME_KEY = 'Time'
+AMOUNT_KEY = 'Amount'
+# Must match feature_engineering_fn.VELOCITY_FEATURES_PREFIX and trainer_fn.VELOCITY_FEATURES_PREFIX
+FEATURE_PREFIX = 'velocity_'
+WINDOWS_SECONDS = [300, 3600]
+# Bound of the state per card, the oldest transactions are dropped first
+MAX_EVENTS_PER_ENTITY = 1000
+
+# Transactions of a card in the largest window, as (time, amount) sorted by time
+History = List[Tuple[float, float]]
+
+
+def get_feature_keys(windows: List[int] = WINDOWS_SECONDS) -> List[str]:
+    keys = []
+    for window in windows:
+        keys += [f"{FEATURE_PREFIX}count_{window}s", f"{FEATURE_PREFIX}amount_{window}s"]
+    return keys
+
+
+def add_transaction(history: History,
+                    time: float,
+                    amount: float,
+                    windows: List[int] = WINDOWS_SECONDS,
+                    max_events: int = MAX_EVENTS_PER_ENTITY) -> Tuple[History, Dict[str, float]]:
+    """Adds a transaction to the history and returns the new history and the velocity features of the transaction.
+
+    The new history drops the transactions out of the largest window of the newest transaction.
+    """
+    # Transactions may arrive out of order, the history stays sorted by time
+    bisect.insort(history, (time, amount))
+    # Before dropping the old transactions, a late transaction may be older than the largest window
+    features = compute_features(history, time, windows)
+    horizon = history[-1][0] - max(windows)
+    first = bisect.bisect_right(history, (horizon, float('inf')))
+    return history[max(first, len(history) - max_events):], features
+
+
+def compute_features(history: History, time: float, windows: List[int] = WINDOWS_SECONDS) -> Dict[str, float]:
+    """Returns the velocity features of the transaction at time, given the history that includes it."""
+    features = {}
+    last = bisect.bisect_right(history, (time, float('inf')))
+    for window in windows:
+        first = bisect.bisect_right(history, (time - window, float('inf')), hi=last)
+        in_window = history[first:last]
+        features[f"{FEATURE_PREFIX}count_{window}s"] = float(len(in_window))
+        features[f"{FEATURE_PREFIX}amount_{window}s"] = float(sum(amount for _, amount in in_window))
+    return features
+
+
+def _add_features_by_entity(entity_and_rows: Tuple[Any, Iterable[Dict[str, Any]]],
+                            windows: List[int]) -> Iterable[Dict[str, Any]]:
+    _, rows = entity_and_rows
+    history: History = []
+    for row in sorted(rows, key=lambda r: r[TIME_KEY]):
+        history, features = add_transaction(history, row[TIME_KEY], row[AMOUNT_KEY], windows)
+        yield {**row, **features}
+
+
+@beam.ptransform_fn
+def AddVelocityFeatures(rows: beam.pvalue.PCollection,
+                        windows: List[int] = WINDOWS_SECONDS) -> beam.pvalue.PCollection:
+    """Adds the velocity features to every row, replaying the transactions of each card in time order."""
+    return (rows
+            | 'KeyByEntity' >> beam.Map(lambda row: (row[ENTITY_KEY], row))
+            | 'GroupByEntity' >> beam.GroupByKey()
+            | 'AddFeatures' >> beam.FlatMap(_add_features_by_entity, windows=windows))
+
+
+def _read_csv_header(input_pattern: str) -> List[str]:
+    with tf.io.gfile.GFile(sorted(tf.io.gfile.glob(input_pattern))[0]) as f:
+        return next(csv.reader(f))
+
+
+def _parse_csv_line(line: str, header: List[str]) -> Dict[str, Any]:
+    values = next(csv.reader(io.StringIO(line)))
+    return {k: int(float(v)) if k in ('Class', ENTITY_KEY) else float(v) for k, v in zip(header, values)}
+
+
+def add_velocity_features(input_path: str,
+                          output_dir: str,
+                          data_format: str = 'csv',
+                          beam_pipeline_args: List[str] = None):
+    """Writes the rows of the files in input_path with the velocity features, as Parquet files in output_dir.
+
+    The output directory can be the --data-path of the pipeline, with --velocity-features.
+    """
+    input_pattern = os.path.join(input_path, '*')
+    with beam.Pipeline(argv=beam_pipeline_args or []) as p:
+        if data_format == 'parquet':
+            rows = p | 'ReadParquet' >> beam.io.ReadFromParquet(input_pattern)
+            with tf.io.gfile.GFile(sorted(tf.io.gfile.glob(input_pattern))[0], 'rb') as f:
+                header = pq.read_schema(f).names
+        elif data_format == 'csv':
+            header = _read_csv_header(input_pattern)
+            rows = (p
+                    | 'ReadCsv' >> beam.io.ReadFromText(input_pattern, skip_header_lines=1)
+                    | 'ParseCsv' >> beam.Map(_parse_csv_line, header=header))
+        else:
+            raise ValueError(f"Unknown data format {data_format}. Valid formats are csv, parquet")
+        if ENTITY_KEY not in header:
+            raise ValueError(f"The data in {input_path} has no {ENTITY_KEY} column, needed by the velocity features")
+
+        fields = [pa.field(k, pa.int64() if k in ('Class', ENTITY_KEY) else pa.float32()) for k in header]
+        fields += [pa.field(k, pa.float32()) for k in get_feature_keys()]
+        _ = (rows
+             | 'AddVelocityFeatures' >> AddVelocityFeatures()
+             | 'WriteParquet' >> beam.io.WriteToParquet(os.path.join(output_dir, 'transactions'),
+                                                        pa.schema(fields),
+                                                        file_name_suffix='.parquet'))
+
+
+if __name__ == '__main__':
+    logging.getLogger().setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-path", required=True, help="Directory with the transactions files")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--data-format", choices=['csv', 'parquet'], default="csv")
+    args, beam_args = parser.parse_known_args()
+
+    add_velocity_features(input_path=args.input_path,
+                          output_dir=args.output_dir,
+                          data_format=args.data_format,
+                          beam_pipeline_args=beam_args)
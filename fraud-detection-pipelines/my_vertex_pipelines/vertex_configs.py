@@ -11,15 +11,68 @@
 #  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
-from typing import Dict, List
-
-import tfx.v1 as tfx
+import datetime
+import os
+import posixpath
+from typing import Any, Dict, List, Optional
 
 BATCH_SIZE = 4096
-DATASET_SIZE = 284807
+# Lower bound of the binary accuracy of the candidate model to bless it
+ACCURACY_THRESHOLD = 0.6
+# The sampled evaluation is enough if the confidence interval is at least this far from the threshold
+EVAL_MARGIN = 0.01
+# Passes over the training data, from scratch and when warm starting from the latest blessed model
+TRAIN_EPOCHS = 1
+WARM_START_EPOCHS = 0.25
+SHUFFLE_BUFFER_SIZE = 10000
+# Examples per call of the model in the batch scoring mode
+SCORE_BATCH_SIZE = 1024
+# Micro-batches of the streaming scoring: max transactions, max wait to fill a batch and parallel batches
+STREAM_BATCH_SIZE = 64
+STREAM_MAX_WAIT_MS = 100
+STREAM_NUM_SHARDS = 16
+# Desired batch size of StatisticsGen when running with several local workers
+LOCAL_STATS_BATCH_SIZE = 4096
+
+LOCAL_PROFILES = ['single', 'multi_threading', 'multi_processing', 'auto']
+LOCAL_DATA_FORMATS = ['csv', 'parquet', 'tfrecord']
+# Format of the examples written by ExampleGen and read by StatisticsGen and Transform
+EXAMPLE_FORMATS = ['tfrecord', 'parquet']
+
+DISTRIBUTION_STRATEGIES = ['none', 'mirrored', 'multi_worker']
+# Policies of the hidden layers of the model, bfloat16 does not need loss scaling
+MIXED_PRECISION_POLICIES = ['none', 'mixed_bfloat16']
+TRAINER_MACHINE_TYPE = 'e2-standard-4'
+# Lightweight variants of the model: max drop of binary accuracy against the float model to push one,
+# fraction of the weights set to zero in the pruned variant and passes over the training data to prune it
+MODEL_VARIANTS = ['int8', 'float16', 'pruned']
+VARIANT_TOLERANCE = 0.01
+PRUNING_SPARSITY = 0.5
+PRUNING_EPOCHS = 0.1
+# Trainer modules: the Keras network of trainer_fn.py, or the gradient boosted trees of trainer_gbt_fn.py
+TRAINER_ENGINES = ['keras', 'gbt']
+GBT_TRAINER_MODULE = 'trainer_gbt_fn.py'
+GBT_NUM_TREES = 300
+GBT_MAX_DEPTH = 6
+# Hyperband epochs of the longest trials, each epoch is a fraction of the training data
+TUNER_MAX_EPOCHS = 9
+
+# Number of most recent spans (days) analyzed by Transform and used for training in incremental runs
+SPAN_WINDOW = 30
+
+# Thresholds of the drift gate: Jensen-Shannon divergence (numeric features) or L-infinity distance
+# (categorical features) of each feature, and relative change of the number of examples
+DRIFT_THRESHOLD = 0.1
+NUM_EXAMPLES_THRESHOLD = 0.2
 
 METADATA_PATH = '/tmp/tfx_metadata.db'
 SERVING_MODEL_DIR = '/tmp/tfx_model/'
+# Deterministic samples of the data files of the development runs, see data_sampling. In Vertex,
+# they are written to this subdirectory of the pipeline root
+SAMPLED_DATA_DIR = '/tmp/tfx_sampled_data/'
+SAMPLED_DATA_SUBDIR = 'sampled_data'
+# Compiled Vertex pipeline definitions, by hash of the arguments and module files
+PIPELINE_SPEC_CACHE_DIR = '/tmp/tfx_pipeline_specs/'
 
 
 def get_beam_args_for_dataflow(project: str,
@@ -38,31 +91,139 @@ def get_beam_args_for_dataflow(project: str,
     return beam_args
 
 
-def get_beam_args_for_local(project: str, temp_location_gcs: str, region: str) -> List[str]:
+def get_local_execution_profile(profile: str = 'single',
+                                num_workers: Optional[int] = None,
+                                running_mode: Optional[str] = None,
+                                stats_batch_size: Optional[int] = None,
+                                resolve_cpu_count: bool = True) -> Dict[str, Any]:
+    """Returns the DirectRunner settings of a local execution profile.
+
+    With resolve_cpu_count=False the number of workers is left to the DirectRunner (0), which
+    uses the CPU count of the machine running the component instead of the one compiling the pipeline.
+    """
+    if profile not in LOCAL_PROFILES:
+        raise ValueError(f"Unknown local profile {profile}. Valid profiles are {LOCAL_PROFILES}")
+
+    cpu_count = os.cpu_count() or 1
+    if profile == 'auto':
+        profile = 'multi_processing' if cpu_count > 1 else 'single'
+
+    if profile == 'single':
+        execution_profile = {'direct_running_mode': 'in_memory',
+                             'direct_num_workers': 1,
+                             'stats_batch_size': None}
+    else:
+        execution_profile = {'direct_running_mode': profile,
+                             'direct_num_workers': cpu_count if resolve_cpu_count else 0,
+                             'stats_batch_size': LOCAL_STATS_BATCH_SIZE}
+
+    if num_workers is not None:
+        execution_profile['direct_num_workers'] = num_workers
+    if running_mode is not None:
+        execution_profile['direct_running_mode'] = running_mode
+    if stats_batch_size is not None:
+        execution_profile['stats_batch_size'] = stats_batch_size
+
+    # The in_memory running mode has a single worker, the DirectRunner would ignore the number of workers
+    if execution_profile['direct_running_mode'] == 'in_memory' and execution_profile['direct_num_workers'] > 1:
+        raise ValueError(f"{execution_profile['direct_num_workers']} DirectRunner workers need the multi_threading "
+                         f"or multi_processing running mode, not in_memory")
+
+    return execution_profile
+
+
+def get_beam_args_for_local(project: str,
+                            temp_location_gcs: str,
+                            region: str,
+                            execution_profile: Optional[Dict[str, Any]] = None) -> List[str]:
     beam_args = [f"--project={project}",
                  f"--temp_location={temp_location_gcs}",
                  f"--region={region}",
                  "--runner=DirectRunner"]
 
+    if execution_profile and execution_profile['direct_running_mode'] != 'in_memory':
+        beam_args += [f"--direct_running_mode={execution_profile['direct_running_mode']}",
+                      f"--direct_num_workers={execution_profile['direct_num_workers']}"]
+
     return beam_args
 
 
-def get_vertex_tuner_config(project_id: str, region: str, service_account: str) -> Dict[str, str]:
-    vertex_tuner_config = {'project': project_id,
-                           'region': region,
-                           'service_account': service_account}
+def get_trainer_input_config(cache: str,
+                             shuffle_buffer_size: int,
+                             deterministic: bool,
+                             profile: bool,
+                             cache_dir: Optional[str] = None) -> Dict[str, Any]:
+    # Options of the tf.data input pipeline of the trainer, see trainer_fn.read_using_tfx
+    input_config = {'input_cache': cache if cache != 'none' else '',
+                    'input_shuffle_buffer_size': shuffle_buffer_size,
+                    'input_deterministic': deterministic,
+                    'input_profile': profile}
+    if cache_dir:
+        input_config['input_cache_dir'] = cache_dir
+    return input_config
+
+
+def get_trainer_fn_file(trainer_fn_path: str, engine: str = 'keras') -> str:
+    """Returns the trainer module file of the engine.
+
+    The gbt module is the one next to trainer_fn_path, so the same paths (local or in GCS) work for
+    both engines. A trainer_fn_path that already points to the gbt module is used as is.
+    """
+    if engine not in TRAINER_ENGINES:
+        raise ValueError(f"Unknown trainer engine {engine}. Valid engines are {TRAINER_ENGINES}")
+    if engine == 'keras' or os.path.basename(trainer_fn_path) == GBT_TRAINER_MODULE:
+        return trainer_fn_path
+    # Local or gs:// paths, both with forward slashes
+    return posixpath.join(posixpath.dirname(trainer_fn_path), GBT_TRAINER_MODULE)
+
+
+def get_latest_complete_span() -> int:
+    # Spans are days since the epoch (UTC), as in the span placeholders of the BigQuery queries
+    return (datetime.datetime.now(datetime.timezone.utc).date() - datetime.date(1970, 1, 1)).days - 1
+
+
+def _get_tfx_image() -> str:
+    # Imported here, so the CLI can parse its arguments (with the defaults of this module) without TFX
+    import tfx.v1 as tfx
+    return 'gcr.io/tfx-oss-public/tfx:{}'.format(tfx.__version__)
+
+
+def get_vertex_tuner_config(project_id: str,
+                            service_account: str,
+                            machine_type: str = TRAINER_MACHINE_TYPE) -> Dict[str, Any]:
+    # The Tuner adds a second worker pool like the first one, with num_parallel_trials - 1 replicas
+    vertex_tuner_config = {
+        'project': project_id,
+        'job_spec': {
+            'service_account': service_account,
+            'worker_pool_specs': [{'machine_spec': {'machine_type': machine_type},
+                                   'replica_count': 1,
+                                   'container_spec': {'image_uri': _get_tfx_image()}
+                                   }]
+        }
+    }
     return vertex_tuner_config
 
 
 def get_vertex_training_config(project_id: str,
-                               service_account: str) -> Dict[str, str]:
+                               service_account: str,
+                               machine_type: str = TRAINER_MACHINE_TYPE,
+                               worker_count: int = 0,
+                               worker_machine_type: Optional[str] = None) -> Dict[str, Any]:
+    # The first pool is the chief, the second pool holds the additional workers of multi-worker training
+    container_spec = {'image_uri': _get_tfx_image()}
+    worker_pool_specs = [{'machine_spec': {'machine_type': machine_type},
+                          'replica_count': 1,
+                          'container_spec': container_spec}]
+    if worker_count > 0:
+        worker_pool_specs.append({'machine_spec': {'machine_type': worker_machine_type or machine_type},
+                                  'replica_count': worker_count,
+                                  'container_spec': dict(container_spec)})
+
     vertex_job_spec = {
         'project': project_id,
         'service_account': service_account,
-        'worker_pool_specs': [{'machine_spec': {'machine_type': 'e2-standard-4'},
-                               'replica_count': 1,
-                               'container_spec': {'image_uri': 'gcr.io/tfx-oss-public/tfx:{}'.format(tfx.__version__)}
-                               }]
+        'worker_pool_specs': worker_pool_specs
     }
 
     return vertex_job_spec
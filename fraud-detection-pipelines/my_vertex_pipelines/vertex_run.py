@@ -12,11 +12,28 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
-import tfx.v1 as tfx
+from typing import Optional
 
 from google.cloud import aiplatform
 from google.cloud.aiplatform import Experiment
 
+# TFX, and TF and Beam (instrumentation), are imported by the functions that use them, so submitting a
+# compiled pipeline definition does not import them
+
+
+def create_job(project_id: str,
+               region: str,
+               pipeline_definition: str,
+               pipeline_name: str,
+               experiment_name: str,
+               job_id: str) -> aiplatform.PipelineJob:
+    aiplatform.init(project=project_id, location=region, experiment=experiment_name)
+
+    return aiplatform.PipelineJob(template_path=pipeline_definition,
+                                  display_name=pipeline_name,
+                                  enable_caching=True,
+                                  job_id=job_id)
+
 
 def run_in_vertex(project_id: str,
                   region: str,
@@ -24,17 +41,41 @@ def run_in_vertex(project_id: str,
                   pipeline_name: str,
                   experiment_name: str,
                   job_id: str,
-                  service_account: str):
-
-    aiplatform.init(project=project_id, location=region, experiment=experiment_name)
+                  service_account: str,
+                  collect_metrics: bool = False,
+                  pipeline_root: Optional[str] = None) -> aiplatform.PipelineJob:
 
-    job = aiplatform.PipelineJob(template_path=pipeline_definition,
-                                 display_name=pipeline_name,
-                                 enable_caching=True,
-                                 job_id=job_id)
+    job = create_job(project_id=project_id,
+                     region=region,
+                     pipeline_definition=pipeline_definition,
+                     pipeline_name=pipeline_name,
+                     experiment_name=experiment_name,
+                     job_id=job_id)
 
     job.submit(service_account=service_account, experiment=experiment_name)
 
+    if collect_metrics:
+        # The metrics are only complete once the job has finished
+        job.wait()
+        from my_vertex_pipelines import instrumentation
+        instrumentation.write_run_metrics(pipeline_root, instrumentation.collect_vertex_run_metrics(job))
+
+    return job
+
+
+def run_locally(pipeline, collect_metrics: bool = False):
+    import tfx.v1 as tfx
+
+    from my_vertex_pipelines import instrumentation
+
+    if not collect_metrics:
+        tfx.orchestration.LocalDagRunner().run(pipeline)
+        return
+
+    with instrumentation.capture_beam_metrics() as beam_metrics:
+        tfx.orchestration.LocalDagRunner().run(pipeline)
 
-def run_locally(pipeline: tfx.dsl.Pipeline):
-    tfx.orchestration.LocalDagRunner().run(pipeline)
+    run_metrics = instrumentation.collect_local_run_metrics(pipeline.metadata_connection_config,
+                                                            pipeline.pipeline_info.pipeline_name,
+                                                            beam_metrics)
+    instrumentation.write_run_metrics(pipeline.pipeline_info.pipeline_root, run_metrics)
@@ -17,4 +17,4 @@ from setuptools import find_packages, setup
 
 setup(name='fraud-detection-pipelines',
       version='0.1',
-      packages=find_packages())
+      packages=find_packages(exclude=['benchmarks']))